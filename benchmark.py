@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+PDF Forensic Sanitizer - Benchmark
+Generates a synthetic PDF corpus and measures the sanitizer phase by phase
+
+Usage:
+    python benchmark.py                          # run, print and save results
+    python benchmark.py --scale 4 --repeat 5     # bigger corpus, best of 5
+    python benchmark.py --compare old.json       # show changes against a run
+    python benchmark.py --startup                # only check import time and lazy imports
+"""
+
+import sys
+import os
+import io
+import json
+import time
+import zlib
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+from pdf_sanitizer_full import PDFSanitizer, DEFAULT_OPTIONS, DEFAULT_MEMORY_BUDGET, __version__
+
+
+# === CORPUS ===
+# Each profile is handed to generate_pdf; size is in MB before --scale
+CORPUS = [
+    {'name': 'text', 'size': 8, 'streams': 2000, 'image_ratio': 0.0, 'xmp_size': 4096,
+     'revisions': 0, 'hex_info': False},
+    {'name': 'images', 'size': 32, 'streams': 400, 'image_ratio': 0.8, 'xmp_size': 4096,
+     'revisions': 0, 'hex_info': False},
+    {'name': 'mixed', 'size': 16, 'streams': 3000, 'image_ratio': 0.25, 'xmp_size': 65536,
+     'revisions': 0, 'hex_info': True},
+    {'name': 'revisions', 'size': 4, 'streams': 500, 'image_ratio': 0.2, 'xmp_size': 4096,
+     'revisions': 8, 'hex_info': False},
+]
+
+# Options enabled in each phase; 'all' is a normal run
+PHASES = {
+    'streams': ['remove_lang_tags'],
+    'info': ['remove_author', 'remove_creator', 'remove_producer', 'remove_title', 'remove_subject'],
+    'id': ['remove_doc_id'],
+    'timestamps': ['remove_timestamps', 'remove_timezone'],
+    'xmp': ['remove_xmp'],
+    'all': list(DEFAULT_OPTIONS),
+}
+
+MODES = ('xref', 'flat', 'stream')
+
+# === STARTUP ===
+# Importing the engine must stay cheap: every CLI run and pool worker pays it
+DEFAULT_STARTUP_BUDGET_MS = 100
+# Only the GUI and the HTTP service use these, and import them when they start
+LAZY_MODULES = ('tkinter', '_tkinter', 'asyncio', 'urllib.parse')
+
+TEXT_LINE = b'/P <</Lang(he) /MCID %d>> BDC BT /F1 %d Tf %d %d Td (%s) Tj ET EMC\n'
+WORDS = [b'report', b'budget', b'meeting', b'summary', b'draft', b'final', b'review', b'notes']
+
+
+def _text_content(rnd, size):
+    """Uncompressed page content of roughly size bytes"""
+    lines = []
+    total = 0
+    while total < size:
+        words = b' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 8)))
+        line = TEXT_LINE % (len(lines), rnd.randint(8, 14), rnd.randint(0, 600), rnd.randint(0, 800), words)
+        lines.append(line)
+        total += len(line)
+    return b''.join(lines)
+
+
+def _xmp_packet(size):
+    packet = (b'<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+              b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF><rdf:Description>'
+              b'<xmp:CreatorTool>Microsoft Word</xmp:CreatorTool>'
+              b'<xmp:CreateDate>2024-01-02T10:11:12+02:00</xmp:CreateDate>'
+              b'<xmp:ModifyDate>2024-01-02T10:11:12+02:00</xmp:ModifyDate>'
+              b'<dc:creator><rdf:Seq><rdf:li>John Smith</rdf:li></rdf:Seq></dc:creator>'
+              b'<dc:title><rdf:Alt><rdf:li xml:lang="x-default">Quarterly plan</rdf:li></rdf:Alt></dc:title>'
+              b'<pdf:Producer>Acrobat Distiller</pdf:Producer>'
+              b'<xmpMM:DocumentID>uuid:6f1c2b8e-1d3a-4c55-9e21-0a7b3c4d5e6f</xmpMM:DocumentID>'
+              b'<xmpMM:InstanceID>uuid:0b9d8c7a-6e5f-4a3b-2c1d-0e9f8a7b6c5d</xmpMM:InstanceID>'
+              b'</rdf:Description></rdf:RDF></x:xmpmeta>\n')
+    # Writers leave whitespace padding so the packet can be edited in place
+    return packet + b' ' * max(size - len(packet) - 20, 0) + b'\n<?xpacket end="w"?>'
+
+
+def _info_dictionary(hex_info, revision=0):
+    def string(text):
+        return b'<' + text.hex().upper().encode() + b'>' if hex_info else b'(' + text + b')'
+    date = b"(D:2024010210%02d12+02'00')" % revision
+    return (b'<</Author' + string(b'John Smith') + b'/Creator' + string(b'Microsoft Word')
+            + b'/Producer' + string(b'Acrobat Distiller') + b'/Title' + string(b'Quarterly plan')
+            + b'/Subject' + string(b'Budget') + b'/CreationDate' + date + b'/ModDate' + date + b'>>')
+
+
+def generate_pdf(size=8, streams=2000, image_ratio=0.0, xmp_size=4096, revisions=0,
+                 hex_info=False, seed=0, **_):
+    """Synthetic PDF of roughly size MB with the given stream mix
+
+    Text streams are Flate content with /Lang(he) marked content; image
+    streams are incompressible DCT data. Each revision is an incremental
+    update that rewrites the Info dictionary.
+    """
+    rnd = random.Random(seed)
+    per_stream = max(int(size * 1024 * 1024) // max(streams, 1), 64)
+    objects = []
+
+    # Text compresses at a steady ratio, so size the content from a sample
+    sample = _text_content(rnd, 64 * 1024)
+    ratio = len(zlib.compress(sample, 6)) / len(sample)
+
+    images = int(streams * image_ratio)
+    kinds = [True] * images + [False] * (streams - images)
+    rnd.shuffle(kinds)
+    for is_image in kinds:
+        if is_image:
+            body = rnd.randbytes(per_stream)
+            objects.append(b'<</Type/XObject/Subtype/Image/Width 64/Height 64/BitsPerComponent 8'
+                           b'/ColorSpace/DeviceRGB/Filter/DCTDecode/Length %d>>\nstream\r\n' % len(body)
+                           + body + b'\r\nendstream')
+        else:
+            body = zlib.compress(_text_content(rnd, int(per_stream / ratio)), 6)
+            objects.append(b'<</Filter/FlateDecode/Length %d>>\nstream\r\n' % len(body)
+                           + body + b'\r\nendstream')
+
+    xmp = _xmp_packet(xmp_size)
+    objects.append(b'<</Type/Metadata/Subtype/XML/Length %d>>\nstream\n' % len(xmp) + xmp + b'\nendstream')
+    metadata = len(objects)
+    objects.append(b'<</Type/Pages/Kids[]/Count 0>>')
+    pages = len(objects)
+    objects.append(b'<</Type/Catalog/Pages %d 0 R/Lang(he)/Metadata %d 0 R>>' % (pages, metadata))
+    catalog = len(objects)
+    objects.append(_info_dictionary(hex_info))
+    info = len(objects)
+
+    out = io.BytesIO()
+    out.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for num, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b'%d 0 obj\n' % num + body + b'\nendobj\n')
+    file_id = b'<%s>' % rnd.randbytes(16).hex().upper().encode()
+    xref = out.tell()
+    out.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b'%010d 00000 n \n' % offset)
+    out.write(b'trailer\n<</Size %d/Root %d 0 R/Info %d 0 R/ID[%s%s]>>\nstartxref\n%d\n%%%%EOF\n'
+              % (len(objects) + 1, catalog, info, file_id, file_id, xref))
+
+    for revision in range(1, revisions + 1):
+        offset = out.tell()
+        out.write(b'%d 0 obj\n' % info + _info_dictionary(hex_info, revision) + b'\nendobj\n')
+        previous, xref = xref, out.tell()
+        instance = b'<%s>' % rnd.randbytes(16).hex().upper().encode()
+        out.write(b'xref\n%d 1\n%010d 00000 n \n' % (info, offset))
+        out.write(b'trailer\n<</Size %d/Root %d 0 R/Info %d 0 R/Prev %d/ID[%s%s]>>\nstartxref\n%d\n%%%%EOF\n'
+                  % (len(objects) + 1, catalog, info, previous, file_id, instance, xref))
+    return out.getvalue()
+
+
+def import_time(runs=5):
+    """Best cumulative import time of pdf_sanitizer_full in ms, from
+    fresh interpreters run with -X importtime, and the lazily imported
+    modules the import pulled in"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    probe = ('import sys, pdf_sanitizer_full; '
+             'print(",".join(m for m in %r if m in sys.modules))' % (LAZY_MODULES,))
+    best = None
+    loaded = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe], cwd=here,
+                                capture_output=True, text=True, check=True)
+        loaded = [m for m in result.stdout.strip().split(',') if m]
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == 'pdf_sanitizer_full':
+                cumulative = int(fields[1]) / 1000
+                best = cumulative if best is None else min(best, cumulative)
+    return best, loaded
+
+
+def check_startup(budget_ms):
+    """True when importing the engine stays within budget without loading
+    the GUI or service modules"""
+    elapsed, loaded = import_time()
+    print(f"Import time: {elapsed:.1f} ms (budget {budget_ms} ms)")
+    ok = elapsed <= budget_ms
+    if not ok:
+        print("[FAIL] Import is over budget")
+    if loaded:
+        print(f"[FAIL] Importing the engine loaded: {', '.join(loaded)}")
+        ok = False
+    return ok
+
+
+# === MEASUREMENT ===
+def _run_once(path, output, options, mode):
+    sanitizer = PDFSanitizer(use_xref=mode == 'xref')
+    budget = DEFAULT_MEMORY_BUDGET if mode == 'stream' else None
+    sanitizer.sanitize_pdf(path, output, dict(options), memory_budget=budget)
+
+
+def measure(path, phase, mode, repeat):
+    """Best wall time of repeat runs, plus peak Python heap from one traced run"""
+    options = {key: key in PHASES[phase] for key in DEFAULT_OPTIONS}
+    output = path + '.out'
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        _run_once(path, output, options, mode)
+        times.append(time.perf_counter() - started)
+
+    # Tracing slows everything down, so it gets a run of its own
+    tracemalloc.start()
+    try:
+        _run_once(path, output, options, mode)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    os.remove(output)
+
+    size = os.path.getsize(path)
+    best = min(times)
+    return {
+        'seconds': round(best, 4),
+        'mb_s': round(size / (1024 * 1024) / best, 2) if best else 0.0,
+        'peak_mb': round(peak / (1024 * 1024), 2),
+    }
+
+
+def run(profiles, phases, modes, scale, repeat, progress=print):
+    results = []
+    with tempfile.TemporaryDirectory(prefix='pdf_bench_') as workdir:
+        for profile in profiles:
+            params = dict(profile, size=profile['size'] * scale)
+            path = os.path.join(workdir, profile['name'] + '.pdf')
+            with open(path, 'wb') as f:
+                f.write(generate_pdf(**params))
+            size = os.path.getsize(path)
+            for mode in modes:
+                for phase in phases:
+                    result = dict(measure(path, phase, mode, repeat),
+                                  profile=profile['name'], size=size, phase=phase, mode=mode)
+                    results.append(result)
+                    progress(f"  {profile['name']:<10} {mode:<6} {phase:<10} "
+                             f"{result['seconds']:8.3f}s {result['mb_s']:9.1f} MB/s "
+                             f"{result['peak_mb']:8.1f} MB peak")
+    return results
+
+
+def compare(results, baseline):
+    """Lines of MB/s changes for every measurement present in both runs"""
+    def key(result):
+        return result['profile'], result['mode'], result['phase']
+
+    before = {key(result): result for result in baseline['results']}
+    lines = [f"Compared with {baseline.get('version', '?')} ({baseline.get('timestamp', '?')}):"]
+    for result in results:
+        old = before.get(key(result))
+        if old is None or not old['mb_s']:
+            continue
+        change = (result['mb_s'] - old['mb_s']) / old['mb_s'] * 100
+        lines.append(f"  {result['profile']:<10} {result['mode']:<6} {result['phase']:<10} "
+                     f"{old['mb_s']:9.1f} -> {result['mb_s']:9.1f} MB/s ({change:+.1f}%)")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PDF Forensic Sanitizer on a synthetic corpus.")
+    parser.add_argument('--profiles', nargs='+', choices=[p['name'] for p in CORPUS],
+                        default=[p['name'] for p in CORPUS], help='corpus profiles to run (default: all)')
+    parser.add_argument('--phases', nargs='+', choices=list(PHASES), default=list(PHASES),
+                        help='phases to measure (default: all)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=['xref'],
+                        help='sanitizer modes to measure (default: xref)')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply every profile size')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, best is kept')
+    parser.add_argument('--output', default=f"benchmark-{__version__}.json",
+                        help='where to save the results (default: %(default)s)')
+    parser.add_argument('--compare', metavar='JSON', help='earlier results to compare against')
+    parser.add_argument('--startup', action='store_true',
+                        help='only check the import time budget and that no GUI module is loaded')
+    parser.add_argument('--startup-budget', type=float, default=DEFAULT_STARTUP_BUDGET_MS, metavar='MS',
+                        help='import time budget in ms (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.startup:
+        return 0 if check_startup(args.startup_budget) else 1
+
+    profiles = [p for p in CORPUS if p['name'] in args.profiles]
+    print(f"PDF Forensic Sanitizer {__version__} benchmark")
+    results = run(profiles, args.phases, args.modes, args.scale, max(args.repeat, 1))
+    import_ms, _ = import_time()
+    print(f"  import     {import_ms:8.1f} ms")
+
+    report = {
+        'version': __version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'import_ms': import_ms,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print('\n'.join(compare(results, json.load(f))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
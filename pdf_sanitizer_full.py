@@ -5,204 +5,4231 @@ Remove forensic traces from PDF files with full control
 Created by: Itay Naftali
 """
 
+# Bump whenever the bytes written for a given input and options can change;
+# cached results from other versions are discarded
+__version__ = '2.3.0'
+
 import sys
 import os
 import re
+import shutil
+import tempfile
+import time
 import zlib
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
+import argparse
+import io
+import json
+import glob
+import hashlib
+import contextlib
+import tracemalloc
+import bisect
 import threading
+import mmap
+import errno
+import stat
+import struct
+import select
+import signal
+import functools
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+# Loaded by _load_gui() when the window is opened, so the engine, the
+# command line modes and pool workers never need Tk
+tk = filedialog = messagebox = ttk = None
+
+
+# === REWRITE RULES ===
+DEFAULT_OPTIONS = {
+    'remove_author': True, 'remove_creator': True, 'remove_producer': True,
+    'remove_title': True, 'remove_subject': True, 'remove_timestamps': True,
+    'remove_timezone': True, 'remove_lang_tags': True, 'remove_doc_id': True,
+    'remove_xmp': True
+}
+
+# (option, stats key, Info dictionary key)
+INFO_FIELDS = [
+    ('remove_author', 'author', b'Author'),
+    ('remove_creator', 'creator', b'Creator'),
+    ('remove_producer', 'producer', b'Producer'),
+    ('remove_title', 'title', b'Title'),
+    ('remove_subject', 'subject', b'Subject'),
+]
+
+# (XMP element, content pattern, replacement content)
+XMP_RULES = [
+    (b'xmp:CreatorTool', rb'[^<]*', b''),
+    (b'dc:creator', rb'.*?', b'<rdf:Seq><rdf:li></rdf:li></rdf:Seq>'),
+    (b'dc:title', rb'.*?', b'<rdf:Alt><rdf:li xml:lang="x-default"></rdf:li></rdf:Alt>'),
+    (b'dc:description', rb'.*?', b'<rdf:Alt><rdf:li xml:lang="x-default"></rdf:li></rdf:Alt>'),
+    (b'pdf:Producer', rb'[^<]*', b''),
+    (b'xmpMM:DocumentID', rb'[^<]*', b'uuid:00000000-0000-0000-0000-000000000000'),
+    (b'xmpMM:InstanceID', rb'[^<]*', b'uuid:00000000-0000-0000-0000-000000000000'),
+    (b'xmp:CreateDate', rb'[^<]*', b'1970-01-01T00:00:00Z'),
+    (b'xmp:ModifyDate', rb'[^<]*', b'1970-01-01T00:00:00Z'),
+]
+
+TIMEZONE_PATTERN = re.compile(rb"(D:\d{14})([+-]\d{2}'\d{2}')")
+ZERO_ID = b'/ID[<00000000000000000000000000000000><00000000000000000000000000000000>]'
+EPOCH_DATE = b'(D:19700101000000Z)'
+PDF_WHITESPACE = b' \t\r\n\x0c\x00'
+
+# === STREAMING LIMITS ===
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+# Longest field match guaranteed to be seen whole across window boundaries
+STREAM_OVERLAP = 1024 * 1024
+ENDSTREAM = b'\nendstream'
+LANG_TAG = b'/Lang(he)'
+
+# === RESOURCE LIMITS ===
+# Inflated bytes allowed per stream and per document before a stream is
+# left alone as a likely decompression bomb
+DEFAULT_MAX_INFLATE = 256 * 1024 * 1024
+DEFAULT_MAX_DOCUMENT_INFLATE = 4 * 1024 * 1024 * 1024
+
+# === RECOMPRESSION ===
+# Besides a zlib level 0-9: 'fast' is level 1, 'match' takes the quickest
+# level that is no larger than the original body, 'smallest' tries every
+# strategy at level 9. Streams that are written piece by piece cannot be
+# compressed twice, so there 'match' is level 6 and 'smallest' level 9.
+RECOMPRESS_POLICIES = ('fast', 'match', 'smallest')
+DEFAULT_RECOMPRESS = 9
+
+# === STREAM SELECTION ===
+# How far back from a stream keyword to look for its dictionary
+STREAM_DICT_LOOKBACK = 4096
+# Compressed bytes handed to the inflater at a time
+INFLATE_CHUNK = 256 * 1024
+STREAM_FILTER = re.compile(rb'/Filter\s*(?:/([^\s/\[\]<>()]+)|\[([^\]]*)\])')
+# Streams that cannot carry a language tag even once inflated: images, font
+# programs, cross-reference data, sampled functions, shadings and XMP.
+# Embedded files are sanitized as documents of their own instead.
+SKIPPED_STREAM = re.compile(
+    rb'/Subtype\s*/(?:Image|Type1C|CIDFontType0C|OpenType)\b|/Type\s*/(?:XRef|Metadata|EmbeddedFile)\b'
+    rb'|/Length[123]\b|/FunctionType\b|/ShadingType\b')
+
+
+def _stream_dictionary(before):
+    """The dictionary at the end of before (the bytes ahead of a stream
+    keyword), or None when it cannot be isolated"""
+    header = before.rfind(b'obj')
+    if header == -1:
+        return None
+    dictionary = bytes(before[header + 3:]).strip(PDF_WHITESPACE)
+    if not (dictionary.startswith(b'<<') and dictionary.endswith(b'>>')):
+        return None
+    return dictionary
+
+
+def _stream_action(dictionary):
+    """'inflate' for Flate streams that may hold language tags, 'scan' for
+    unfiltered bodies, 'skip' for everything else and None if unknown"""
+    if dictionary is None:
+        return None
+    match = STREAM_FILTER.search(dictionary)
+    if match is None:
+        return 'scan'
+    filters = [match.group(1)] if match.group(1) else re.findall(rb'/([^\s/]+)', match.group(2))
+    if filters != [b'FlateDecode'] or SKIPPED_STREAM.search(dictionary):
+        return 'skip'
+    return 'inflate'
+
+
+class _ChainedReader:
+    """Reads pushed-back spool files before resuming the underlying input"""
+
+    def __init__(self, src):
+        self.src = src
+        self.pushed = []
+        self.consumed = 0
+
+    def push(self, fileobj):
+        self.pushed.append(fileobj)
+
+    def read(self, size):
+        while self.pushed:
+            chunk = self.pushed[-1].read(size)
+            if chunk:
+                return chunk
+            self.pushed.pop().close()
+        chunk = self.src.read(size)
+        self.consumed += len(chunk)
+        return chunk
+
+
+
+class SanitizeAborted(Exception):
+    """A job stopped by its time budget or by PDFSanitizer.cancel()
+
+    guard is 'timeout', 'cpu_limit' or 'cancelled'; error is the entry
+    added to stats['errors'].
+    """
+
+    def __init__(self, guard, error):
+        limit = error.get('limit')
+        super().__init__({'timeout': f"Time limit of {limit}s exceeded",
+                          'cpu_limit': f"CPU time limit of {limit}s exceeded"}.get(guard, "Cancelled"))
+        self.guard = guard
+        self.error = error
+
+    def __reduce__(self):
+        return SanitizeAborted, (self.guard, self.error)
+
+
+class _InflateLimit(Exception):
+    """A stream inflated past one of the _JobGuard limits"""
+
+    def __init__(self, guard, limit):
+        super().__init__(guard)
+        self.guard = guard
+        self.limit = limit
+
+
+class _JobGuard:
+    """Resource limits and cancellation for one job, shared by every thread
+    working on it
+
+    Inflation is charged as it happens, so a stream is given up on as soon
+    as it passes max_inflate, not after it has been inflated whole. The time
+    limits are checked at the same points: wall time from when the job
+    started, and CPU time of the threads working on it, so jobs sharing a
+    process (the GUI's) are not charged for each other. Trips are collected
+    in errors.
+
+    The guard of an embedded document has its container's as parent: the
+    parent's time limits and cancellation apply too, and inflation counts
+    towards the parent's document total.
+    """
+
+    def __init__(self, max_inflate=DEFAULT_MAX_INFLATE, max_document_inflate=DEFAULT_MAX_DOCUMENT_INFLATE,
+                 timeout=None, cpu_limit=None, cancelled=None, parent=None):
+        self.max_inflate = max_inflate
+        self.max_document_inflate = max_document_inflate
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        # CPU seconds charged so far, and the last thread_time() read on
+        # each thread that checked in
+        self.cpu_used = 0.0
+        self._cpu_seen = {threading.get_ident(): time.thread_time()}
+        self.cancelled = cancelled or threading.Event()
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Count from zero again, keeping the deadlines: a fallback pass
+        redoes the same work"""
+        self.inflated = 0
+        self.errors = []
+
+    def check(self):
+        """Raise SanitizeAborted once the job is cancelled or out of time"""
+        if self.cancelled.is_set():
+            self._abort('cancelled', None)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self._abort('timeout', self.timeout)
+        if self.cpu_limit is not None and self._charge_cpu() > self.cpu_limit:
+            self._abort('cpu_limit', self.cpu_limit)
+        if self.parent is not None:
+            self.parent.check()
+
+    def _charge_cpu(self):
+        """Add the CPU time this thread used since its last check; returns
+        the job's total"""
+        now = time.thread_time()
+        ident = threading.get_ident()
+        with self.lock:
+            # A thread is charged from its first check; an ident reused by a
+            # new thread can read lower than the one it replaced
+            self.cpu_used += max(now - self._cpu_seen.get(ident, now), 0.0)
+            self._cpu_seen[ident] = now
+            return self.cpu_used
+
+    def _abort(self, guard, limit):
+        error = {'guard': guard, 'limit': limit}
+        with self.lock:
+            if error not in self.errors:
+                self.errors.append(error)
+        raise SanitizeAborted(guard, error)
+
+    def charge(self, size, stream_total):
+        """Count size more inflated bytes of a stream that has now produced
+        stream_total; raises _InflateLimit past either limit"""
+        self.check()
+        if stream_total > self.max_inflate:
+            raise _InflateLimit('stream_inflate', self.max_inflate)
+        with self.lock:
+            self.inflated += size
+            over = self.inflated > self.max_document_inflate
+        if over:
+            raise _InflateLimit('document_inflate', self.max_document_inflate)
+        if self.parent is not None:
+            self.parent.charge(size, 0)
+
+    def note(self, error, offset):
+        """Record a stream left alone because of an _InflateLimit"""
+        with self.lock:
+            # Past the document limit every further stream trips it too
+            if error.guard == 'document_inflate' and any(
+                    entry['guard'] == 'document_inflate' for entry in self.errors):
+                return
+            self.errors.append({'guard': error.guard, 'offset': offset, 'limit': error.limit})
+
+
+class _LangProbe:
+    """Inflates a stream body piece by piece, looking for a Hebrew language
+    tag split across pieces.
+
+    Up to retain_limit bytes of output are kept (None keeps everything) so a
+    matching body does not have to be inflated twice; past that, output is
+    dropped as it is produced. With a guard, inflation is charged to it and
+    stops with _InflateLimit. With first_only, inflation stops at the first
+    tag, for callers that only ask whether there is one.
+    """
+
+    def __init__(self, window, retain_limit=None, guard=None, first_only=False):
+        self.inflater = zlib.decompressobj()
+        self.window = window
+        self.retain_limit = retain_limit
+        self.guard = guard
+        self.first_only = first_only
+        self.inflated = 0
+        self.pieces = []
+        self.retained = 0
+        self.dropped = False
+        self.failed = False
+        self.found = False
+        self.tail = b''
+
+    def feed(self, piece):
+        if self.failed:
+            return
+        try:
+            while piece and not self.inflater.eof and not (self.first_only and self.found):
+                out = self.inflater.decompress(piece, self.window)
+                piece = self.inflater.unconsumed_tail
+                if self.guard is not None:
+                    self.inflated += len(out)
+                    self.guard.charge(len(out), self.inflated)
+                if not self.dropped:
+                    self.retained += len(out)
+                    if self.retain_limit is not None and self.retained > self.retain_limit:
+                        self.dropped = True
+                        self.pieces = []
+                    else:
+                        self.pieces.append(out)
+                text = self.tail + out
+                self.found = self.found or LANG_TAG in text
+                self.tail = text[-(len(LANG_TAG) - 1):]
+        except zlib.error:
+            self.failed = True
+
+    @property
+    def done(self):
+        """No further input can change the outcome"""
+        return self.failed or self.inflater.eof or (self.first_only and self.found)
+
+    @property
+    def matched(self):
+        """True when the body inflated completely and holds a tag; with
+        first_only, when a tag turned up before any error"""
+        return not self.failed and self.found and (self.inflater.eof or self.first_only)
+
+    def output(self):
+        """The whole inflated body, or None if it was not retained"""
+        return None if self.dropped else b''.join(self.pieces)
+
+
+def _check_recompress(policy):
+    if policy in RECOMPRESS_POLICIES:
+        return policy
+    if isinstance(policy, int) and not isinstance(policy, bool) and 0 <= policy <= 9:
+        return policy
+    raise ValueError(f"Unknown recompression policy: {policy!r}")
+
+
+def _deflater(policy):
+    """Incremental compressor for a policy"""
+    if policy == 'smallest':
+        return zlib.compressobj(9, zlib.DEFLATED, 15, 9)
+    return zlib.compressobj({'fast': 1, 'match': 6}.get(policy, policy))
+
+
+def _deflate(data, policy, original_size):
+    """Compress a whole inflated body according to a policy"""
+    if policy == 'fast':
+        return zlib.compress(data, 1)
+    if policy == 'match':
+        for level in (1, 6):
+            packed = zlib.compress(data, level)
+            if len(packed) <= original_size:
+                return packed
+        return zlib.compress(data, 9)
+    if policy == 'smallest':
+        candidates = []
+        for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+            deflater = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+            candidates.append(deflater.compress(data) + deflater.flush())
+        return min(candidates, key=len)
+    return zlib.compress(data, policy)
+
+
+def _rewrite_flate(body, retain_limit=None, policy=DEFAULT_RECOMPRESS, guard=None):
+    """Rewrite the language tags of one Flate stream body.
+
+    Returns (replacement, tags, packed, seconds): replacement covers the
+    whole stream ... endstream span, or is None when the body has no tag
+    and keeps its original bytes; packed is the new compressed length and
+    seconds the time spent compressing. Touches no shared state besides
+    guard, which is thread-safe, so bodies can be handled on worker threads.
+    """
+    probe = _LangProbe(INFLATE_CHUNK, retain_limit, guard)
+    for i in range(0, len(body), INFLATE_CHUNK):
+        probe.feed(body[i:i + INFLATE_CHUNK])
+        if probe.done:
+            break
+    if not probe.matched:
+        return None, 0, 0, 0.0
+
+    decompressed = probe.output()
+    if decompressed is None:
+        out = io.BytesIO()
+        tags, packed, seconds = _rewrite_flate_to(io.BytesIO(body).read, len(body), out,
+                                                  INFLATE_CHUNK, policy, guard)
+        return out.getvalue(), tags, packed, seconds
+    tags = decompressed.count(LANG_TAG)
+    decompressed = decompressed.replace(LANG_TAG, b'/Lang(en)')
+    started = time.perf_counter()
+    packed = _deflate(decompressed, policy, len(body))
+    seconds = time.perf_counter() - started
+    return b'stream\r\n' + packed + b'\r\nendstream', tags, len(packed), seconds
+
+
+def _timed(function, *args):
+    """function(*args) and the wall time it took, for work run on a pool"""
+    started = time.perf_counter()
+    return function(*args), time.perf_counter() - started
+
+
+def _rewrite_flate_to(read, length, dst, window, policy=DEFAULT_RECOMPRESS, guard=None):
+    """Inflate a stream body piece by piece, rewrite its language tags and
+    deflate it to dst. Returns (tags, packed, seconds) as _rewrite_flate.
+    The body was already probed within the guard's limits; only its time
+    limits are checked here."""
+    inflater = zlib.decompressobj()
+    deflater = _deflater(policy)
+    keep = len(LANG_TAG) - 1
+    tail = b''
+    tags = packed = 0
+    seconds = 0.0
+    dst.write(b'stream\r\n')
+    while length and not inflater.eof:
+        if guard is not None:
+            guard.check()
+        piece = read(min(window, length))
+        length -= len(piece)
+        while piece and not inflater.eof:
+            text = tail + inflater.decompress(piece, window)
+            piece = inflater.unconsumed_tail
+            tags += text.count(LANG_TAG)
+            text = text.replace(LANG_TAG, b'/Lang(en)')
+            started = time.perf_counter()
+            out = deflater.compress(text[:-keep])
+            seconds += time.perf_counter() - started
+            packed += len(out)
+            dst.write(out)
+            tail = text[-keep:]
+    started = time.perf_counter()
+    out = deflater.compress(tail) + deflater.flush()
+    seconds += time.perf_counter() - started
+    packed += len(out)
+    dst.write(out)
+    dst.write(b'\r\nendstream')
+    return tags, packed, seconds
+
+
+# === PATCHED OUTPUT ===
+# errnos meaning "this copy method does not work here", not "the copy failed"
+COPY_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF,
+                    errno.EPERM, errno.ENOTSUP}
+# Largest single kernel copy; larger ranges take several calls
+COPY_CHUNK = 1 << 30
+# Literal bytes collected before a write call
+WRITE_BUFFER = 1024 * 1024
+
+
+def _apply_patches(data, patches):
+    """data with sorted (offset, old_length, replacement) patches applied"""
+    if not patches:
+        return data
+    pieces = []
+    last = 0
+    for offset, old_length, replacement in patches:
+        pieces.append(data[last:offset])
+        pieces.append(replacement)
+        last = offset + old_length
+    pieces.append(data[last:])
+    return b''.join(pieces)
+
+
+@contextlib.contextmanager
+def _mapped(f):
+    """Read-only memory map of an open file (b'' when it is empty)"""
+    if os.fstat(f.fileno()).st_size == 0:
+        yield b''
+        return
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield data
+    finally:
+        try:
+            data.close()
+        except BufferError:
+            # Views into the map are still held, by the traceback of an
+            # error on its way out say; it is unmapped once they go
+            pass
+
+
+@contextlib.contextmanager
+def _output_file(input_path, output_path, buffering=0):
+    """File to write output_path through, unbuffered by default
+
+    When output_path is input_path itself, a temporary neighbour is written
+    and moved over it once complete, since the input is still being read.
+    An output left incomplete by an error is removed. input_path is None
+    for an input that is not a file.
+    """
+    same = (input_path is not None and os.path.exists(output_path)
+            and os.path.samefile(input_path, output_path))
+    target = output_path + '.partial' if same else output_path
+    try:
+        with open(target, 'wb', buffering=buffering) as dst:
+            yield dst
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(target)
+        raise
+    if same:
+        os.replace(target, output_path)
+
+
+class _SpliceWriter:
+    """Write a mix of literal bytes and byte ranges of src to dst
+
+    Ranges never pass through Python: copy_file_range is tried first, then
+    sendfile, then slices of a memory map; a method the platform or
+    filesystem refuses is dropped for the rest of the file. An input held
+    in memory is passed as data and sliced directly; dst then only needs a
+    write method.
+    """
+
+    def __init__(self, src, dst, data=None):
+        self.src = None if data is not None else src.fileno()
+        self.dst = dst
+        self.data = data
+        # The map made by _write_mapped, which close() releases
+        self.mapped = None
+        self.pending = bytearray()
+        # Bytes written so far
+        self.position = 0
+        kernel = (('copy_file_range', self._copy_file_range), ('sendfile', self._sendfile))
+        self.methods = [method for name, method in kernel
+                        if data is None and hasattr(os, name)] + [self._write_mapped]
+
+    def write(self, data):
+        self.pending += data
+        self.position += len(data)
+        if len(self.pending) >= WRITE_BUFFER:
+            self.flush()
+
+    def copy(self, offset, length):
+        """Append length bytes of src starting at offset"""
+        self.flush()
+        self.position += length
+        while length > 0:
+            method = self.methods[0]
+            try:
+                copied = method(offset, min(length, COPY_CHUNK))
+            except OSError as e:
+                if e.errno not in COPY_UNSUPPORTED or method == self._write_mapped:
+                    raise
+                copied = 0
+            if copied == 0:
+                if method == self._write_mapped:
+                    raise OSError(errno.EIO, "Input file shrank while being copied")
+                self.methods.pop(0)
+                continue
+            offset += copied
+            length -= copied
+
+    def flush(self):
+        with memoryview(self.pending) as view:
+            done = 0
+            while done < len(view):
+                written = self.dst.write(view[done:])
+                # Some writable objects report nothing and write everything
+                done = len(view) if written is None else done + written
+        self.pending.clear()
+
+    def _copy_file_range(self, offset, length):
+        return os.copy_file_range(self.src, self.dst.fileno(), length, offset)
+
+    def _sendfile(self, offset, length):
+        return os.sendfile(self.dst.fileno(), self.src, offset, length)
+
+    def _write_mapped(self, offset, length):
+        if self.data is None:
+            self.data = self.mapped = mmap.mmap(self.src, 0, access=mmap.ACCESS_READ)
+        with memoryview(self.data) as view:
+            written = self.dst.write(view[offset:offset + length])
+        return max(min(length, len(self.data) - offset), 0) if written is None else written
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+
+
+def _write_patched(input_path, output_path, patches):
+    """Write input_path with sorted patches applied to output_path
+
+    Only the replacement bytes are written from Python; everything between
+    them is copied by _SpliceWriter. Returns the output size.
+    """
+    with open(input_path, 'rb') as src, _output_file(input_path, output_path) as dst:
+        out = _SpliceWriter(src, dst)
+        try:
+            last = 0
+            for offset, old_length, replacement in patches:
+                out.copy(last, offset - last)
+                out.write(replacement)
+                last = offset + old_length
+            out.copy(last, os.fstat(src.fileno()).st_size - last)
+            out.flush()
+        finally:
+            out.close()
+        return out.position
+
+
+class _BufferReader:
+    """Read-only file over data with sorted patches applied, made without
+    building the patched bytes; XrefIndex reads in-memory inputs and outputs
+    through it"""
+
+    def __init__(self, data, patches=()):
+        # Pieces of the output as (source, start, length), and where each begins
+        self.pieces = []
+        self.starts = []
+        self.size = 0
+        last = 0
+        for offset, old_length, replacement in patches:
+            self._add(data, last, offset - last)
+            self._add(replacement, 0, len(replacement))
+            last = offset + old_length
+        self._add(data, last, len(data) - last)
+        self.position = 0
+
+    def _add(self, source, start, length):
+        if length > 0:
+            self.pieces.append((source, start, length))
+            self.starts.append(self.size)
+            self.size += length
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.size}[whence]
+        self.position = max(base + offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        chunks = []
+        i = bisect.bisect_right(self.starts, self.position) - 1
+        while self.position < end:
+            source, start, length = self.pieces[i]
+            skip = self.position - self.starts[i]
+            take = min(length - skip, end - self.position)
+            chunks.append(source[start + skip:start + skip + take])
+            self.position += take
+            i += 1
+        return b''.join(chunks)
+
+
+@contextlib.contextmanager
+def _buffer_of(source):
+    """The bytes of an in-memory input: bytes, a bytearray, a memoryview or a
+    binary file object (read from its current position)
+
+    bytes, views of a whole bytes object and files on disk are used where
+    they are (a file is memory-mapped); anything else is copied once, as a
+    mutable buffer must not change while it is being sanitized.
+    """
+    if isinstance(source, bytes):
+        yield source
+        return
+    if isinstance(source, (bytearray, memoryview)):
+        view = memoryview(source)
+        if isinstance(view.obj, bytes) and view.c_contiguous and view.nbytes == len(view.obj):
+            yield view.obj
+        else:
+            yield view.tobytes()
+        return
+    try:
+        on_disk = source.tell() == 0 and stat.S_ISREG(os.fstat(source.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        on_disk = False
+    if on_disk:
+        with _mapped(source) as data:
+            yield data
+    else:
+        yield source.read()
+
+
+class _PathTarget:
+    """Input and output of a sanitize call working on files"""
+
+    def __init__(self, input_path, output_path):
+        self.input_path = input_path
+        self.output_path = output_path
+
+    def source(self):
+        return open(self.input_path, 'rb')
+
+    def mapped(self, f):
+        return _mapped(f)
+
+    def write_patched(self, f, patches):
+        """Write the input with sorted patches applied; returns the size"""
+        return _write_patched(self.input_path, self.output_path, patches)
+
+    def append(self, f, size, revision):
+        """Write the input followed by revision; an input sanitized onto
+        itself only has the revision appended. Returns the size."""
+        if os.path.exists(self.output_path) and os.path.samefile(self.input_path, self.output_path):
+            with open(self.output_path, 'ab') as out:
+                out.write(revision)
+            return size + len(revision)
+        return self.write_patched(f, [(size, 0, revision)])
+
+    @contextlib.contextmanager
+    def splice(self, f):
+        """_SpliceWriter over the output, flushed at the end of the block"""
+        with _output_file(self.input_path, self.output_path) as dst:
+            out = _SpliceWriter(f, dst)
+            try:
+                yield out
+                out.flush()
+            finally:
+                out.close()
+
+    def written(self, patches):
+        """The output as a file, to check it once written"""
+        return open(self.output_path, 'rb')
+
+
+class _BufferTarget:
+    """Input and output of a sanitize call working in memory: data (bytes
+    or a memory map) is written, patched, to the binary file object dst"""
+
+    def __init__(self, data, dst):
+        self.data = data
+        self.dst = dst
+
+    def source(self):
+        return contextlib.nullcontext(_BufferReader(self.data))
+
+    def mapped(self, f):
+        return contextlib.nullcontext(self.data)
+
+    def write_patched(self, f, patches):
+        with self.splice(f) as out:
+            last = 0
+            for offset, old_length, replacement in patches:
+                out.copy(last, offset - last)
+                out.write(replacement)
+                last = offset + old_length
+            out.copy(last, len(self.data) - last)
+        return out.position
+
+    def append(self, f, size, revision):
+        return self.write_patched(f, [(size, 0, revision)])
+
+    @contextlib.contextmanager
+    def splice(self, f):
+        out = _SpliceWriter(f, self.dst, self.data)
+        yield out
+        out.flush()
+
+    def written(self, patches):
+        # dst may be write-only, so the output is read back from the input
+        return contextlib.nullcontext(_BufferReader(self.data, patches))
+
+
+class RewriteEngine:
+    """Single-pass matcher compiled from the enabled sanitization options.
+
+    Every rule becomes one named alternative of a single regex, grouped by
+    its leading byte so the regex engine can skip straight to candidates.
+    The buffer is walked once and the output is joined once at the end.
+    """
+
+    def __init__(self, options, in_place=False, recompress=DEFAULT_RECOMPRESS, guard=None):
+        self.options = options
+        # _JobGuard limiting how far streams are inflated, or None
+        self.guard = guard
+        # In-place rewrites must not grow identifiers whose length we keep
+        self.in_place = in_place
+        self.recompress = _check_recompress(recompress)
+        self.handlers = {}
+        self.stats = None
+        # Rule name -> [matches, bytes matched], and time spent on stream
+        # bodies, for SanitizeMetrics
+        self.matches = {}
+        self.stream_seconds = 0.0
+        rules = []
+
+        if options.get('remove_lang_tags'):
+            rules.append((b's', 'stream', rb'tream\r?\n', None))
+
+        if options.get('remove_timestamps'):
+            for name in (b'CreationDate', b'ModDate'):
+                rules.append((b'/', name.decode().lower(), name + rb'\([^)]*\)',
+                              self._make_date_handler(name)))
+
+        for option, key, name in INFO_FIELDS:
+            if options.get(option):
+                rules.append((b'/', key, name + rb'(?:\([^)]*\)|<[^>]*>)',
+                              self._make_info_handler(key, name)))
+
+        if options.get('remove_timezone'):
+            rules.append((b'D', 'timezone', rb":\d{14}[+-]\d{2}'\d{2}'", self._handle_timezone))
+
+        if options.get('remove_lang_tags'):
+            rules.append((b'/', 'lang', rb'Lang\(he\)', lambda m: b'/Lang(en)'))
+
+        if options.get('remove_doc_id'):
+            rules.append((b'/', 'doc_id',
+                          rb'ID\s*\[\s*<[A-Fa-f0-9]+>(?P<doc_id_full>\s*<[A-Fa-f0-9]+>\s*\])?',
+                          self._handle_doc_id))
+
+        if options.get('remove_xmp'):
+            for i, (tag, content, replacement) in enumerate(XMP_RULES):
+                rules.append((b'<', f'xmp{i}', tag + b'>' + content + b'</' + tag + b'>',
+                              self._make_xmp_handler(tag, replacement)))
+
+        groups = {}
+        for first, name, pattern, handler in rules:
+            groups.setdefault(first, []).append(b'(?P<' + name.encode() + b'>' + pattern + b')')
+            self.handlers[name] = handler
+            self.matches[name] = [0, 0]
+        branches = [re.escape(first) + b'(?:' + b'|'.join(alts) + b')'
+                    for first, alts in groups.items()]
+        self.pattern = re.compile(b'|'.join(branches), re.DOTALL) if branches else None
+
+    def rewrite(self, data, stats, executor=None):
+        """Apply every enabled rule to data in one scan"""
+        return _apply_patches(data, self.patches(data, stats, executor))
+
+    def patches(self, data, stats, executor=None):
+        """Sorted (offset, old_length, replacement) edits that apply every
+        enabled rule to data, found in one scan
+
+        With an executor, Flate streams are inflated and recompressed on its
+        workers while the scan goes on; results are collected in order.
+        """
+        if self.pattern is None:
+            return []
+        self.stats = stats
+        search = self.pattern.search
+        handlers = self.handlers
+        matches = self.matches
+        patches = []
+        pending = False
+        pos = 0
+        # Unfiltered stream bodies are scanned like any other bytes, but
+        # stream keywords inside them must not start a new stream
+        stream_end = 0
+
+        while True:
+            match = search(data, pos)
+            if match is None:
+                break
+            name = match.lastgroup
+            start = match.start()
+            if name == 'stream':
+                pos = match.end()
+                if start < stream_end:
+                    continue
+                if self.guard is not None:
+                    self.guard.check()
+                newline = data.find(ENDSTREAM, pos + 1)
+                if newline == -1:
+                    continue
+                end = newline + len(ENDSTREAM)
+                dictionary = _stream_dictionary(data[max(start - STREAM_DICT_LOOKBACK, 0):start])
+                body = memoryview(data)[pos:self._body_end(data, pos, newline)]
+                action = self._count_stream(dictionary)
+                counter = matches['stream']
+                counter[0] += 1
+                counter[1] += len(body)
+                if executor is not None and action == 'inflate':
+                    # Flate bodies are skipped whatever the outcome, so only
+                    # the replacement bytes wait on the worker
+                    patches.append((start, end - start, (
+                        executor.submit(_timed, _rewrite_flate, body, None, self.recompress, self.guard),
+                        len(body))))
+                    pending = True
+                    pos = end
+                    continue
+                started = time.perf_counter()
+                replacement, scan_body = self._process_stream(action, body, offset=start)
+                self.stream_seconds += time.perf_counter() - started
+                if replacement is not None:
+                    patches.append((start, end - start, replacement))
+                    pos = end
+                elif scan_body:
+                    stream_end = end
+                else:
+                    pos = end
+                continue
+            pos = match.end()
+            patches.append((start, pos - start, handlers[name](match)))
+            counter = matches[name]
+            counter[0] += 1
+            counter[1] += pos - start
+
+        if pending:
+            resolved = []
+            for offset, old_length, replacement in patches:
+                if type(replacement) is tuple:
+                    future, original = replacement
+                    try:
+                        (replacement, tags, packed, seconds), elapsed = future.result()
+                    except _InflateLimit as e:
+                        self.guard.note(e, offset)
+                        continue
+                    self.stream_seconds += elapsed
+                    self._note_recompressed(tags, original, packed, seconds)
+                    if replacement is None:
+                        continue
+                resolved.append((offset, old_length, replacement))
+            patches = resolved
+        return patches
+
+    # === SCANNING ===
+    def scan(self, data, first_only=False):
+        """Find what rewrite() would remove without building any output
+
+        Returns {category: [(offset, text), ...]} using the stats keys as
+        categories. Flate streams are inflated but never recompressed, and a
+        tag inside one is reported at the stream keyword. With first_only,
+        each category stops at its first finding and the scan ends once
+        every enabled category has one.
+        """
+        findings = {}
+        if self.pattern is None:
+            return findings
+        search = self.pattern.search
+        wanted = self._categories()
+        stream_end = 0
+        pos = 0
+
+        def found(category, offset, text):
+            if first_only and category in findings:
+                return
+            findings.setdefault(category, []).append((offset, bytes(text[:80]).decode('latin-1')))
+
+        while not (first_only and wanted <= findings.keys()):
+            match = search(data, pos)
+            if match is None:
+                break
+            name = match.lastgroup
+            start = match.start()
+            pos = match.end()
+            if name != 'stream':
+                for category, offset, text in self._detect(name, match):
+                    found(category, offset, text)
+                continue
+            if start < stream_end:
+                continue
+            newline = data.find(ENDSTREAM, pos + 1)
+            if newline == -1:
+                continue
+            end = newline + len(ENDSTREAM)
+            action = _stream_action(_stream_dictionary(data[max(start - STREAM_DICT_LOOKBACK, 0):start]))
+            if action == 'skip' or (action == 'inflate' and first_only and 'lang_tags' in findings):
+                pos = end
+                continue
+            if action in ('inflate', None):
+                probe = _LangProbe(INFLATE_CHUNK, retain_limit=0, guard=self.guard, first_only=first_only)
+                try:
+                    with memoryview(data) as view:
+                        body_end = self._body_end(data, pos, newline)
+                        for i in range(pos, body_end, INFLATE_CHUNK):
+                            with view[i:min(i + INFLATE_CHUNK, body_end)] as piece:
+                                probe.feed(piece)
+                            if probe.done:
+                                break
+                except _InflateLimit as e:
+                    self.guard.note(e, start)
+                    pos = end
+                    continue
+                if probe.matched:
+                    found('lang_tags', start, b'stream ' + LANG_TAG)
+                    pos = end
+                    continue
+                if action == 'inflate':
+                    pos = end
+                    continue
+            # Unfiltered or unidentified body: look inside it like any bytes
+            stream_end = end
+        return findings
+
+    def _categories(self):
+        """Finding categories the enabled rules can produce"""
+        categories = {key for option, key, _ in INFO_FIELDS if self.options.get(option)}
+        for option, key in (('remove_timestamps', 'timestamps'), ('remove_timezone', 'timezone'),
+                            ('remove_lang_tags', 'lang_tags'), ('remove_doc_id', 'doc_id'),
+                            ('remove_xmp', 'xmp')):
+            if self.options.get(option):
+                categories.add(key)
+        return categories
+
+    def _detect(self, name, match):
+        """(category, offset, text) for each trace carried by a rule match,
+        following the same tests the rewrite handlers apply"""
+        text = match.group(0)
+        start = match.start()
+        traces = []
+        if name == 'timezone':
+            return [('timezone', start, text)]
+        if name == 'lang':
+            return [('lang_tags', start, text)]
+        if name == 'doc_id':
+            # Only a complete /ID pair is rewritten; zeroed IDs are clean
+            if match.group('doc_id_full') is not None and re.search(rb'<[0-9A-Fa-f]*[1-9A-Fa-f]', text):
+                traces.append(('doc_id', start, text))
+            return traces
+        if name.startswith('xmp'):
+            tag, _, replacement = XMP_RULES[int(name[3:])]
+            if text[len(tag) + 2:-len(tag) - 3] != replacement:
+                traces.append(('xmp', start, text))
+        elif name in ('creationdate', 'moddate'):
+            value = text[text.index(b'('):]
+            if value not in (b'()', EPOCH_DATE):
+                traces.append(('timestamps', start, text))
+        elif text[-2:] not in (b'()', b'<>'):
+            traces.append((name, start, text))
+        if self.options.get('remove_timezone'):
+            zone = TIMEZONE_PATTERN.search(text)
+            if zone:
+                traces.append(('timezone', start + zone.start(), zone.group(0)))
+        return traces
+
+    # === STREAMING ===
+    def rewrite_stream(self, src, dst, stats, memory_budget=DEFAULT_MEMORY_BUDGET,
+                       progress=None):
+        """Apply every enabled rule while copying src to dst in bounded memory.
+
+        The input is read in fixed windows; the last STREAM_OVERLAP bytes of
+        each window are carried into the next so matches are never split.
+        Stream bodies that run past the window are spooled to a temporary
+        file. Returns the number of input bytes read.
+        """
+        self.stats = stats
+        window = max(memory_budget // 4, 64 * 1024)
+        overlap = min(STREAM_OVERLAP, window // 2)
+        reader = _ChainedReader(src)
+        search = self.pattern.search if self.pattern is not None else None
+        buf = b''
+        # Bytes just ahead of buf, where a stream's dictionary may start
+        history = b''
+        base = 0
+        stream_end = 0
+        eof = False
+
+        while True:
+            while not eof and len(buf) < window:
+                chunk = reader.read(window - len(buf))
+                if not chunk:
+                    eof = True
+                else:
+                    buf += chunk
+            if progress:
+                progress(reader.consumed)
+            if self.guard is not None:
+                self.guard.check()
+
+            limit = len(buf) if eof else len(buf) - overlap
+            last = pos = 0
+            pushed_back = False
+            while search is not None and pos < limit:
+                match = search(buf, pos)
+                if match is None or match.start() >= limit:
+                    break
+                name = match.lastgroup
+                start = match.start()
+                if name != 'stream':
+                    dst.write(buf[last:start])
+                    dst.write(self.handlers[name](match))
+                    last = pos = match.end()
+                    self.matches[name][0] += 1
+                    self.matches[name][1] += pos - start
+                    continue
+                pos = match.end()
+                if base + start < stream_end:
+                    continue
+
+                dictionary = _stream_dictionary(self._lookback(history, buf, start))
+                newline = buf.find(ENDSTREAM, pos + 1)
+                if newline != -1 or eof:
+                    # The whole stream is already in the window
+                    if newline == -1:
+                        continue
+                    end = newline + len(ENDSTREAM)
+                    body = memoryview(buf)[pos:self._body_end(buf, pos, newline)]
+                    self.matches['stream'][0] += 1
+                    self.matches['stream'][1] += len(body)
+                    started = time.perf_counter()
+                    replacement, scan_body = self._process_stream(
+                        self._count_stream(dictionary), body, window, offset=base + start)
+                    self.stream_seconds += time.perf_counter() - started
+                    if replacement is not None:
+                        dst.write(buf[last:start])
+                        dst.write(replacement)
+                        last = pos = end
+                    elif scan_body:
+                        stream_end = base + end
+                    else:
+                        pos = end
+                    continue
+
+                dst.write(buf[last:start])
+                body_start = pos - start
+                action = _stream_action(dictionary)
+                started = time.perf_counter()
+                spool, body_end, end, rewrite = self._spool_stream(
+                    reader, buf[start:], body_start, window, probe=action in ('inflate', None),
+                    offset=base + start)
+                if end is not None:
+                    self._count_stream(dictionary)
+                    self.matches['stream'][0] += 1
+                    self.matches['stream'][1] += body_end - body_start
+                history = self._lookback(history, buf, start)
+                if end is None:
+                    # No endstream: not a stream, rescan past the keyword only
+                    spool.seek(0)
+                    stream_end = base + start + 1
+                elif rewrite:
+                    spool.seek(body_start)
+                    tags, packed, seconds = _rewrite_flate_to(
+                        spool.read, body_end - body_start, dst, window, self.recompress, self.guard)
+                    self._note_recompressed(tags, body_end - body_start, packed, seconds)
+                    spool.seek(end + len(ENDSTREAM))
+                    start += end + len(ENDSTREAM)
+                    history = b''
+                elif action in ('scan', None):
+                    spool.seek(0)
+                    stream_end = base + start + end + len(ENDSTREAM)
+                else:
+                    # Binary body: copy it through without scanning
+                    spool.seek(0)
+                    remaining = end + len(ENDSTREAM)
+                    while remaining:
+                        chunk = spool.read(min(window, remaining))
+                        dst.write(chunk)
+                        remaining -= len(chunk)
+                    start += end + len(ENDSTREAM)
+                    history = b''
+                self.stream_seconds += time.perf_counter() - started
+                reader.push(spool)
+                base += start
+                buf = b''
+                eof = False
+                pushed_back = True
+                break
+
+            if pushed_back:
+                continue
+            # Resume after the last stream jumped over, not inside it
+            cut = max(pos, limit)
+            dst.write(buf[last:cut])
+            history = self._lookback(history, buf, cut)
+            base += cut
+            buf = buf[cut:]
+            if eof and not buf:
+                return reader.consumed
+
+    @staticmethod
+    def _lookback(history, buf, pos):
+        """The STREAM_DICT_LOOKBACK bytes before buf[pos], reaching into history"""
+        if pos >= STREAM_DICT_LOOKBACK:
+            return buf[pos - STREAM_DICT_LOOKBACK:pos]
+        return history[len(history) - (STREAM_DICT_LOOKBACK - pos):] + buf[:pos]
+
+    @staticmethod
+    def _body_end(data, body_start, newline):
+        """Index where a stream body ends given the newline before endstream"""
+        if data[newline - 1:newline] == b'\r' and newline - 1 > body_start:
+            return newline - 1
+        return newline
+
+    def _spool_stream(self, reader, head, body_start, window, probe=True, offset=None):
+        """Copy a stream to a spool file until its endstream is found.
+
+        Returns (spool, body_end, end, rewrite) where end is the spool offset
+        of the newline before endstream, or None if there is none. The body
+        is probed for Hebrew language tags as it arrives, unless probe is
+        False; offset is where the stream starts, for reporting limits.
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=window)
+        spool.write(head)
+        lang_probe = _LangProbe(window, retain_limit=0, guard=self.guard) if probe else None
+        stream_offset = offset
+        data, offset = head, 0
+        fed = body_start
+        scanned = body_start + 1
+        # Carry enough bytes to see an endstream split across reads, plus
+        # the byte before it in case of a CRLF
+        keep = len(ENDSTREAM) + 1
+
+        while True:
+            found_at = data.find(ENDSTREAM, max(scanned - offset, 0))
+            if found_at != -1:
+                end = offset + found_at
+                safe = offset + self._body_end(data, body_start - offset, found_at)
+            else:
+                end = None
+                safe = offset + len(data) - len(ENDSTREAM)
+                scanned = max(scanned, safe + 1)
+
+            if lang_probe and safe > fed and not lang_probe.done:
+                try:
+                    lang_probe.feed(data[fed - offset:safe - offset])
+                except _InflateLimit as e:
+                    # Keep spooling, but the body is copied through as it is
+                    self.guard.note(e, stream_offset)
+                    lang_probe.failed = True
+                fed = safe
+
+            if end is not None:
+                break
+            chunk = reader.read(window)
+            if not chunk:
+                break
+            spool.write(chunk)
+            carry = data[-keep:]
+            offset += len(data) - len(carry)
+            data = carry + chunk
+
+        return spool, safe, end, lang_probe is not None and lang_probe.matched
+
+    def _note_timezone(self, text):
+        # Sequential passes stripped timezones before other rules consumed them
+        if self.options.get('remove_timezone') and TIMEZONE_PATTERN.search(text):
+            self.stats['timezone'] = True
+
+    # === HANDLERS ===
+    def _process_stream(self, action, body, retain_limit=None, offset=None):
+        """Decide what happens to one stream body given its classification.
+
+        Returns (replacement, scan_body): the bytes replacing the whole
+        stream ... endstream span or None to keep it, and whether a body
+        that is kept should still be searched by the other rules. offset is
+        where the stream starts, for reporting limits.
+        """
+        if action in ('scan', 'skip'):
+            return None, action == 'scan'
+        try:
+            replacement, tags, packed, seconds = _rewrite_flate(body, retain_limit, self.recompress, self.guard)
+        except _InflateLimit as e:
+            self.guard.note(e, offset)
+            return None, False
+        self._note_recompressed(tags, len(body), packed, seconds)
+        if replacement is None:
+            return None, action is None
+        return replacement, False
+
+    def _note_recompressed(self, tags, original, packed, seconds):
+        """Record a stream rewrite; bodies without a tag were left alone"""
+        if not tags:
+            return
+        self.stats['lang_tags'] += tags
+        self.stats['recompress_bytes_in'] += original
+        self.stats['recompress_bytes_out'] += packed
+        self.stats['recompress_seconds'] += seconds
+
+    def _count_stream(self, dictionary):
+        """Classify a stream and record whether it will be inflated"""
+        action = _stream_action(dictionary)
+        if action in ('scan', 'skip'):
+            self.stats['streams_skipped'] += 1
+        else:
+            self.stats['streams_decoded'] += 1
+        return action
+
+    def _make_info_handler(self, key, name):
+        def handler(match):
+            text = match.group(0)
+            self._note_timezone(text)
+            if len(text) > len(name) + 3:
+                self.stats[key] = True
+            if text[len(name) + 1:len(name) + 2] == b'(':
+                return b'/' + name + b'()'
+            return b'/' + name + b'<>'
+        return handler
+
+    def _make_date_handler(self, name):
+        def handler(match):
+            text = match.group(0)
+            self._note_timezone(text)
+            if name == b'CreationDate' and len(text) > len(name) + 3:
+                self.stats['timestamps'] = True
+            return b'/' + name + EPOCH_DATE
+        return handler
+
+    def _make_xmp_handler(self, tag, replacement):
+        def handler(match):
+            self._note_timezone(match.group(0))
+            return b'<' + tag + b'>' + replacement + b'</' + tag + b'>'
+        return handler
+
+    def _handle_timezone(self, match):
+        self.stats['timezone'] = True
+        return match.group(0)[:16] + b'Z'
+
+    def _handle_doc_id(self, match):
+        self.stats['doc_id'] = True
+        if match.group('doc_id_full') is None:
+            return match.group(0)
+        if self.in_place:
+            return re.sub(rb'<[A-Fa-f0-9]*>', lambda m: b'<' + b'0' * (len(m.group(0)) - 2) + b'>',
+                          match.group(0))
+        return ZERO_ID
+
+
+# === OBJECT LAYER ===
+class PDFStructureError(Exception):
+    """The file's cross-reference structure cannot be used"""
+
+
+XREF_ENTRY = re.compile(rb'(\d{10})[ ](\d{5})[ ]([nf])')
+XREF_SUBSECTION = re.compile(rb'\s*(\d+)[ ]+(\d+)[ \t]*\r?\n')
+OBJ_HEADER = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj')
+EOL = re.compile(rb'[\r\n]')
+TRAILER = re.compile(rb'trailer\s*')
+# How sanitize_pdf writes its result (see sanitize_pdf)
+OUTPUT_MODES = ('rewrite', 'incremental', 'collapse')
+
+
+def _ref(dictionary, key):
+    """Object number of an indirect reference such as /Info 12 0 R, or None"""
+    match = re.search(rb'/' + key + rb'\s+(\d+)\s+\d+\s+R', dictionary)
+    return int(match.group(1)) if match else None
+
+
+def _int_value(dictionary, key):
+    match = re.search(rb'/' + key + rb'\s+(\d+)(?!\s+\d+\s+R)', dictionary)
+    return int(match.group(1)) if match else None
+
+
+def _string_end(data, pos):
+    """Index just past the literal string starting at data[pos] ('(')"""
+    depth = 0
+    while pos < len(data):
+        c = data[pos]
+        if c == 0x5C:           # backslash escape
+            pos += 2
+            continue
+        if c == 0x28:
+            depth += 1
+        elif c == 0x29:
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        pos += 1
+    raise PDFStructureError("Unterminated string")
+
+
+def _dict_end(data, pos):
+    """Index just past the dictionary starting at data[pos] ('<<')"""
+    depth = 0
+    while pos < len(data):
+        if data.startswith(b'<<', pos):
+            depth += 1
+            pos += 2
+        elif data.startswith(b'>>', pos):
+            depth -= 1
+            pos += 2
+            if depth == 0:
+                return pos
+        elif data[pos] == 0x28:
+            pos = _string_end(data, pos)
+        elif data[pos] == 0x3C:
+            pos = data.find(b'>', pos) + 1 or len(data)
+        elif data[pos] == 0x25:     # comment runs to end of line
+            eol = EOL.search(data, pos)
+            pos = eol.end() if eol else len(data)
+        else:
+            pos += 1
+    raise PDFStructureError("Unterminated dictionary")
+
+
+def _fit_in_place(old, new, anchor):
+    """Make new exactly len(old) bytes by padding or trimming whitespace
+    just before anchor, so no later byte offset moves. None if impossible."""
+    delta = len(old) - len(new)
+    if delta >= 0:
+        return new[:anchor] + b' ' * delta + new[anchor:]
+    head = new[:anchor]
+    spare = len(head) - len(head.rstrip(PDF_WHITESPACE)) - 1
+    if spare < -delta:
+        return None
+    return new[:anchor + delta] + new[anchor:]
+
+
+def _merge_patches(first, second):
+    """One sorted patch list from two; PDFStructureError if any overlap
+
+    A patch of second that lies wholly inside one of first is dropped: first
+    already rewrote that range.
+    """
+    spans = sorted((offset, offset + old_length) for offset, old_length, _ in first)
+    starts = [start for start, _ in spans]
+    kept = []
+    for patch in second:
+        i = bisect.bisect_right(starts, patch[0]) - 1
+        if i < 0 or patch[0] >= spans[i][1] or patch[0] + patch[1] > spans[i][1]:
+            kept.append(patch)
+    merged = sorted(first + kept)
+    for (offset, old_length, _), (following, _, _) in zip(merged, merged[1:]):
+        if offset + old_length > following:
+            raise PDFStructureError(f"Overlapping rewrites at offset {following}")
+    return merged
+
+
+STREAM_KEYWORD = re.compile(rb'\s*stream(?:\r\n|\n)')
+STREAM_AFTER_DICT = re.compile(rb'>>\s*stream(?:\r\n|\n)')
+LENGTH_ENTRY = re.compile(rb'/Length(?![A-Za-z0-9])\s*(\d+)(?:\s+(\d+)\s+R)?')
+
+
+def _stream_span(obj):
+    """(dict_start, dict_end, body_start, body_end) of a stream object, or None"""
+    header = OBJ_HEADER.match(obj)
+    if header is None:
+        return None
+    start = obj.find(b'<<', header.end())
+    if start == -1 or obj[header.end():start].strip():
+        return None
+    end = _dict_end(obj, start)
+    keyword = STREAM_KEYWORD.match(obj, end)
+    if keyword is None:
+        return None
+    body_end = obj.rfind(b'endstream')
+    if body_end < keyword.end():
+        raise PDFStructureError("Stream without endstream")
+    if obj.startswith(b'\r\n', body_end - 2):
+        body_end -= 2
+    elif obj[body_end - 1:body_end] in (b'\r', b'\n'):
+        body_end -= 1
+    return start, end, keyword.end(), max(body_end, keyword.end())
+
+
+def _with_length(old, new):
+    """new with its /Length set to the actual stream body, when rewriting
+    changed the body size. Returns (bytes, (num, length) or None), the
+    second item for a /Length held in a separate object."""
+    span = _stream_span(new)
+    if span is None:
+        return new, None
+    start, end, body_start, body_end = span
+    length = body_end - body_start
+    old_span = _stream_span(old)
+    if old_span is not None and old_span[3] - old_span[2] == length:
+        return new, None
+    entry = LENGTH_ENTRY.search(new, start, end)
+    if entry is None:
+        return new[:start + 2] + b'/Length %d' % length + new[start + 2:], None
+    if entry.group(2) is not None:
+        return new, (int(entry.group(1)), length)
+    return new[:entry.start(1)] + b'%d' % length + new[entry.end(1):], None
+
+
+REFERENCE = re.compile(rb'\d+\s+\d+\s+R')
+NAME_OR_NUMBER = re.compile(rb'/?[^\s/<>\[\]()]+')
+# Trailer entries carried into a new xref section
+TRAILER_KEYS = (b'Root', b'Info', b'ID', b'Encrypt')
+
+
+def _entry(dictionary, key):
+    """Raw value of /key in a dictionary: a reference, dictionary, array or
+    single token. None when absent."""
+    match = re.search(rb'/' + key + rb'(?![A-Za-z0-9])\s*', dictionary)
+    if match is None:
+        return None
+    pos = match.end()
+    reference = REFERENCE.match(dictionary, pos)
+    if reference:
+        return reference.group()
+    if dictionary.startswith(b'<<', pos):
+        return dictionary[pos:_dict_end(dictionary, pos)]
+    if dictionary.startswith(b'[', pos):
+        return dictionary[pos:dictionary.index(b']', pos) + 1]
+    token = NAME_OR_NUMBER.match(dictionary, pos)
+    return token.group() if token else None
+
+
+def _array_items(text, pos):
+    """(raw items, end) of the array starting at text[pos] ('['): references,
+    strings, dictionaries, arrays and single tokens"""
+    items = []
+    pos += 1
+    while pos < len(text):
+        c = text[pos]
+        if c in PDF_WHITESPACE:
+            pos += 1
+            continue
+        if c == 0x5D:           # ]
+            return items, pos + 1
+        if c == 0x28:
+            end = _string_end(text, pos)
+        elif text.startswith(b'<<', pos):
+            end = _dict_end(text, pos)
+        elif c == 0x3C:
+            end = text.find(b'>', pos) + 1 or len(text)
+        elif c == 0x5B:
+            end = _array_items(text, pos)[1]
+        else:
+            token = REFERENCE.match(text, pos) or NAME_OR_NUMBER.match(text, pos)
+            end = token.end() if token else pos + 1
+        items.append(text[pos:end])
+        pos = end
+    raise PDFStructureError("Unterminated array")
+
+
+STRING_ESCAPE = re.compile(rb'\\([0-7]{1,3}|\r\n|[\s\S])')
+STRING_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f', b'\r\n': b'', b'\n': b'',
+                  b'\r': b''}
+
+
+def _string_value(raw):
+    """Text of a literal or hex string token, for reports; None for
+    anything else"""
+    if raw is None:
+        return None
+    if raw.startswith(b'('):
+        data = STRING_ESCAPE.sub(
+            lambda m: (bytes([int(m.group(1), 8) & 0xFF]) if m.group(1)[:1].isdigit()
+                       else STRING_ESCAPES.get(m.group(1), m.group(1))), raw[1:-1])
+    elif raw.startswith(b'<') and not raw.startswith(b'<<'):
+        digits = re.sub(rb'[^0-9A-Fa-f]', b'', raw)
+        data = bytes.fromhex((digits + b'0' * (len(digits) % 2)).decode('ascii'))
+    else:
+        return None
+    if data.startswith(b'\xfe\xff'):
+        return data[2:].decode('utf-16-be', 'replace')
+    return data.decode('latin-1')
+
+
+def _string_entry(dictionary, key):
+    """Text of the string /key of a dictionary, or None"""
+    for match in re.finditer(rb'/' + key + rb'(?![A-Za-z0-9])\s*', dictionary):
+        pos = match.end()
+        if dictionary.startswith(b'(', pos):
+            return _string_value(dictionary[pos:_string_end(dictionary, pos)])
+        if dictionary.startswith(b'<', pos) and not dictionary.startswith(b'<<', pos):
+            return _string_value(dictionary[pos:dictionary.find(b'>', pos) + 1])
+    return None
+
+
+def _png_unpredict(data, columns):
+    """Undo PNG row predictors (DecodeParms /Predictor 10-15) for one byte
+    per pixel, as cross-reference streams use"""
+    rows = []
+    previous = bytearray(columns)
+    for start in range(0, len(data) - columns, columns + 1):
+        kind = data[start]
+        row = bytearray(data[start + 1:start + 1 + columns])
+        if kind == 1:
+            for i in range(1, columns):
+                row[i] = (row[i] + row[i - 1]) & 0xFF
+        elif kind == 2:
+            row = bytearray((a + b) & 0xFF for a, b in zip(row, previous))
+        elif kind == 3:
+            for i in range(columns):
+                row[i] = (row[i] + ((row[i - 1] if i else 0) + previous[i]) // 2) & 0xFF
+        elif kind == 4:
+            for i in range(columns):
+                a = row[i - 1] if i else 0
+                b = previous[i]
+                c = previous[i - 1] if i else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                row[i] = (row[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xFF
+        elif kind != 0:
+            raise PDFStructureError(f"Unknown PNG predictor {kind}")
+        rows.append(bytes(row))
+        previous = row
+    return b''.join(rows)
+
+
+def _decode_stream(obj, guard=None):
+    """(dictionary, decoded data) of a stream object that is unfiltered or
+    FlateDecode, with or without a PNG predictor
+
+    Inflation is charged to guard, a _JobGuard, when one is given; a stream
+    past one of its limits raises PDFStructureError. Without a guard it is
+    capped at DEFAULT_MAX_INFLATE.
+    """
+    span = _stream_span(obj)
+    if span is None:
+        raise PDFStructureError("Not a stream object")
+    start, end, body_start, body_end = span
+    dictionary = obj[start:end]
+    length = _entry(dictionary, b'Length')
+    if length is not None and length.isdigit() and body_start + int(length) <= len(obj):
+        body_end = body_start + int(length)
+    data = obj[body_start:body_end]
+    filters = _entry(dictionary, b'Filter')
+    if filters is not None:
+        if filters.strip(b'[] ') not in (b'/FlateDecode', b'/Fl'):
+            raise PDFStructureError(f"Unsupported filter {filters.decode('latin-1')}")
+        limit = guard.max_inflate if guard is not None else DEFAULT_MAX_INFLATE
+        try:
+            data = zlib.decompressobj().decompress(data, limit + 1)
+        except zlib.error as e:
+            raise PDFStructureError(f"Corrupt stream: {e}")
+        if guard is not None:
+            try:
+                guard.charge(len(data), len(data))
+            except _InflateLimit as e:
+                raise PDFStructureError(f"Stream inflates past the {e.guard} limit of {e.limit} bytes")
+        elif len(data) > limit:
+            raise PDFStructureError(f"Stream inflates past {limit} bytes")
+    params = _entry(dictionary, b'DecodeParms') or b''
+    predictor = _int_value(params, b'Predictor') or 1
+    if predictor >= 10:
+        data = _png_unpredict(data, _int_value(params, b'Columns') or 1)
+    elif predictor != 1:
+        raise PDFStructureError(f"Unsupported predictor {predictor}")
+    return dictionary, data
+
+
+class ObjectStream:
+    """The objects held in an /ObjStm, decoded once and re-encodable after
+    editing self.objects, a list of [num, text]"""
+
+    def __init__(self, obj, guard=None):
+        header = OBJ_HEADER.match(obj)
+        self.num, self.generation = int(header.group(1)), int(header.group(2))
+        self.dictionary, data = _decode_stream(obj, guard)
+        count = _int_value(self.dictionary, b'N')
+        first = _int_value(self.dictionary, b'First')
+        if count is None or first is None:
+            raise PDFStructureError(f"Object stream {self.num} has no /N or /First")
+        pairs = [int(value) for value in data[:first].split()[:2 * count]]
+        if len(pairs) != 2 * count:
+            raise PDFStructureError(f"Object stream {self.num} has a short header")
+        starts = [first + offset for offset in pairs[1::2]] + [len(data)]
+        self.objects = [[num, data[start:following].strip()]
+                        for num, start, following in zip(pairs[::2], starts, starts[1:])]
+
+    def text(self, num, index):
+        """Text of object num, found at index in the stream"""
+        if index >= len(self.objects) or self.objects[index][0] != num:
+            raise PDFStructureError(f"Object {num} is not at index {index} of object stream {self.num}")
+        return self.objects[index][1]
+
+    def encode(self, policy=DEFAULT_RECOMPRESS):
+        """Complete 'num gen obj ... endobj' bytes with the current objects"""
+        offsets = []
+        position = 0
+        for _, text in self.objects:
+            offsets.append(position)
+            position += len(text) + 1
+        header = b' '.join(b'%d %d' % (num, offset) for (num, _), offset in zip(self.objects, offsets)) + b'\n'
+        data = header + b''.join(text + b'\n' for _, text in self.objects)
+        packed = _deflate(data, policy, len(data))
+        extends = _entry(self.dictionary, b'Extends')
+        dictionary = (b'<</Type/ObjStm/N %d/First %d/Filter/FlateDecode/Length %d'
+                      % (len(self.objects), len(header), len(packed))
+                      + (b'/Extends ' + extends if extends else b'') + b'>>')
+        return (b'%d %d obj\n' % (self.num, self.generation) + dictionary
+                + b'\nstream\n' + packed + b'\nendstream\nendobj')
+
+
+def _next_trailer(trailer, size, prev=None):
+    """Trailer dictionary for a new xref section, based on an older one"""
+    return b'<<' + _trailer_entries(trailer, size, prev) + b'>>'
+
+
+def _trailer_entries(trailer, size, prev=None):
+    entries = [b'/Size %d' % size]
+    for key in TRAILER_KEYS:
+        value = _entry(trailer, key)
+        if value is not None:
+            entries.append(b'/' + key + b' ' + value)
+    if prev is not None:
+        entries.append(b'/Prev %d' % prev)
+    return b''.join(entries)
+
+
+def _runs(nums):
+    """Sorted nums split into runs of consecutive numbers"""
+    runs = []
+    for num in sorted(nums):
+        if runs and runs[-1][-1] == num - 1:
+            runs[-1].append(num)
+        else:
+            runs.append([num])
+    return runs
+
+
+def _xref_section(objects, size=None):
+    """Classic xref table for {num: (offset, generation)}
+
+    Without size, only the given objects are listed, in runs of consecutive
+    numbers (an update section). With size, every number below it is listed
+    and the missing ones are chained into the free list.
+    """
+    lines = [b'xref\n']
+    if size is None:
+        for run in _runs(objects):
+            lines.append(b'%d %d\n' % (run[0], len(run)))
+            lines.extend(b'%010d %05d n \n' % objects[num] for num in run)
+    else:
+        free = [num for num in range(1, size) if num not in objects]
+        following = dict(zip([0] + free, free + [0]))
+        lines.append(b'0 %d\n' % size)
+        for num in range(size):
+            if num in objects:
+                lines.append(b'%010d %05d n \n' % objects[num])
+            else:
+                lines.append(b'%010d %05d f \n' % (following[num], 65535 if num == 0 else 0))
+    return b''.join(lines)
+
+
+def _xref_stream(objects, num, position, trailer, size, prev=None):
+    """Cross-reference stream object num, to be written at position, for an
+    update section listing {num: (offset, generation)} and itself"""
+    objects = dict(objects)
+    objects[num] = (position, 0)
+    width = max((max(offset for offset, _ in objects.values()).bit_length() + 7) // 8, 1)
+    runs = _runs(objects)
+    rows = b''.join(b'\x01' + objects[n][0].to_bytes(width, 'big') + objects[n][1].to_bytes(2, 'big')
+                    for run in runs for n in run)
+    packed = zlib.compress(rows)
+    index = b' '.join(b'%d %d' % (run[0], len(run)) for run in runs)
+    dictionary = (b'<</Type/XRef/W[1 %d 2]/Index[%s]/Filter/FlateDecode/Length %d' % (width, index, len(packed))
+                  + _trailer_entries(trailer, size, prev) + b'>>')
+    return b'%d 0 obj\n' % num + dictionary + b'\nstream\n' + packed + b'\nendstream\nendobj\n'
+
+
+ENDSTREAM_AT = re.compile(rb'\s*endstream')
+EOL_ENDSTREAM = re.compile(rb'(?:\r\n|\r|\n)?endstream')
+FILE_ATTACHMENT = re.compile(rb'/Subtype\s*/FileAttachment(?![A-Za-z0-9])')
+OFFSET_ENTRY = re.compile(rb'(/(?:Prev|XRefStm)\s+)(\d+)')
+LENGTH_OBJECT = re.compile(rb'(obj\s*)(\d+)(\s*endobj)')
+STREAM_EOL = re.compile(rb'\r\n|\n')
+
+
+def _shifter(patches):
+    """Function mapping an input offset to the output offset once sorted
+    patches are applied"""
+    offsets = []
+    shifts = [0]
+    for offset, old_length, replacement in patches:
+        if len(replacement) != old_length:
+            offsets.append(offset)
+            shifts.append(shifts[-1] + len(replacement) - old_length)
+
+    def shift(offset):
+        return offset + shifts[bisect.bisect_left(offsets, offset)]
+    return shift
+
+
+def _stream_keyword(data, offset):
+    """Offset of the stream keyword whose body holds offset, or None when
+    offset is outside every stream body"""
+    end = offset
+    while True:
+        found = data.rfind(b'stream', 0, end)
+        if found < 3 or data[found - 3:found] == b'end':
+            return None
+        if STREAM_EOL.match(data, found + 6) and bytes(
+                data[max(found - 64, 0):found]).rstrip(PDF_WHITESPACE).endswith(b'>>'):
+            return found
+        end = found
+
+
+def _length_patches(data, patches, index=None):
+    """Patches that set /Length of every stream whose body the patches resize
+
+    A patch starting with the stream keyword replaces the whole body; any
+    other patch that changes size inside a body moves its end, and the
+    changes are added up per stream. A direct /Length is found in the
+    dictionary ahead of the stream; an indirect one needs index to find the
+    object holding it, and is left alone without one.
+    """
+    lengths = {}
+    deltas = {}
+    for offset, old_length, replacement in patches:
+        if len(replacement) == old_length:
+            continue
+        if replacement.startswith(b'stream'):
+            keyword = STREAM_KEYWORD.match(replacement)
+            body_end = replacement.rfind(b'endstream')
+            if replacement.startswith(b'\r\n', body_end - 2):
+                body_end -= 2
+            elif replacement[body_end - 1:body_end] in (b'\r', b'\n'):
+                body_end -= 1
+            lengths[offset] = body_end - keyword.end()
+            continue
+        keyword = _stream_keyword(data, offset)
+        if keyword is not None:
+            deltas[keyword] = deltas.get(keyword, 0) + len(replacement) - old_length
+
+    found = []
+    for offset in sorted(set(lengths) | {keyword for keyword, delta in deltas.items() if delta}):
+        start = max(offset - STREAM_DICT_LOOKBACK, 0)
+        header = bytes(data[start:offset]).rfind(b'obj')
+        if header == -1:
+            raise PDFStructureError(f"No dictionary for the stream at offset {offset}")
+        entry = LENGTH_ENTRY.search(data, start + header, offset)
+        if entry is None:
+            raise PDFStructureError(f"No /Length for the stream at offset {offset}")
+        if entry.group(2) is None:
+            length = lengths.get(offset, int(entry.group(1)) + deltas.get(offset, 0))
+            found.append((entry.start(1), len(entry.group(1)), b'%d' % length))
+            continue
+        if index is None:
+            # Without a usable xref table the object cannot be found
+            continue
+        num = int(entry.group(1))
+        for position in index.offsets(num):
+            value = LENGTH_OBJECT.search(index.read_object(num, position))
+            if value is None:
+                raise PDFStructureError(f"Length object {num} is not a number")
+            length = lengths.get(offset, int(value.group(2)) + deltas.get(offset, 0))
+            found.append((position + value.start(2), len(value.group(2)), b'%d' % length))
+    return sorted(found)
+
+
+def _relocated_table(text, shift):
+    """An xref table and its trailer with every offset moved by shift"""
+    split = text.rfind(b'trailer')
+
+    def entry(match):
+        if match.group(3) != b'n':
+            return match.group()
+        return b'%010d' % shift(int(match.group(1))) + match.group()[10:]
+    return (XREF_ENTRY.sub(entry, text[:split])
+            + OFFSET_ENTRY.sub(lambda m: m.group(1) + b'%d' % shift(int(m.group(2))), text[split:]))
+
+
+def _without(dictionary, keys):
+    """dictionary with the given entries taken out"""
+    for key in keys:
+        value = _entry(dictionary, key)
+        if value is not None:
+            match = re.search(rb'/' + key + rb'(?![A-Za-z0-9])\s*', dictionary)
+            dictionary = dictionary[:match.start()] + dictionary[match.end() + len(value):]
+    return dictionary
+
+
+def _relocated_xref_stream(obj, shift):
+    """An xref stream object with every offset moved by shift, encoded
+    again with field widths large enough for the new offsets"""
+    header = OBJ_HEADER.match(obj)
+    dictionary, rows = _decode_stream(obj)
+    widths = [int(width) for width in (_entry(dictionary, b'W') or b'').strip(b'[]').split()]
+    if len(widths) != 3:
+        raise PDFStructureError("Xref stream has no valid /W")
+    row_size = sum(widths)
+    entries = []
+    for start in range(0, len(rows) - row_size + 1, row_size):
+        fields = []
+        at = start
+        for width in widths:
+            fields.append(int.from_bytes(rows[at:at + width], 'big'))
+            at += width
+        kind = fields[0] if widths[0] else 1
+        entries.append((kind, shift(fields[1]) if kind == 1 else fields[1], fields[2]))
+    middle = max(widths[1], (max((entry[1] for entry in entries), default=0).bit_length() + 7) // 8)
+    packed = zlib.compress(b''.join(kind.to_bytes(1, 'big') + value.to_bytes(middle, 'big')
+                                    + extra.to_bytes(widths[2], 'big') for kind, value, extra in entries))
+    rest = _without(dictionary, (b'W', b'Length', b'Filter', b'DecodeParms'))[2:-2]
+    rest = OFFSET_ENTRY.sub(lambda m: m.group(1) + b'%d' % shift(int(m.group(2))), rest)
+    return (obj[:header.end()] + b'\n<</W[1 %d %d]/Filter/FlateDecode/Length %d' % (middle, widths[2], len(packed))
+            + rest + b'>>\nstream\n' + packed + b'\nendstream\nendobj')
+
+
+class XrefIndex:
+    """Cross-reference sections of a PDF, newest revision first
+
+    Classic tables, cross-reference streams (PDF 1.5+) and hybrid files are
+    read. Only the trailer tail, the xref sections and the objects asked for
+    are read, and an object stream is decoded only when one of its objects
+    is asked for, so the cost follows the amount of metadata, not the file
+    size.
+    """
+
+    def __init__(self, f, guard=None):
+        self.f = f
+        # _JobGuard charged for decoding xref and object streams
+        self.guard = guard
+        f.seek(0, os.SEEK_END)
+        self.size = f.tell()
+        # Each section: {'offset', 'kind': 'table' or 'stream',
+        #                'entries': {num: offset}, 'generations': {num: generation},
+        #                'free': {num}, 'compressed': {num: (stream num, index)},
+        #                'streams': {xref stream num: offset}, 'trailer': bytes,
+        #                'trailer_offset': int}
+        self.sections = []
+        self.bytes_read = 0
+        # Decoded object streams by offset
+        self.object_streams = {}
+        self._load()
+
+    def _read(self, offset, size):
+        self.f.seek(offset)
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def _load(self):
+        tail_start = max(self.size - 2048, 0)
+        tail = self._read(tail_start, self.size - tail_start)
+        keyword = tail.rfind(b'startxref')
+        match = re.search(rb'startxref\s+(\d+)\s*(?:%%EOF)?\s*$', tail[keyword:])
+        if match is None:
+            raise PDFStructureError("No startxref")
+        self.startxref = int(match.group(1))
+        # Where the number is, for rewriting it
+        self.startxref_at = (tail_start + keyword + match.start(1), len(match.group(1)))
+
+        offset = self.startxref
+        seen = set()
+        while offset is not None:
+            if offset in seen or offset >= self.size:
+                raise PDFStructureError(f"Bad xref offset {offset}")
+            seen.add(offset)
+            section = self._read_section(offset)
+            self.sections.append(section)
+            offset = _int_value(section['trailer'], b'Prev')
+
+    def _read_section(self, offset):
+        data = self._read(offset, 64 * 1024)
+        match = re.match(rb'\s*xref\s*?\r?\n', data)
+        if match is None:
+            return self._read_stream_section(offset)
+        pos = match.end()
+        entries = {}
+        generations = {}
+        free = set()
+        while True:
+            sub = XREF_SUBSECTION.match(data, pos)
+            if sub is None:
+                break
+            first, count = int(sub.group(1)), int(sub.group(2))
+            pos = sub.end()
+            needed = pos + count * 20 + 1024
+            if needed > len(data):
+                data += self._read(offset + len(data), needed - len(data))
+            for num in range(first, first + count):
+                entry = XREF_ENTRY.match(data, pos)
+                if entry is None:
+                    raise PDFStructureError(f"Bad xref entry for object {num}")
+                if entry.group(3) == b'n':
+                    entries[num] = int(entry.group(1))
+                    generations[num] = int(entry.group(2))
+                else:
+                    free.add(num)
+                pos = entry.end()
+                while pos < len(data) and data[pos] in PDF_WHITESPACE:
+                    pos += 1
+
+        match = TRAILER.match(data, pos)
+        if match is None:
+            raise PDFStructureError("No trailer after xref table")
+        end = _dict_end(data, match.end())
+        while end < len(data) and data[end] in PDF_WHITESPACE:
+            end += 1
+        section = {
+            'offset': offset,
+            'kind': 'table',
+            'entries': entries,
+            'generations': generations,
+            'free': free,
+            'compressed': {},
+            'streams': {},
+            'trailer': data[match.end():end],
+            'trailer_offset': offset + match.end(),
+        }
+
+        # A hybrid file lists its compressed objects in a stream that
+        # readers without stream support never see; the table wins
+        hidden = _int_value(section['trailer'], b'XRefStm')
+        if hidden is not None:
+            stream = self._read_stream_section(hidden)
+            for num, location in stream['compressed'].items():
+                if num not in entries:
+                    section['compressed'][num] = location
+                    free.discard(num)
+            for num, position in stream['entries'].items():
+                if num not in entries:
+                    entries[num] = position
+                    generations[num] = stream['generations'][num]
+                    free.discard(num)
+            section['streams'] = stream['streams']
+        return section
+
+    def _read_stream_section(self, offset):
+        header = OBJ_HEADER.match(self._read(offset, 64))
+        if header is None:
+            raise PDFStructureError(f"No xref table or stream at offset {offset}")
+        stream_num = int(header.group(1))
+        obj = self.read_object(stream_num, offset, limit=self.size)
+        dictionary, rows = _decode_stream(obj, self.guard)
+        if not re.search(rb'/Type\s*/XRef', dictionary):
+            raise PDFStructureError(f"Object {stream_num} at offset {offset} is not an xref stream")
+        widths = [int(width) for width in (_entry(dictionary, b'W') or b'').strip(b'[]').split()]
+        size = _int_value(dictionary, b'Size')
+        if len(widths) != 3 or size is None:
+            raise PDFStructureError(f"Xref stream {stream_num} has no valid /W or /Size")
+        ranges = [int(value) for value in (_entry(dictionary, b'Index') or b'[0 %d]' % size).strip(b'[]').split()]
+
+        entries = {}
+        generations = {}
+        free = set()
+        compressed = {}
+        row_size = sum(widths)
+        pos = 0
+        for first, count in zip(ranges[::2], ranges[1::2]):
+            for num in range(first, first + count):
+                row = rows[pos:pos + row_size]
+                if len(row) < row_size:
+                    raise PDFStructureError(f"Xref stream {stream_num} is truncated")
+                pos += row_size
+                fields = []
+                at = 0
+                for width in widths:
+                    fields.append(int.from_bytes(row[at:at + width], 'big'))
+                    at += width
+                kind = fields[0] if widths[0] else 1
+                if kind == 1:
+                    entries[num] = fields[1]
+                    generations[num] = fields[2]
+                elif kind == 2:
+                    compressed[num] = (fields[1], fields[2])
+                elif kind == 0:
+                    free.add(num)
+        return {
+            'offset': offset,
+            'kind': 'stream',
+            'entries': entries,
+            'generations': generations,
+            'free': free,
+            'compressed': compressed,
+            'streams': {stream_num: offset},
+            'trailer': dictionary,
+            'trailer_offset': offset + obj.find(b'<<'),
+        }
+
+    def offsets(self, num):
+        """Offsets of every revision of object num stored outside an object
+        stream, newest first"""
+        found = []
+        for section in self.sections:
+            offset = section['entries'].get(num)
+            if offset is not None and offset not in found:
+                found.append(offset)
+        return found
+
+    def locations(self, num):
+        """Every revision of object num, newest first: ('plain', offset) or
+        ('compressed', object stream num, object stream offset, index)"""
+        found = []
+        for i, section in enumerate(self.sections):
+            if num in section['entries']:
+                location = ('plain', section['entries'][num])
+            elif num in section['compressed']:
+                stream_num, index = section['compressed'][num]
+                # The object stream as of that revision; the live object is
+                # read from the newest one, which an update may have
+                # rewritten without listing the objects it holds again
+                view = self.sections[i if found else 0:]
+                stream_offset = next((older['entries'][stream_num] for older in view
+                                      if stream_num in older['entries']), None)
+                if stream_offset is None:
+                    raise PDFStructureError(f"Object stream {stream_num} is not in the xref table")
+                location = ('compressed', stream_num, stream_offset, index)
+            else:
+                continue
+            if location not in found:
+                found.append(location)
+        return found
+
+    def object_stream(self, num, offset):
+        """Decoded ObjectStream num at offset, shared between callers"""
+        stream = self.object_streams.get(offset)
+        if stream is None:
+            stream = ObjectStream(self.read_object(num, offset, limit=self.size), self.guard)
+            self.object_streams[offset] = stream
+        return stream
+
+    def read_text(self, num, location):
+        """Object num at a location from locations(): the whole 'num G obj
+        ... endobj' when plain, the bare object when compressed"""
+        if location[0] == 'plain':
+            return self.read_object(num, location[1])
+        _, stream_num, stream_offset, index = location
+        return self.object_stream(stream_num, stream_offset).text(num, index)
+
+    def _live(self):
+        plain = {}
+        compressed = {}
+        settled = set()
+        for section in self.sections:
+            for num, offset in section['entries'].items():
+                if num not in settled:
+                    plain[num] = (offset, section['generations'][num])
+            for num, location in section['compressed'].items():
+                if num not in settled:
+                    compressed[num] = location
+            settled.update(section['entries'])
+            settled.update(section['compressed'])
+            settled.update(section['free'])
+        return plain, compressed
+
+    def live(self):
+        """{num: (offset, generation)} of the objects the newest revision
+        uses, outside object streams"""
+        return self._live()[0]
+
+    def live_compressed(self):
+        """{num: (object stream num, index)} of the objects the newest
+        revision uses inside object streams"""
+        return self._live()[1]
+
+    def containers(self):
+        """Numbers of the object streams and xref streams, which only hold
+        other objects"""
+        found = set()
+        for section in self.sections:
+            found.update(stream_num for stream_num, _ in section['compressed'].values())
+            found.update(section['streams'])
+        return found
+
+    def boundaries(self):
+        """Sorted offsets of every object and xref section, plus the file size"""
+        found = {self.size}
+        for section in self.sections:
+            found.add(section['offset'])
+            found.update(section['entries'].values())
+            found.update(section['streams'].values())
+        return sorted(found)
+
+    def object_end(self, num, offset, boundary):
+        """End of object num at offset, given that it stops before boundary
+
+        Only its first and last few bytes are read, however large it is.
+        """
+        if boundary - offset <= 64 * 1024:
+            data = self._read(offset, boundary - offset)
+            head, tail, tail_start = data, data, offset
+        else:
+            head = self._read(offset, 64)
+            tail_start = boundary - 4096
+            tail = self._read(tail_start, 4096)
+        header = OBJ_HEADER.match(head)
+        if header is None or int(header.group(1)) != num:
+            raise PDFStructureError(f"Object {num} is not at offset {offset}")
+        end = tail.rfind(b'endobj')
+        if end == -1:
+            return offset + len(self.read_object(num, offset, limit=self.size))
+        return tail_start + end + len(b'endobj')
+
+    def relocate(self, data, patches):
+        """patches plus the edits that keep the file readable when they
+        resize anything: stream /Length entries, every xref section (tables
+        keep their size, xref streams are encoded again), /Prev and
+        /XRefStm, and startxref. data is the mapped input."""
+        if all(len(replacement) == old_length for _, old_length, replacement in patches):
+            return patches
+        patches = _merge_patches(patches, _length_patches(data, patches, self))
+
+        # Regions rebuilt from their current bytes, with the patches already
+        # made inside them applied first
+        regions = []
+        for section in self.sections:
+            if section['kind'] == 'table':
+                end = section['trailer_offset'] + len(section['trailer'])
+                regions.append((section['offset'], end, _relocated_table))
+            for num, offset in section['streams'].items():
+                end = offset + len(self.read_object(num, offset, limit=self.size))
+                regions.append((offset, end, _relocated_xref_stream))
+        startxref, digits = self.startxref_at
+        regions.append((startxref, startxref + digits, lambda text, shift: b'%d' % shift(self.startxref)))
+
+        current = {}
+        for start, end, _ in regions:
+            inside = [(offset - start, old_length, replacement) for offset, old_length, replacement in patches
+                      if start <= offset and offset + old_length <= end]
+            current[start] = _apply_patches(bytes(data[start:end]), inside)
+        patches = [patch for patch in patches
+                   if not any(start <= patch[0] and patch[0] + patch[1] <= end for start, end, _ in regions)]
+
+        # Rebuilt regions can change size themselves (an offset gaining a
+        # digit), which moves what follows: repeat until nothing moves
+        rebuilt = dict(current)
+        for _ in range(8):
+            merged = _merge_patches(patches, [(start, end - start, rebuilt[start]) for start, end, _ in regions])
+            shift = _shifter(merged)
+            following = {start: build(current[start], shift) for start, _, build in regions}
+            if all(len(following[start]) == len(rebuilt[start]) for start in rebuilt):
+                return _merge_patches(patches, [(start, end - start, following[start])
+                                                for start, end, _ in regions])
+            rebuilt = following
+        raise PDFStructureError("Offsets did not settle after rewriting")
+
+    def verify(self, resized=()):
+        """Check that every xref entry points at its object, and that each
+        stream object holding one of the resized offsets ends on endstream
+        where its /Length says; returns how many entries were checked"""
+        checked = set()
+        for section in self.sections:
+            for num, offset in section['entries'].items():
+                if (num, offset) in checked:
+                    continue
+                header = OBJ_HEADER.match(self._read(offset, 64))
+                if header is None or int(header.group(1)) != num:
+                    raise PDFStructureError(f"Xref entry for object {num} does not point at it")
+                checked.add((num, offset))
+
+        starts = sorted((offset, num) for num, offset in checked)
+        offsets = [offset for offset, _ in starts]
+        for offset, num in sorted({starts[i] for i in (bisect.bisect_right(offsets, position) - 1
+                                                       for position in resized) if i >= 0}):
+            self._verify_length(num, offset)
+        return len(checked)
+
+    def _verify_length(self, num, offset):
+        """Check that the /Length of stream object num at offset ends on
+        endstream; objects that are not streams pass"""
+        head = self._read(offset, 4096)
+        keyword = STREAM_AFTER_DICT.search(head)
+        if keyword is None or b'endobj' in head[:keyword.start()]:
+            return
+        length = _entry(head[:keyword.start() + 2], b'Length')
+        if length is not None and REFERENCE.fullmatch(length):
+            length = self._length_value(int(length.split()[0]))
+        if (length is None or not length.isdigit()
+                or not EOL_ENDSTREAM.match(self._read(offset + keyword.end() + int(length), 16))):
+            raise PDFStructureError(f"/Length of object {num} does not end on endstream")
+
+    def read_object(self, num, offset, limit=16 * 1024 * 1024):
+        """Bytes of 'num G obj ... endobj' at offset"""
+        data = self._read(offset, 4096)
+        header = OBJ_HEADER.match(data)
+        if header is None or int(header.group(1)) != num:
+            raise PDFStructureError(f"Object {num} is not at offset {offset}")
+        # Compressed data may hold the bytes 'endobj'; the /Length tells
+        # where the stream body ends
+        start = 0
+        indirect = False
+        keyword = STREAM_AFTER_DICT.search(data)
+        if keyword is not None and b'endobj' not in data[:keyword.start()]:
+            length = _entry(data[:keyword.start() + 2], b'Length')
+            if length is not None and REFERENCE.fullmatch(length):
+                length = self._length_value(int(length.split()[0]))
+                indirect = True
+            if length is not None and length.isdigit():
+                start = keyword.end() + int(length)
+        end = data.find(b'endobj', start)
+        while end == -1:
+            if len(data) >= limit:
+                raise PDFStructureError(f"Object {num} is too large")
+            chunk = self._read(offset + len(data), max(len(data), start + 64 - len(data)))
+            if not chunk:
+                raise PDFStructureError(f"Object {num} has no endobj")
+            data += chunk
+            end = data.find(b'endobj', max(len(data) - len(chunk) - 6, start))
+        if indirect and start and not ENDSTREAM_AT.match(data, start):
+            # The newest length is not this revision's: trust endobj
+            end = data.find(b'endobj', keyword.end())
+        return data[:end + len(b'endobj')]
+
+    def _length_value(self, num):
+        """Digits of the newest revision of the /Length object num, or None"""
+        try:
+            text = self.resolve(b'%d 0 R' % num)
+        except PDFStructureError:
+            return None
+        if text is None:
+            return None
+        value = LENGTH_OBJECT.search(text)
+        return value.group(2) if value else text.strip()
+
+    def resolve(self, value):
+        """A direct value as it is; for a reference the text of the newest
+        revision of the object it points at, None when that is missing"""
+        if value is None or not REFERENCE.fullmatch(value):
+            return value
+        num = int(value.split()[0])
+        locations = self.locations(num)
+        return self.read_text(num, locations[0]) if locations else None
+
+    def array(self, dictionary, key):
+        """Raw items of the array /key of a dictionary, following a
+        reference to it; [] when absent"""
+        value = self.resolve(_entry(dictionary, key))
+        start = value.find(b'[') if value is not None else -1
+        if start == -1:
+            return []
+        return _array_items(value, start)[0]
+
+    def embedded_files(self):
+        """{num: name} of the embedded file streams of the newest revision,
+        from the /EmbeddedFiles name tree and file attachment annotations
+
+        name is the file specification's /UF or /F, or None.
+        """
+        root = self.resolve(_entry(self.sections[0]['trailer'], b'Root'))
+        if root is None:
+            return {}
+        found = {}
+        seen = set()
+
+        def unseen(value):
+            reference = REFERENCE.fullmatch(value)
+            if reference is None:
+                return True
+            num = int(value.split()[0])
+            if num in seen:
+                return False
+            seen.add(num)
+            return True
+
+        def add(filespec, name=None):
+            spec = self.resolve(filespec)
+            if spec is None:
+                return
+            name = _string_entry(spec, b'UF') or _string_entry(spec, b'F') or name
+            streams = self.resolve(_entry(spec, b'EF'))
+            for reference in REFERENCE.findall(streams or b''):
+                found.setdefault(int(reference.split()[0]), name)
+
+        names = self.resolve(_entry(root, b'Names'))
+        nodes = [_entry(names, b'EmbeddedFiles')] if names is not None else []
+        while nodes:
+            value = nodes.pop()
+            if value is None or not unseen(value):
+                continue
+            node = self.resolve(value)
+            if node is None:
+                continue
+            nodes.extend(self.array(node, b'Kids'))
+            items = self.array(node, b'Names')
+            for key, filespec in zip(items[::2], items[1::2]):
+                add(filespec, _string_value(key))
+
+        pages = [_entry(root, b'Pages')]
+        while pages:
+            value = pages.pop()
+            if value is None or not unseen(value):
+                continue
+            node = self.resolve(value)
+            if node is None:
+                continue
+            kids = self.array(node, b'Kids')
+            if kids:
+                pages.extend(kids)
+                continue
+            for annotation in self.array(node, b'Annots'):
+                annotation = self.resolve(annotation)
+                if annotation is not None and FILE_ATTACHMENT.search(annotation):
+                    add(_entry(annotation, b'FS'))
+        return found
+
+
+# === EMBEDDED FILES ===
+# Levels of attached PDFs sanitized in turn: 1 sanitizes the attachments of
+# the file itself, 2 their attachments too, and so on; 0 leaves them alone
+DEFAULT_EMBEDDED_DEPTH = 3
+# How far into an attachment its %PDF- header may start
+PDF_HEADER_WINDOW = 1024
+EMBEDDED_FILE = re.compile(rb'/Type\s*/EmbeddedFile(?![A-Za-z0-9])')
+OBJ_HEADERS = re.compile(rb'(\d+)\s+\d+\s+obj(?![A-Za-z0-9])')
+PARAMS_ENTRY = re.compile(rb'/Params(?![A-Za-z0-9])\s*')
+SIZE_ENTRY = re.compile(rb'/Size\s+(\d+)')
+CHECKSUM_ENTRY = re.compile(rb'/CheckSum\s*')
+
+
+def _scanned_embedded_files(data):
+    """(num, name, offset, object bytes) of the embedded file streams found
+    by scanning data, for files whose xref table cannot be used
+
+    An indirect /Length is looked up by scanning too. Matches inside a
+    stream already found belong to an attachment of that attachment.
+    """
+    found = []
+    covered = 0
+    for match in EMBEDDED_FILE.finditer(data):
+        before = max(match.start() - STREAM_DICT_LOOKBACK, covered)
+        headers = list(OBJ_HEADERS.finditer(data, before, match.start()))
+        if not headers:
+            continue
+        offset = headers[-1].start()
+        window = bytes(data[offset:match.end() + STREAM_DICT_LOOKBACK])
+        start = window.find(b'<<')
+        try:
+            end = _dict_end(window, start) if start != -1 else -1
+        except PDFStructureError:
+            continue
+        keyword = STREAM_KEYWORD.match(window, end) if end > match.start() - offset else None
+        if keyword is None:
+            continue
+        body_start = offset + keyword.end()
+        length = _entry(window[start:end], b'Length')
+        if length is not None and REFERENCE.fullmatch(length):
+            num, generation = length.split()[:2]
+            values = re.findall(rb'(?<!\d)' + num + rb'\s+' + generation + rb'\s+obj\s*(\d+)\s*endobj', data)
+            length = values[-1] if values else None
+        if length is not None and length.isdigit() and ENDSTREAM_AT.match(data, body_start + int(length)):
+            stop = data.find(b'endobj', body_start + int(length))
+        else:
+            stop = data.find(b'endobj', data.find(b'endstream', body_start))
+        if stop != -1:
+            covered = stop + len(b'endobj')
+            found.append((int(headers[-1].group(1)), None, offset, bytes(data[offset:covered])))
+    return found
+
+
+def _params_patches(dictionary, at, data):
+    """Patches setting /Size and /CheckSum in the direct /Params of an
+    embedded file's dictionary, which starts at offset at, to match data"""
+    params = PARAMS_ENTRY.search(dictionary)
+    if params is None or not dictionary.startswith(b'<<', params.end()):
+        return []
+    params_end = _dict_end(dictionary, params.end())
+    patches = []
+    size = SIZE_ENTRY.search(dictionary, params.end(), params_end)
+    if size is not None:
+        patches.append((at + size.start(1), len(size.group(1)), b'%d' % len(data)))
+    checksum = CHECKSUM_ENTRY.search(dictionary, params.end(), params_end)
+    if checksum is not None:
+        pos = checksum.end()
+        if dictionary.startswith(b'(', pos):
+            end = _string_end(dictionary, pos)
+        else:
+            end = dictionary.find(b'>', pos) + 1 if dictionary.startswith(b'<', pos) else 0
+        if end:
+            patches.append((at + pos, end - pos, b'<%s>' % hashlib.md5(data).hexdigest().encode()))
+    return patches
+
+
+# === RESULT CACHE ===
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+HASH_CHUNK = 1024 * 1024
+
+
+class SanitizeCache:
+    """On-disk index of sanitized outputs keyed by input content and settings
+
+    Outputs are kept under directory/objects and handed out as hard links
+    (copies across filesystems). The least recently used entries are
+    evicted once their total size passes max_size; entries written by
+    another sanitizer version are dropped when the cache is opened.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.objects = os.path.join(directory, 'objects')
+        self.max_size = max_size
+        os.makedirs(self.objects, exist_ok=True)
+        import sqlite3
+        # Batch workers share the index, so wait on each other's writes
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), timeout=60)
+        with self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, stats TEXT, '
+                            'size INTEGER, mtime_ns INTEGER, used REAL)')
+            row = self.db.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+            if row is None or row[0] != __version__:
+                self._drop([key for key, in self.db.execute('SELECT key FROM entries')])
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (__version__,))
+
+    def close(self):
+        self.db.close()
+
+    def key(self, input_path, settings):
+        """Digest of the input bytes, the settings that shape the output and
+        the sanitizer version"""
+        digest = hashlib.sha256()
+        digest.update(json.dumps([__version__, settings], sort_keys=True).encode())
+        with open(input_path, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def fetch(self, key, output_path):
+        """Place the cached output at output_path and return its stats, or
+        None on a miss"""
+        row = self.db.execute('SELECT stats, size, mtime_ns FROM entries WHERE key = ?',
+                              (key,)).fetchone()
+        if row is None:
+            return None
+        stats, size, mtime_ns = row
+        stored = self._path(key)
+        try:
+            st = os.stat(stored)
+        except OSError:
+            st = None
+        if st is None or (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+            # Missing, or rewritten through a link handed out earlier
+            with self.db:
+                self._drop([key])
+            return None
+        self._place(stored, output_path)
+        with self.db:
+            self.db.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(stats)
+
+    def store(self, key, output_path, stats):
+        """Keep a copy of a fresh output, then evict down to max_size"""
+        stored = self._path(key)
+        partial = f"{stored}.{os.getpid()}.tmp"
+        self._place(output_path, partial)
+        os.replace(partial, stored)
+        st = os.stat(stored)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                            (key, json.dumps(stats), st.st_size, st.st_mtime_ns, time.time()))
+            total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total > self.max_size:
+                evicted = []
+                for old_key, size in self.db.execute('SELECT key, size FROM entries ORDER BY used'):
+                    if total <= self.max_size:
+                        break
+                    evicted.append(old_key)
+                    total -= size
+                self._drop(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.objects, key + '.pdf')
+
+    def _drop(self, keys):
+        for key in keys:
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _place(source, target):
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+
+# === INSTRUMENTATION ===
+PROFILERS = ('cprofile', 'tracemalloc')
+# Entries kept from a profile
+PROFILE_TOP = 25
+
+
+class SanitizeMetrics:
+    """Where one sanitize call spent its time
+
+    Each phase records wall time, bytes processed and, while tracemalloc is
+    tracing, bytes allocated at its peak. Rules fused into one scan cannot
+    be timed apart, so each reports its match count and bytes matched
+    instead. 'streams' is the part of 'rewrite' spent on stream bodies
+    (summed across worker threads when there are several).
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.rules = {}
+        self.profile = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a block; set the yielded record's 'bytes' inside it"""
+        record = self.phases.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'allocated': None})
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] += time.perf_counter() - started
+            if tracing:
+                allocated = max(tracemalloc.get_traced_memory()[1] - baseline, 0)
+                record['allocated'] = (record['allocated'] or 0) + allocated
+
+    def add_engine(self, engine):
+        """Fold in the rule matches and stream time of a RewriteEngine"""
+        for name, (count, size) in engine.matches.items():
+            if name.startswith('xmp'):
+                name = XMP_RULES[int(name[3:])][0].decode()
+            rule = self.rules.setdefault(name, {'matches': 0, 'bytes': 0})
+            rule['matches'] += count
+            rule['bytes'] += size
+        if 'stream' in engine.matches:
+            streams = self.phases.setdefault('streams', {'seconds': 0.0, 'bytes': 0, 'allocated': None})
+            streams['seconds'] += engine.stream_seconds
+            streams['bytes'] += engine.matches['stream'][1]
+
+    def as_dict(self):
+        phases = {name: dict(record, seconds=round(record['seconds'], 6))
+                  for name, record in self.phases.items()}
+        metrics = {'phases': phases, 'rules': dict(self.rules)}
+        if self.profile is not None:
+            metrics['profile'] = self.profile
+        return metrics
+
+
+def metrics_prometheus(metrics, labels=None):
+    """Prometheus text exposition of the 'metrics' entry of the stats"""
+    def series(name, extra, value):
+        pairs = dict(labels or {}, **extra)
+        text = ','.join('%s="%s"' % (key, str(val).replace('\\', '\\\\').replace('"', '\\"'))
+                        for key, val in pairs.items())
+        return f"{name}{{{text}}} {value}"
+
+    lines = []
+    for metric, field, kind, help_text in (
+            ('pdf_sanitizer_phase_seconds', 'seconds', 'phases', 'Wall time per phase'),
+            ('pdf_sanitizer_phase_bytes', 'bytes', 'phases', 'Bytes processed per phase'),
+            ('pdf_sanitizer_phase_allocated_bytes', 'allocated', 'phases', 'Peak bytes allocated per phase'),
+            ('pdf_sanitizer_rule_matches', 'matches', 'rules', 'Matches per rewrite rule'),
+            ('pdf_sanitizer_rule_bytes', 'bytes', 'rules', 'Bytes matched per rewrite rule')):
+        label = 'phase' if kind == 'phases' else 'rule'
+        values = [(name, record[field]) for name, record in metrics[kind].items()
+                  if record[field] is not None]
+        if not values:
+            continue
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        lines.extend(series(metric, {label: name}, value) for name, value in values)
+    return '\n'.join(lines) + '\n'
+
+
+class PDFSanitizer:
+    def __init__(self, use_xref=True, workers=1, recompress=DEFAULT_RECOMPRESS, cache=None,
+                 metrics_hook=None, profile=None, max_inflate=DEFAULT_MAX_INFLATE,
+                 max_document_inflate=DEFAULT_MAX_DOCUMENT_INFLATE, timeout=None, cpu_limit=None,
+                 embedded_depth=DEFAULT_EMBEDDED_DEPTH):
+        self.stats = {}
+        # Rewrite only the Info dictionary, catalog /Metadata and trailer /ID
+        # when the xref table can be parsed; otherwise scan the whole file
+        self.use_xref = use_xref
+        # Threads for inflating and recompressing Flate streams (zlib drops
+        # the GIL); None means one per CPU
+        self.workers = workers or os.cpu_count() or 1
+        # Compression for rewritten streams: a zlib level or one of
+        # RECOMPRESS_POLICIES; streams without a tag keep their bytes
+        self.recompress = _check_recompress(recompress)
+        # SanitizeCache, or a directory to open one in, to reuse the output
+        # of inputs already seen with the same settings
+        self.cache = SanitizeCache(cache) if isinstance(cache, str) else cache
+        # Called with stats['metrics'] after every sanitize call
+        self.metrics_hook = metrics_hook
+        # 'cprofile' or 'tracemalloc' to add a profile to the metrics
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError(f"Unknown profiler: {profile!r}")
+        self.profile = profile
+        self.metrics = SanitizeMetrics()
+        # Per job: inflated bytes allowed per stream and per document (a
+        # stream past either is left as it is and reported in
+        # stats['errors']), and wall and CPU seconds before SanitizeAborted
+        self.max_inflate = max_inflate
+        self.max_document_inflate = max_document_inflate
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        # Levels of attached PDFs sanitized with the same settings and
+        # limits (see DEFAULT_EMBEDDED_DEPTH)
+        self.embedded_depth = embedded_depth
+        self._cancelled = threading.Event()
+        # Guard of the document this one is attached to
+        self._parent_guard = None
+        self._executor = None
+        self.guard = self._new_guard()
+
+    def cancel(self):
+        """Stop the running job (or the next one, if none is running) with
+        SanitizeAborted at its next check; safe to call from any thread"""
+        self._cancelled.set()
+
+    def _new_guard(self):
+        return _JobGuard(self.max_inflate, self.max_document_inflate, self.timeout, self.cpu_limit,
+                         self._cancelled, self._parent_guard)
+
+    @contextlib.contextmanager
+    def _job(self):
+        """Limits for one public call; a cancelled sanitizer is usable again
+        once the call it stopped has ended"""
+        self.guard = self._new_guard()
+        try:
+            yield
+        except SanitizeAborted:
+            # Stop the rest of the job's work before clearing the flag it checks
+            self._close_pool()
+            self._cancelled.clear()
+            raise
+        finally:
+            self._close_pool()
+
+    def _pool(self):
+        """The job's worker threads, shared by the stream pass and embedded
+        files and started on first use; None with a single worker"""
+        if self.workers <= 1:
+            return None
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers)
+        return self._executor
+
+    def _close_pool(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def _patches(self, engine, data):
+        """Run engine over data, on the job's pool when more than one worker is set"""
+        return engine.patches(data, self.stats, self._pool())
+
+    def _child(self):
+        """Sanitizer for a PDF attached to the current job's: the same
+        settings one level down, under this job's limits. It runs on one
+        thread, as a task on this job's pool."""
+        child = PDFSanitizer(self.use_xref, 1, self.recompress, max_inflate=self.max_inflate,
+                             max_document_inflate=self.max_document_inflate,
+                             embedded_depth=self.embedded_depth - 1)
+        child._parent_guard = self.guard
+        return child
+
+    def _embedded_streams(self, index, live=None):
+        """(num, name, offset, object bytes) of every revision of the
+        embedded file streams the newest revision uses, or with live (from
+        index.live()) of the live revision only"""
+        if self.embedded_depth < 1:
+            return []
+        found = []
+        for num, name in sorted(index.embedded_files().items()):
+            offsets = index.offsets(num) if live is None else [live[num][0]] if num in live else []
+            found.extend((num, name, offset, index.read_object(num, offset, limit=index.size))
+                         for offset in offsets)
+        return found
+
+    def _sanitize_embedded(self, streams, options):
+        """Patches re-embedding sanitized copies of the PDFs among streams
+        (from _embedded_streams), which are sanitized side by side on the
+        job's pool; each stream gets an entry in stats['attachments']"""
+        if self.embedded_depth < 1 or not streams:
+            return []
+        pool = self._pool()
+        with self.metrics.phase('embedded') as record:
+            if pool is None:
+                results = [self._embedded_patches(*stream, options) for stream in streams]
+            else:
+                futures = [pool.submit(self._embedded_patches, *stream, options) for stream in streams]
+                results = [future.result() for future in futures]
+            record['bytes'] = sum(len(stream[3]) for stream in streams)
+        patches = []
+        for found, attachment in results:
+            patches.extend(found)
+            self.stats['attachments'].append(attachment)
+        return sorted(patches)
+
+    def _embedded_patches(self, num, name, offset, obj, options):
+        """(patches, stats entry) for the embedded file stream obj at offset
+
+        A PDF is sanitized by a child sanitizer and written back with the
+        stream's filter, /Params /Size and /CheckSum; /Length is fixed with
+        the other resized streams. Streams with a filter other than plain
+        FlateDecode are left as they are.
+        """
+        attachment = {'object': num, 'name': name, 'offset': offset, 'pdf': False}
+        try:
+            span = _stream_span(obj)
+            if span is None:
+                raise PDFStructureError("Not a stream object")
+            start, end, body_start, body_end = span
+            dictionary = obj[start:end]
+            length = _entry(dictionary, b'Length')
+            if length is not None and length.isdigit() and body_start + int(length) <= len(obj):
+                body_end = body_start + int(length)
+            filters = _entry(dictionary, b'Filter')
+            if filters is not None and (filters.strip(b'[] ') not in (b'/FlateDecode', b'/Fl')
+                                        or _entry(dictionary, b'DecodeParms') is not None):
+                attachment['skipped'] = f"Unsupported filter {filters.decode('latin-1')}"
+                return [], attachment
+            data = obj[body_start:body_end]
+            if filters is not None:
+                try:
+                    data = zlib.decompressobj().decompress(data, self.max_inflate + 1)
+                    self.guard.charge(len(data), len(data))
+                except zlib.error as e:
+                    attachment['skipped'] = f"Corrupt stream: {e}"
+                    return [], attachment
+                except _InflateLimit as e:
+                    self.guard.note(e, offset)
+                    attachment['skipped'] = e.guard
+                    return [], attachment
+            attachment['size'] = len(data)
+            if b'%PDF-' not in data[:PDF_HEADER_WINDOW]:
+                return [], attachment
+            attachment['pdf'] = True
+
+            try:
+                output, stats = self._child().sanitize_buffer(data, options=options)
+            except SanitizeAborted:
+                raise
+            except Exception as e:
+                attachment['error'] = f"{type(e).__name__}: {e}"
+                return [], attachment
+            stats.pop('metrics', None)
+            attachment['sanitized_size'] = len(output)
+            attachment['stats'] = stats
+            if stats['errors']:
+                # Keeps the cache from storing an output with streams left alone
+                with self.guard.lock:
+                    self.guard.errors.extend(dict(error, embedded=num) for error in stats['errors'])
+            if output == data:
+                return [], attachment
+
+            body = output if filters is None else _deflate(output, self.recompress, body_end - body_start)
+            keyword = obj.rindex(b'stream', end, body_start)
+            stop = obj.index(b'endstream', body_end) + len(b'endstream')
+            patches = [(offset + keyword, stop - keyword, b'stream\r\n' + body + b'\r\nendstream')]
+            patches += _params_patches(dictionary, offset + start, output)
+            return sorted(patches), attachment
+        except PDFStructureError as e:
+            attachment['error'] = str(e)
+            return [], attachment
+
+    def _reset_stats(self):
+        self.guard.reset()
+        self.stats = {
+            'author': False, 'creator': False, 'producer': False,
+            'title': False, 'subject': False, 'timestamps': False,
+            'timezone': False, 'lang_tags': 0, 'doc_id': False, 'xmp': False,
+            'streams_decoded': 0, 'streams_skipped': 0,
+            'recompress_bytes_in': 0, 'recompress_bytes_out': 0, 'recompress_seconds': 0.0,
+            # Limits that tripped, as {'guard', 'limit'[, 'offset'][, 'embedded']}
+            'errors': self.guard.errors,
+            # One entry per embedded file stream (see _embedded_patches)
+            'attachments': [],
+        }
+
+    def _finish_stats(self, options, size, elapsed):
+        self.stats['throughput_mb_s'] = round(size / (1024 * 1024) / elapsed, 2) if elapsed else 0.0
+        self.stats['recompress_seconds'] = round(self.stats['recompress_seconds'], 4)
+
+        # The XMP rules report on whether they ran, not on whether they matched
+        if options.get('remove_xmp'):
+            self.stats['xmp'] = True
+
+    def sanitize_pdf(self, input_path, output_path=None, options=None, progress_callback=None,
+                     memory_budget=None, output_mode='rewrite'):
+        """Sanitize PDF based on selected options
+
+        With memory_budget set (in bytes) the file is streamed through
+        sanitize_stream instead of being loaded whole. output_mode is one of
+        OUTPUT_MODES: 'rewrite' edits the file in place, 'incremental'
+        appends a sanitized revision (fast, but the old values stay in the
+        file), 'collapse' writes a single revision without the old ones.
+        """
+        if output_mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode: {output_mode!r}")
+        if memory_budget is not None and output_mode != 'rewrite':
+            raise ValueError(f"The {output_mode} output mode cannot be streamed")
+
+        if output_path is None:
+            base, ext = os.path.splitext(input_path)
+            output_path = f"{base}_sanitized{ext}"
+
+        if options is None:
+            options = dict(DEFAULT_OPTIONS)
+
+        self.metrics = SanitizeMetrics()
+        with self._job(), self._profiling():
+            if self.cache is None:
+                self._sanitize_file(input_path, output_path, options, progress_callback, memory_budget,
+                                    output_mode)
+            else:
+                self._sanitize_cached(input_path, output_path, options, progress_callback, memory_budget,
+                                      output_mode)
+        self._publish_metrics()
+        return output_path, self.stats
+
+    def _sanitize_cached(self, input_path, output_path, options, progress_callback, memory_budget,
+                         output_mode):
+        settings = {'options': options, 'recompress': self.recompress,
+                    'xref': self.use_xref and memory_budget is None, 'output_mode': output_mode,
+                    'embedded_depth': self.embedded_depth}
+        with self.metrics.phase('cache') as record:
+            key = self.cache.key(input_path, settings)
+            stats = self.cache.fetch(key, output_path)
+            record['bytes'] = os.path.getsize(input_path)
+        if stats is not None:
+            self.stats = dict(stats, cache='hit')
+            if progress_callback:
+                progress_callback(100, "Complete! (cached)")
+            return
+
+        # Never write through a link to a cached copy left by an earlier hit
+        if os.path.exists(output_path) and os.stat(output_path).st_nlink > 1:
+            os.remove(output_path)
+        self._sanitize_file(input_path, output_path, options, progress_callback, memory_budget,
+                            output_mode)
+        # An output with streams left alone by a limit is not reused
+        if not self.stats['errors']:
+            with self.metrics.phase('cache'):
+                self.cache.store(key, output_path, self.stats)
+        self.stats['cache'] = 'miss'
+
+    def sanitize_buffer(self, data, dst=None, options=None, progress_callback=None,
+                        output_mode='rewrite'):
+        """Sanitize a PDF held in memory, without touching the disk
+
+        data is bytes, a bytearray, a memoryview or a binary file object.
+        Returns (output, stats) like sanitize_pdf: output is the sanitized
+        PDF as bytes, or dst itself when a binary file object to write into
+        is given. bytes and files on disk are not copied (see _buffer_of).
+        The cache is not used.
+        """
+        if output_mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode: {output_mode!r}")
+
+        if options is None:
+            options = dict(DEFAULT_OPTIONS)
+
+        out = io.BytesIO() if dst is None else dst
+        self.metrics = SanitizeMetrics()
+        with self._job(), self._profiling(), _buffer_of(data) as source:
+            self._sanitize_target(_BufferTarget(source, out), options, progress_callback, output_mode)
+        self._publish_metrics()
+        return (out.getvalue() if dst is None else dst), self.stats
+
+    @contextlib.contextmanager
+    def _profiling(self):
+        """Run a block under the configured profiler, if any"""
+        if self.profile == 'cprofile':
+            import cProfile
+            import pstats
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP)
+                self.metrics.profile = report.getvalue()
+        elif self.profile == 'tracemalloc':
+            # Leave tracing running if someone else started it
+            owner = not tracemalloc.is_tracing()
+            if owner:
+                tracemalloc.start()
+            try:
+                yield
+            finally:
+                top = tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_TOP]
+                if owner:
+                    tracemalloc.stop()
+                self.metrics.profile = '\n'.join(str(stat) for stat in top)
+        else:
+            yield
+
+    def _publish_metrics(self):
+        self.stats['metrics'] = self.metrics.as_dict()
+        if self.metrics_hook:
+            self.metrics_hook(self.stats['metrics'])
+
+    def scan_pdf(self, input_path, options=None, first_only=False):
+        """Report the traces sanitize_pdf would remove, without writing anything
+
+        The file is memory-mapped rather than read. As in sanitize_pdf, the
+        metadata rules only look at the metadata objects when the xref
+        table can be used. Returns a dict with the findings per category as
+        lists of {'offset', 'text'}, whether the file is clean, the limits
+        that tripped (as stats['errors']) and timings.
+        """
+        if options is None:
+            options = dict(DEFAULT_OPTIONS)
+
+        started = time.perf_counter()
+        findings = {}
+
+        def merge(found, base=0):
+            for category, hits in found.items():
+                if first_only and category in findings:
+                    continue
+                findings.setdefault(category, []).extend((base + offset, text) for offset, text in hits)
+
+        with self._job(), open(input_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            regions = None
+            if self.use_xref:
+                try:
+                    regions = list(self._metadata_regions(XrefIndex(f, self.guard)))
+                except PDFStructureError:
+                    pass
+            if regions is None:
+                full_scan = RewriteEngine(options, guard=self.guard)
+            else:
+                engine = RewriteEngine(dict(options, remove_lang_tags=False))
+                for offset, old, _, container in regions:
+                    found = engine.scan(old, first_only)
+                    if container is not None:
+                        # Reported at the object stream holding the object
+                        found = {category: [(0, text) for _, text in hits] for category, hits in found.items()}
+                    merge(found, offset)
+                full_scan = RewriteEngine({'remove_lang_tags': options.get('remove_lang_tags')},
+                                          guard=self.guard)
+            if size and full_scan.pattern is not None:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    merge(full_scan.scan(data, first_only))
+        elapsed = time.perf_counter() - started
+
+        return {
+            'input': input_path,
+            # A stream skipped by a limit may hide a tag
+            'clean': not findings and not self.guard.errors,
+            'findings': {category: [{'offset': offset, 'text': text} for offset, text in found]
+                         for category, found in findings.items()},
+            'errors': self.guard.errors,
+            'size': size,
+            'seconds': round(elapsed, 4),
+            'throughput_mb_s': round(size / (1024 * 1024) / elapsed, 2) if elapsed else 0.0,
+        }
+
+    def _sanitize_file(self, input_path, output_path, options, progress_callback, memory_budget,
+                       output_mode='rewrite'):
+        """sanitize_pdf without the cache"""
+        if memory_budget is not None:
+            with open(input_path, 'rb') as src, _output_file(input_path, output_path, buffering=-1) as dst:
+                self._sanitize_stream(src, dst, options, progress_callback, memory_budget,
+                                      total_size=os.fstat(src.fileno()).st_size)
+            return
+
+        self._sanitize_target(_PathTarget(input_path, output_path), options, progress_callback,
+                              output_mode)
+
+    def _sanitize_target(self, target, options, progress_callback, output_mode):
+        """Sanitize target's input into its output, in memory or on disk"""
+        self._reset_stats()
+
+        if output_mode != 'rewrite':
+            self._sanitize_revision(target, options, progress_callback, output_mode)
+            return
+
+        if self.use_xref:
+            try:
+                self._sanitize_objects(target, options, progress_callback)
+                return
+            except PDFStructureError as e:
+                # Broken or unsupported structure: fall back to the flat scan
+                self._reset_stats()
+                self.stats['xref_fallback'] = str(e)
 
+        self.stats['mode'] = 'flat'
 
-class PDFSanitizer:
-    def __init__(self):
-        self.stats = {}
+        # === SINGLE-SCAN REWRITE ===
+        if progress_callback:
+            progress_callback(10, "Scanning document...")
 
-    def sanitize_pdf(self, input_path, output_path=None, options=None, progress_callback=None):
-        """Sanitize PDF based on selected options"""
+        # The input is mapped, not read: the scan pages it in and the
+        # unchanged ranges never have to be copied through Python
+        engine = RewriteEngine(options, recompress=self.recompress, guard=self.guard)
+        started = time.perf_counter()
+        with target.source() as f, target.mapped(f) as data:
+            size = len(data)
+            with self.metrics.phase('rewrite') as record:
+                patches = self._patches(engine, data)
+                streams = _scanned_embedded_files(data) if self.embedded_depth > 0 else []
+                record['bytes'] = size
+            if streams:
+                # Whatever the scan rewrote inside an attachment is superseded
+                patches = _merge_patches(self._sanitize_embedded(streams, options), patches)
+                del streams
+            with self.metrics.phase('relocate'):
+                relocated, indexed = self._relocate_flat(f, data, patches, self.guard)
+            self.metrics.add_engine(engine)
+            self._finish_stats(options, size, time.perf_counter() - started)
 
-        if output_path is None:
-            base, ext = os.path.splitext(input_path)
-            output_path = f"{base}_sanitized{ext}"
+            # === WRITE OUTPUT ===
+            if progress_callback:
+                progress_callback(90, f"Writing file... ({self.stats['throughput_mb_s']} MB/s scan)")
 
-        if options is None:
-            options = {
-                'remove_author': True, 'remove_creator': True, 'remove_producer': True,
-                'remove_title': True, 'remove_subject': True, 'remove_timestamps': True,
-                'remove_timezone': True, 'remove_lang_tags': True, 'remove_doc_id': True,
-                'remove_xmp': True
-            }
+            with self.metrics.phase('write') as record:
+                record['bytes'] = target.write_patched(f, relocated)
+        if indexed:
+            self._verify_output(target, relocated)
 
-        self.stats = {
-            'author': False, 'creator': False, 'producer': False,
-            'title': False, 'subject': False, 'timestamps': False,
-            'timezone': False, 'lang_tags': 0, 'doc_id': False, 'xmp': False
-        }
+        if progress_callback:
+            progress_callback(100, "Complete!")
 
-        with open(input_path, 'rb') as f:
-            data = f.read()
+    @staticmethod
+    def _relocate_flat(f, data, patches, guard=None):
+        """patches made by the flat scan, plus whatever keeps the output's
+        xref table valid when they resize anything, and whether that table
+        was rebuilt. A file whose table cannot be read (often why the flat
+        scan runs) only gets direct /Length values fixed."""
+        if all(len(replacement) == old_length for _, old_length, replacement in patches):
+            return patches, False
+        try:
+            return XrefIndex(f, guard).relocate(data, patches), True
+        except PDFStructureError:
+            return _merge_patches(patches, _length_patches(data, patches)), False
 
+    def _verify_output(self, target, patches):
+        """Check that the rewritten xref entries of target's output resolve
+        and that the streams the patches resized end where /Length says"""
+        shift = _shifter(patches)
+        resized = [shift(offset) for offset, old_length, replacement in patches
+                   if len(replacement) != old_length]
+        with self.metrics.phase('verify') as record, target.written(patches) as f:
+            index = XrefIndex(f)
+            self.stats['xref_verified'] = index.verify(resized)
+            record['bytes'] = index.bytes_read
+
+    def _sanitize_objects(self, target, options, progress_callback):
+        """Rewrite the metadata objects in place, located through the xref table
+
+        Every metadata replacement is padded or trimmed to the original
+        length. Recompressed streams usually change size, so their /Length
+        and every later xref offset are then rewritten and the output's
+        table is checked. Raises PDFStructureError when that is not
+        possible.
+        """
+        started = time.perf_counter()
         if progress_callback:
-            progress_callback(5, "Reading PDF...")
+            progress_callback(5, "Reading cross-reference table...")
+
+        with target.source() as f:
+            with self.metrics.phase('xref') as record:
+                index = XrefIndex(f, self.guard)
+                size = index.size
+                patches = self._metadata_patches(index, options)
+                streams = self._embedded_streams(index)
+                record['bytes'] = index.bytes_read
 
-        # === COMPRESSED STREAMS (Language Tags) ===
-        if options.get('remove_lang_tags'):
             if progress_callback:
-                progress_callback(10, "Processing compressed streams...")
+                progress_callback(30, "Rewriting metadata objects...")
 
-            def replace_in_stream(match):
-                stream_data = match.group(1)
-                try:
-                    decompressed = zlib.decompress(stream_data)
-                    if b'/Lang(he)' in decompressed:
-                        count = decompressed.count(b'/Lang(he)')
-                        self.stats['lang_tags'] += count
-                        decompressed = decompressed.replace(b'/Lang(he)', b'/Lang(en)')
-                        recompressed = zlib.compress(decompressed, 9)
-                        return b'stream\r\n' + recompressed + b'\r\nendstream'
-                except:
-                    pass
-                return match.group(0)
+            self.stats['mode'] = 'xref'
 
-            stream_pattern = rb'stream\r?\n(.+?)\r?\nendstream'
-            data = re.sub(stream_pattern, replace_in_stream, data, flags=re.DOTALL)
+            if streams:
+                if progress_callback:
+                    progress_callback(40, "Sanitizing attachments...")
+                patches = _merge_patches(patches, self._sanitize_embedded(streams, options))
+                del streams
+
+            with target.mapped(f) as data:
+                if options.get('remove_lang_tags'):
+                    # Language tags live in page content and structure streams, so
+                    # they still need a pass over the whole file
+                    if progress_callback:
+                        progress_callback(50, "Processing compressed streams...")
+                    engine = RewriteEngine({'remove_lang_tags': True}, recompress=self.recompress,
+                                           guard=self.guard)
+                    with self.metrics.phase('rewrite') as record:
+                        patches = _merge_patches(patches, self._patches(engine, data))
+                        record['bytes'] = size
+                    self.metrics.add_engine(engine)
+                # Recompressed streams and attachments change size: fix the
+                # offsets after them
+                with self.metrics.phase('relocate'):
+                    relocated = index.relocate(data, patches)
 
-        # === TIMEZONE ===
-        if options.get('remove_timezone'):
-            if progress_callback:
-                progress_callback(20, "Removing timezone info...")
-            date_pattern = rb"(D:\d{14})([+-]\d{2}'\d{2}')"
-            if re.search(date_pattern, data):
-                self.stats['timezone'] = True
-            data = re.sub(date_pattern, rb"\1Z", data)
-
-        # === AUTHOR ===
-        if options.get('remove_author'):
-            if progress_callback:
-                progress_callback(25, "Removing author...")
-            if re.search(rb'/Author\([^)]+\)', data) or re.search(rb'/Author<[^>]+>', data):
-                self.stats['author'] = True
-            data = re.sub(rb'/Author\([^)]*\)', b'/Author()', data)
-            data = re.sub(rb'/Author<[^>]*>', b'/Author<>', data)
-
-        # === CREATOR ===
-        if options.get('remove_creator'):
-            if progress_callback:
-                progress_callback(30, "Removing creator...")
-            if re.search(rb'/Creator\([^)]+\)', data) or re.search(rb'/Creator<[^>]+>', data):
-                self.stats['creator'] = True
-            data = re.sub(rb'/Creator\([^)]*\)', b'/Creator()', data)
-            data = re.sub(rb'/Creator<[^>]*>', b'/Creator<>', data)
-
-        # === PRODUCER ===
-        if options.get('remove_producer'):
-            if progress_callback:
-                progress_callback(35, "Removing producer...")
-            if re.search(rb'/Producer\([^)]+\)', data) or re.search(rb'/Producer<[^>]+>', data):
-                self.stats['producer'] = True
-            data = re.sub(rb'/Producer\([^)]*\)', b'/Producer()', data)
-            data = re.sub(rb'/Producer<[^>]*>', b'/Producer<>', data)
-
-        # === TITLE ===
-        if options.get('remove_title'):
-            if progress_callback:
-                progress_callback(40, "Removing title...")
-            if re.search(rb'/Title\([^)]+\)', data) or re.search(rb'/Title<[^>]+>', data):
-                self.stats['title'] = True
-            data = re.sub(rb'/Title\([^)]*\)', b'/Title()', data)
-            data = re.sub(rb'/Title<[^>]*>', b'/Title<>', data)
-
-        # === SUBJECT ===
-        if options.get('remove_subject'):
             if progress_callback:
-                progress_callback(45, "Removing subject...")
-            if re.search(rb'/Subject\([^)]+\)', data) or re.search(rb'/Subject<[^>]+>', data):
-                self.stats['subject'] = True
-            data = re.sub(rb'/Subject\([^)]*\)', b'/Subject()', data)
-            data = re.sub(rb'/Subject<[^>]*>', b'/Subject<>', data)
+                progress_callback(90, "Writing file...")
+            with self.metrics.phase('write') as record:
+                record['bytes'] = target.write_patched(f, relocated)
+        if relocated is not patches:
+            self._verify_output(target, relocated)
+
+        self._finish_stats(options, size, time.perf_counter() - started)
+        if progress_callback:
+            progress_callback(100, "Complete!")
 
-        # === LANGUAGE TAGS (uncompressed) ===
+    def _metadata_patches(self, index, options, fit=True):
+        """Same-length (offset, old_length, replacement) patches for every
+        revision of the Info dictionary, catalog /Metadata and trailer /ID
+
+        An Info dictionary kept in an object stream is edited in the decoded
+        stream, which is then encoded again as a single patch. With fit=False
+        the replacements keep their natural length.
+        """
+        engine = RewriteEngine(dict(options, remove_lang_tags=False), in_place=True)
+        patches = []
+        edited = {}
+
+        for offset, old, kind, container in self._metadata_regions(index):
+            new = engine.rewrite(old, self.stats)
+            if new == old:
+                continue
+            if container is not None:
+                stream, position = container
+                stream.objects[position][1] = new
+                edited[offset] = stream
+                continue
+            if not fit:
+                patches.append((offset, len(old), new))
+                continue
+            if kind == 'info':
+                anchor = new.rfind(b'endobj')
+            elif kind == 'xmp':
+                anchor = new.rfind(b'<?xpacket end')
+                # Without a packet trailer, pad ahead of the EOL before
+                # endstream so the padding stays inside the stream data
+                anchor = anchor if anchor != -1 else len(new.rstrip(b'\r\n'))
+            else:
+                anchor = len(new)
+            fitted = _fit_in_place(old, new, anchor)
+            if fitted is None:
+                raise PDFStructureError(f"Replacement at offset {offset} does not fit in place")
+            patches.append((offset, len(old), fitted))
+
+        for offset, stream in edited.items():
+            old = index.read_object(stream.num, offset, limit=index.size)
+            patches.append((offset, len(old), self._encode_object_stream(stream, old, options, fit)))
+
+        self.metrics.add_engine(engine)
+        patches.sort()
+        return patches
+
+    def _encode_object_stream(self, stream, old, options, fit):
+        """Bytes of an edited object stream; with fit, exactly len(old)"""
         if options.get('remove_lang_tags'):
-            if progress_callback:
-                progress_callback(50, "Removing language tags...")
-            data = re.sub(rb'/Lang\(he\)', b'/Lang(en)', data)
+            # The stream pass tags these too, but its patch falls inside this
+            # one and is dropped (see _merge_patches)
+            for item in stream.objects:
+                item[1] = item[1].replace(LANG_TAG, b'/Lang(en)')
+        for policy in (self.recompress, 'smallest'):
+            new = stream.encode(policy)
+            if not fit:
+                return new
+            fitted = _fit_in_place(old, new, new.rfind(b'endobj'))
+            if fitted is not None:
+                return fitted
+        raise PDFStructureError(f"Object stream {stream.num} does not fit in place")
 
-        # === DOCUMENT ID ===
-        if options.get('remove_doc_id'):
-            if progress_callback:
-                progress_callback(55, "Removing document ID...")
-            if re.search(rb'/ID\s*\[\s*<[A-Fa-f0-9]+>', data):
-                self.stats['doc_id'] = True
-            data = re.sub(
-                rb'/ID\s*\[\s*<[A-Fa-f0-9]+>\s*<[A-Fa-f0-9]+>\s*\]',
-                b'/ID[<00000000000000000000000000000000><00000000000000000000000000000000>]',
-                data
-            )
-
-        # === TIMESTAMPS ===
-        if options.get('remove_timestamps'):
-            if progress_callback:
-                progress_callback(60, "Removing timestamps...")
-            if re.search(rb'/CreationDate\([^)]+\)', data):
-                self.stats['timestamps'] = True
-            data = re.sub(rb'/CreationDate\([^)]*\)', b'/CreationDate(D:19700101000000Z)', data)
-            data = re.sub(rb'/ModDate\([^)]*\)', b'/ModDate(D:19700101000000Z)', data)
+    @staticmethod
+    def _metadata_regions(index):
+        """(offset, bytes, kind, container) for every revision of the Info
+        dictionary ('info'), uncompressed catalog /Metadata body ('xmp') and
+        trailer. container is None, or (ObjectStream, index) for an object
+        kept in the object stream at offset."""
+        info_nums = {_ref(section['trailer'], b'Info') for section in index.sections} - {None}
+        root_nums = {_ref(section['trailer'], b'Root') for section in index.sections} - {None}
+
+        for num in sorted(info_nums):
+            locations = index.locations(num)
+            if not locations:
+                raise PDFStructureError(f"Info object {num} is not in the xref table")
+            for location in locations:
+                if location[0] == 'plain':
+                    yield location[1], index.read_object(num, location[1]), 'info', None
+                else:
+                    _, stream_num, stream_offset, position = location
+                    stream = index.object_stream(stream_num, stream_offset)
+                    yield stream_offset, stream.text(num, position), 'info', (stream, position)
+
+        metadata_nums = set()
+        for num in root_nums:
+            for location in index.locations(num):
+                metadata_nums.add(_ref(index.read_text(num, location), b'Metadata'))
+        metadata_nums.discard(None)
+
+        for num in sorted(metadata_nums):
+            for offset in index.offsets(num):
+                obj = index.read_object(num, offset)
+                start = re.search(rb'stream\r?\n', obj)
+                # Compressed XMP is left alone, as in the flat scan
+                if start is None or b'/Filter' in obj[:start.start()]:
+                    continue
+                end = obj.rfind(b'endstream')
+                yield offset + start.end(), obj[start.end():end], 'xmp', None
+
+        for section in index.sections:
+            yield section['trailer_offset'], section['trailer'], 'trailer', None
+
+    def _sanitize_revision(self, target, options, progress_callback, output_mode):
+        """Write a sanitized revision, appended after the existing ones
+        ('incremental') or replacing all of them ('collapse')
+
+        Objects of the newest revision are rewritten whole at their natural
+        size, with stream /Length entries updated to match.
+        """
+        started = time.perf_counter()
+        if progress_callback:
+            progress_callback(5, "Reading cross-reference table...")
+
+        with target.source() as f:
+            with self.metrics.phase('xref') as record:
+                index = XrefIndex(f, self.guard)
+                live = index.live()
+                patches = self._metadata_patches(index, options, fit=False)
+                streams = self._embedded_streams(index, live)
+                record['bytes'] = index.bytes_read
+
+            if streams:
+                if progress_callback:
+                    progress_callback(20, "Sanitizing attachments...")
+                patches = _merge_patches(patches, self._sanitize_embedded(streams, options))
+                del streams
+
+            if options.get('remove_lang_tags'):
+                if progress_callback:
+                    progress_callback(30, "Processing compressed streams...")
+                engine = RewriteEngine({'remove_lang_tags': True}, recompress=self.recompress,
+                                       guard=self.guard)
+                with self.metrics.phase('rewrite') as record, target.mapped(f) as data:
+                    patches = _merge_patches(patches, self._patches(engine, data))
+                    record['bytes'] = index.size
+                self.metrics.add_engine(engine)
+
+            with self.metrics.phase('rewrite'):
+                objects, trailer = self._rewritten_objects(index, live, patches)
 
-        # === XMP METADATA ===
-        if options.get('remove_xmp'):
             if progress_callback:
-                progress_callback(70, "Removing XMP metadata...")
-            self.stats['xmp'] = True
+                progress_callback(80, "Writing file...")
+            with self.metrics.phase('write') as record:
+                if output_mode == 'incremental':
+                    record['bytes'] = self._append_revision(f, index, target, live, objects, trailer)
+                else:
+                    record['bytes'] = self._write_collapsed(f, index, target, live, objects, trailer)
+
+        self.stats['mode'] = output_mode
+        self.stats['revisions'] = len(index.sections)
+        self.stats['rewritten_objects'] = len(objects)
+        self._finish_stats(options, index.size, time.perf_counter() - started)
+        if progress_callback:
+            progress_callback(100, "Complete!")
+
+    @staticmethod
+    def _rewritten_objects(index, live, patches):
+        """({num: new object bytes}, newest trailer) with the patches that
+        fall inside live objects or that trailer applied; the rest belong to
+        superseded revisions and are dropped"""
+        newest = index.sections[0]
+        trailer_start = newest['trailer_offset']
+        trailer_patches = []
+        starts = sorted((offset, num) for num, (offset, _) in live.items())
+        offsets = [offset for offset, _ in starts]
+        touched = {}
+        for patch in patches:
+            if trailer_start <= patch[0] < trailer_start + len(newest['trailer']):
+                trailer_patches.append((patch[0] - trailer_start,) + patch[1:])
+                continue
+            i = bisect.bisect_right(offsets, patch[0]) - 1
+            if i >= 0:
+                touched.setdefault(starts[i][1], []).append(patch)
+
+        objects = {}
+        for num, found in touched.items():
+            offset = live[num][0]
+            old = index.read_object(num, offset, limit=index.size)
+            inside = [(at - offset, length, replacement) for at, length, replacement in found
+                      if at + length <= offset + len(old)]
+            if not inside:
+                continue
+            objects[num], length = _with_length(old, _apply_patches(old, inside))
+            if length is not None:
+                length_num, value = length
+                if length_num not in live:
+                    raise PDFStructureError(f"Length object {length_num} is not in the xref table")
+                objects[length_num] = b'%d %d obj\n%d\nendobj' % (length_num, live[length_num][1], value)
+        return objects, _apply_patches(newest['trailer'], trailer_patches)
+
+    @staticmethod
+    def _append_revision(f, index, target, live, objects, trailer):
+        """Copy the input and append objects as a new revision; an input
+        sanitized onto itself only has the revision appended. Returns the
+        output size."""
+        revision = bytearray()
+        if objects or trailer != index.sections[0]['trailer']:
+            f.seek(index.size - 1)
+            if f.read(1) not in (b'\r', b'\n'):
+                revision += b'\n'
+            entries = {}
+            for num in sorted(objects):
+                entries[num] = (index.size + len(revision), live[num][1])
+                revision += objects[num] + b'\n'
+            xref_offset = index.size + len(revision)
+            size = max(_int_value(trailer, b'Size') or 0, max(objects, default=0) + 1)
+            if index.sections[0]['kind'] == 'stream':
+                # Continue with an xref stream: readers of a file that has
+                # them may not expect a table after one
+                revision += _xref_stream(entries, size, xref_offset, trailer, size + 1, index.startxref)
+            else:
+                if entries:
+                    revision += _xref_section(entries)
+                else:
+                    # A section needs at least one entry; object 0 is always free
+                    revision += b'xref\n0 1\n0000000000 65535 f \n'
+                revision += b'trailer\n' + _next_trailer(trailer, size, index.startxref)
+            revision += b'\nstartxref\n%d\n%%%%EOF\n' % xref_offset
+
+        return target.append(f, index.size, bytes(revision))
+
+    @staticmethod
+    def _write_collapsed(f, index, target, live, objects, trailer):
+        """Write the live objects, rewritten where needed, under a single
+        xref table; superseded revisions are left out. Objects kept in object
+        streams are written out as plain objects. Returns the size."""
+        f.seek(0)
+        header = re.search(rb'%PDF-\d\.\d[^\r\n]*\r?\n(?:%[^\r\n]*\r?\n)?', f.read(1024))
+        if header is None:
+            raise PDFStructureError("No %PDF header")
+        boundaries = index.boundaries()
+        containers = index.containers()
+        streams = {}
+        unpacked = {}
+        for num, (stream_num, position) in sorted(index.live_compressed().items()):
+            if stream_num not in streams:
+                if stream_num in objects:
+                    streams[stream_num] = ObjectStream(objects[stream_num])
+                elif stream_num in live:
+                    streams[stream_num] = index.object_stream(stream_num, live[stream_num][0])
+                else:
+                    raise PDFStructureError(f"Object stream {stream_num} is not in the xref table")
+            unpacked[num] = (b'%d 0 obj\n' % num + streams[stream_num].text(num, position)
+                             + b'\nendobj\n')
+        entries = {}
+        with target.splice(f) as out:
+            out.write(header.group())
+            for offset, num in sorted((offset, num) for num, (offset, _) in live.items()
+                                      if num and num not in containers):
+                entries[num] = (out.position, live[num][1])
+                if num in objects:
+                    out.write(objects[num])
+                else:
+                    boundary = boundaries[bisect.bisect_right(boundaries, offset)]
+                    out.copy(offset, index.object_end(num, offset, boundary) - offset)
+                out.write(b'\n')
+            for num, text in unpacked.items():
+                entries[num] = (out.position, 0)
+                out.write(text)
+            xref_offset = out.position
+            size = max(entries, default=0) + 1
+            out.write(_xref_section(entries, size))
+            out.write(b'trailer\n' + _next_trailer(trailer, size)
+                      + b'\nstartxref\n%d\n%%%%EOF\n' % xref_offset)
+        return out.position
+
+    def sanitize_stream(self, src, dst, options=None, progress_callback=None,
+                        memory_budget=DEFAULT_MEMORY_BUDGET, total_size=None):
+        """Sanitize from one binary file object to another in bounded memory
+
+        Works with pipes such as stdin/stdout; total_size is only used to
+        report progress percentages.
+        """
+
+        if options is None:
+            options = dict(DEFAULT_OPTIONS)
+
+        self.metrics = SanitizeMetrics()
+        with self._job(), self._profiling():
+            self._sanitize_stream(src, dst, options, progress_callback, memory_budget, total_size)
+        self._publish_metrics()
+        return self.stats
+
+    def _sanitize_stream(self, src, dst, options, progress_callback, memory_budget, total_size):
+        self._reset_stats()
 
-            data = re.sub(rb'<xmp:CreatorTool>[^<]*</xmp:CreatorTool>',
-                          b'<xmp:CreatorTool></xmp:CreatorTool>', data)
-            data = re.sub(rb'<dc:creator>.*?</dc:creator>',
-                          b'<dc:creator><rdf:Seq><rdf:li></rdf:li></rdf:Seq></dc:creator>',
-                          data, flags=re.DOTALL)
-            data = re.sub(rb'<dc:title>.*?</dc:title>',
-                          b'<dc:title><rdf:Alt><rdf:li xml:lang="x-default"></rdf:li></rdf:Alt></dc:title>',
-                          data, flags=re.DOTALL)
-            data = re.sub(rb'<dc:description>.*?</dc:description>',
-                          b'<dc:description><rdf:Alt><rdf:li xml:lang="x-default"></rdf:li></rdf:Alt></dc:description>',
-                          data, flags=re.DOTALL)
-            data = re.sub(rb'<pdf:Producer>[^<]*</pdf:Producer>',
-                          b'<pdf:Producer></pdf:Producer>', data)
-            data = re.sub(rb'<xmpMM:DocumentID>[^<]*</xmpMM:DocumentID>',
-                          b'<xmpMM:DocumentID>uuid:00000000-0000-0000-0000-000000000000</xmpMM:DocumentID>', data)
-            data = re.sub(rb'<xmpMM:InstanceID>[^<]*</xmpMM:InstanceID>',
-                          b'<xmpMM:InstanceID>uuid:00000000-0000-0000-0000-000000000000</xmpMM:InstanceID>', data)
-            data = re.sub(rb'<xmp:CreateDate>[^<]*</xmp:CreateDate>',
-                          b'<xmp:CreateDate>1970-01-01T00:00:00Z</xmp:CreateDate>', data)
-            data = re.sub(rb'<xmp:ModifyDate>[^<]*</xmp:ModifyDate>',
-                          b'<xmp:ModifyDate>1970-01-01T00:00:00Z</xmp:ModifyDate>', data)
-
-        # === WRITE OUTPUT ===
         if progress_callback:
-            progress_callback(90, "Writing file...")
+            progress_callback(5, "Streaming PDF...")
+
+        def progress(consumed):
+            if progress_callback and total_size:
+                progress_callback(5 + 90 * consumed / total_size,
+                                  f"Streaming PDF... {consumed // (1024 * 1024)} MB")
 
-        with open(output_path, 'wb') as f:
-            f.write(data)
+        engine = RewriteEngine(options, recompress=self.recompress, guard=self.guard)
+        started = time.perf_counter()
+        with self.metrics.phase('rewrite') as record:
+            size = engine.rewrite_stream(src, dst, self.stats, memory_budget, progress)
+            dst.flush()
+            record['bytes'] = size
+        self.metrics.add_engine(engine)
+        self._finish_stats(options, size, time.perf_counter() - started)
 
         if progress_callback:
             progress_callback(100, "Complete!")
 
-        return output_path, self.stats
+
+# === SERVICE ===
+DEFAULT_SERVICE_PORT = 8765
+# Requests accepted (running plus waiting) before new ones get 503
+DEFAULT_QUEUE_DEPTH = 32
+DEFAULT_REQUEST_TIMEOUT = 60
+DEFAULT_MAX_REQUEST = 512 * 1024 * 1024
+MAX_HEADER_SIZE = 64 * 1024
+SERVICE_CHUNK = 256 * 1024
+# Request bodies up to this size are sanitized in memory; larger ones are
+# spooled through a temporary directory so that queued requests cannot
+# hold queue_depth * max_request bytes of RAM
+SERVICE_IN_MEMORY = 64 * 1024 * 1024
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                411: 'Length Required', 413: 'Payload Too Large', 500: 'Internal Server Error',
+                503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _serve_job(input_path, output_path, options, recompress, timeout):
+    """Sanitize one request body in a pool worker, which gives up by itself
+    after timeout seconds instead of staying busy after the 504"""
+    _, stats = PDFSanitizer(recompress=recompress, timeout=timeout).sanitize_pdf(
+        input_path, output_path, options)
+    return stats
+
+
+def _serve_buffer(body, options, recompress, timeout):
+    """_serve_job for a body held in memory; returns (output, stats)"""
+    return PDFSanitizer(recompress=recompress, timeout=timeout).sanitize_buffer(body, options=options)
+
+
+def _parse_options(query):
+    """Sanitization options and recompression policy from a query string"""
+    from urllib.parse import unquote_plus
+    options = dict(DEFAULT_OPTIONS)
+    recompress = DEFAULT_RECOMPRESS
+    for pair in filter(None, query.split('&')):
+        name, _, value = pair.partition('=')
+        name = unquote_plus(name)
+        value = unquote_plus(value)
+        if name == 'recompress':
+            try:
+                recompress = _check_recompress(int(value) if value.isdigit() else value)
+            except ValueError as e:
+                raise HTTPError(400, str(e))
+        elif name in options:
+            if value.lower() not in ('1', '0', 'true', 'false', 'yes', 'no', 'on', 'off'):
+                raise HTTPError(400, f"Option {name} must be true or false")
+            options[name] = value.lower() in ('1', 'true', 'yes', 'on')
+        else:
+            raise HTTPError(400, f"Unknown option: {name}")
+    return options, recompress
+
+
+class SanitizeServer:
+    """Local HTTP service in front of a pool of sanitizer processes
+
+    POST /sanitize?option=false&recompress=fast with the PDF as the body
+    answers with the sanitized PDF and its stats as JSON in the
+    X-Sanitize-Stats header. GET /health reports load; GET /metrics is in
+    Prometheus text format. At most queue_depth requests are admitted at
+    once (running or waiting for a worker); past that the answer is 503
+    with Retry-After, so callers back off instead of piling up.
+    """
+
+    def __init__(self, workers=None, queue_depth=DEFAULT_QUEUE_DEPTH, timeout=DEFAULT_REQUEST_TIMEOUT,
+                 max_request=DEFAULT_MAX_REQUEST):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_depth = max(queue_depth, 1)
+        self.timeout = timeout
+        self.max_request = max_request
+        self.pool = None
+        self.admitted = 0
+        self.running = 0
+        self.started = time.time()
+        self.responses = {}
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.totals = {'phases': {}, 'rules': {}}
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_SERVICE_PORT, unix_path=None, ready=None):
+        # asyncio alone would take most of the engine's import time budget,
+        # so the service imports it where it is used
+        import asyncio
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Spawned rather than forked: a forked worker would inherit, and keep
+        # open, whichever client connections exist at the time
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            # Start every worker up front so no request pays for it
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(self.pool, int) for _ in range(self.workers)))
+            if unix_path is not None:
+                server = await asyncio.start_unix_server(self._connection, path=unix_path,
+                                                         limit=MAX_HEADER_SIZE)
+            else:
+                server = await asyncio.start_server(self._connection, host, port, limit=MAX_HEADER_SIZE)
+            if ready:
+                ready(server)
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    # === CONNECTIONS ===
+    async def _connection(self, reader, writer):
+        import asyncio
+        try:
+            while True:
+                try:
+                    request = await self._read_head(reader)
+                except HTTPError as e:
+                    await self._respond(writer, e.status, str(e).encode() + b'\n', close=True)
+                    break
+                if request is None:
+                    break
+                keep_alive = await self._handle(reader, writer, *request)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_head(self, reader):
+        """(method, path, query, headers) of the next request, None at EOF"""
+        import asyncio
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise HTTPError(400, "Truncated request")
+            return None
+        except asyncio.LimitOverrunError:
+            raise HTTPError(400, "Request header too large")
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        path, _, query = target.partition('?')
+        return method, path, query, headers
+
+    async def _handle(self, reader, writer, method, path, query, headers):
+        """Answer one request; returns whether the connection stays open"""
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if path == '/health' and method == 'GET':
+            await self._respond(writer, 200, json.dumps(self.health()).encode(), 'application/json',
+                                close=not keep_alive)
+            return keep_alive
+        if path == '/metrics' and method == 'GET':
+            await self._respond(writer, 200, self.prometheus().encode(),
+                                'text/plain; version=0.0.4', close=not keep_alive)
+            return keep_alive
+        if path != '/sanitize':
+            await self._respond(writer, 404, b'Not found\n', close=True)
+            return False
+        if method != 'POST':
+            await self._respond(writer, 405, b'Use POST\n', close=True)
+            return False
+
+        started = time.perf_counter()
+        status = await self._sanitize(reader, writer, query, headers, keep_alive)
+        elapsed = time.perf_counter() - started
+        self.responses[status] = self.responses.get(status, 0) + 1
+        self.latency_sum += elapsed
+        self.latency[next((i for i, bound in enumerate(LATENCY_BUCKETS) if elapsed <= bound),
+                          len(LATENCY_BUCKETS))] += 1
+        return keep_alive and status == 200
+
+    async def _sanitize(self, reader, writer, query, headers, keep_alive):
+        import asyncio
+        try:
+            length = int(headers['content-length'])
+        except (KeyError, ValueError):
+            await self._respond(writer, 411, b'Content-Length required\n', close=True)
+            return 411
+        continuing = headers.get('expect', '').lower() == '100-continue'
+        try:
+            if length > self.max_request:
+                raise HTTPError(413, "Request too large")
+            options, recompress = _parse_options(query)
+            # Refused before the body is stored: the client learns at once to back off
+            if self.admitted >= self.queue_depth:
+                raise HTTPError(503, "Busy, retry later")
+        except HTTPError as e:
+            if not continuing and e.status != 413:
+                # Otherwise the client, still sending, sees a reset instead of the answer
+                await self._receive(reader, length, None)
+            await self._respond(writer, e.status, str(e).encode() + b'\n', close=True,
+                                extra={'Retry-After': '1'} if e.status == 503 else None)
+            return e.status
+
+        self.admitted += 1
+        workdir = None
+        try:
+            if continuing:
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            loop = asyncio.get_running_loop()
+            if length <= SERVICE_IN_MEMORY:
+                body = await reader.readexactly(length)
+                job = loop.run_in_executor(self.pool, _serve_buffer, body, options, recompress,
+                                           self.timeout)
+            else:
+                workdir = tempfile.mkdtemp(prefix='pdf_sanitizer_')
+                input_path = os.path.join(workdir, 'input.pdf')
+                output_path = os.path.join(workdir, 'output.pdf')
+                with open(input_path, 'wb') as f:
+                    await self._receive(reader, length, f)
+                job = loop.run_in_executor(self.pool, _serve_job, input_path, output_path, options,
+                                           recompress, self.timeout)
+            self.running += 1
+            try:
+                result = await asyncio.wait_for(job, self.timeout)
+            except (asyncio.TimeoutError, SanitizeAborted):
+                await self._respond(writer, 504, b'Timed out\n', close=True)
+                return 504
+            except Exception as e:
+                await self._respond(writer, 500, f"{type(e).__name__}: {e}\n".encode(), close=True)
+                return 500
+            finally:
+                self.running -= 1
+
+            output, stats = result if workdir is None else (None, result)
+            _add_metrics(self.totals, stats['metrics'])
+            stats.pop('metrics', None)
+            size = len(output) if workdir is None else os.path.getsize(output_path)
+            writer.write(self._head(200, size, 'application/pdf', not keep_alive,
+                                    {'X-Sanitize-Stats': json.dumps(stats)}))
+            if workdir is None:
+                writer.write(output)
+                await writer.drain()
+                return 200
+            with open(output_path, 'rb') as f:
+                while True:
+                    chunk = f.read(SERVICE_CHUNK)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    # Slow readers hold their own request back, not others
+                    await writer.drain()
+            return 200
+        finally:
+            self.admitted -= 1
+            if workdir is not None:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    @staticmethod
+    async def _receive(reader, length, f):
+        """Copy a request body of length bytes to f, or drop it if f is None"""
+        import asyncio
+        while length:
+            chunk = await reader.read(min(SERVICE_CHUNK, length))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', length)
+            if f is not None:
+                f.write(chunk)
+            length -= len(chunk)
+
+    @staticmethod
+    def _head(status, length, content_type, close, extra=None):
+        lines = [f"HTTP/1.1 {status} {HTTP_REASONS[status]}", f"Content-Type: {content_type}",
+                 f"Content-Length: {length}", f"Connection: {'close' if close else 'keep-alive'}"]
+        lines.extend(f"{name}: {value}" for name, value in (extra or {}).items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _respond(self, writer, status, body, content_type='text/plain', close=False, extra=None):
+        writer.write(self._head(status, len(body), content_type, close, extra) + body)
+        await writer.drain()
+
+    # === REPORTING ===
+    def health(self):
+        return {
+            'status': 'busy' if self.admitted >= self.queue_depth else 'ok',
+            'version': __version__,
+            'workers': self.workers,
+            'running': self.running,
+            'queued': self.admitted - self.running,
+            'queue_depth': self.queue_depth,
+            'uptime_s': round(time.time() - self.started, 1),
+        }
+
+    def prometheus(self):
+        lines = [
+            "# HELP pdf_sanitizer_requests_total Sanitize requests by HTTP status",
+            "# TYPE pdf_sanitizer_requests_total counter",
+        ]
+        lines.extend(f'pdf_sanitizer_requests_total{{status="{status}"}} {count}'
+                     for status, count in sorted(self.responses.items()))
+        lines += [
+            "# HELP pdf_sanitizer_requests_in_flight Admitted requests, running or queued",
+            "# TYPE pdf_sanitizer_requests_in_flight gauge",
+            f"pdf_sanitizer_requests_in_flight {self.admitted}",
+            "# HELP pdf_sanitizer_request_seconds Sanitize request latency",
+            "# TYPE pdf_sanitizer_request_seconds histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), self.latency):
+            cumulative += count
+            lines.append(f'pdf_sanitizer_request_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"pdf_sanitizer_request_seconds_sum {round(self.latency_sum, 6)}")
+        lines.append(f"pdf_sanitizer_request_seconds_count {cumulative}")
+        return '\n'.join(lines) + '\n' + metrics_prometheus(self.totals)
+
+
+# === WATCH FOLDER ===
+# Seconds a dropped file must stay unchanged after its writer closed it
+DEFAULT_SETTLE = 0.2
+# Seconds between scans of the inbox when inotify is not available
+DEFAULT_POLL_INTERVAL = 1.0
+# Kept in the inbox; names starting with a dot are never picked up
+WATCH_JOURNAL = '.pdf_sanitizer_journal.jsonl'
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_Q_OVERFLOW = 0x4000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class _Inotify:
+    """Modify, close-after-write and moved-in events of one directory
+
+    Uses Linux inotify through libc; raises OSError, AttributeError where
+    libc has no inotify, or TypeError where ctypes cannot load the process's
+    own symbols (Windows), so callers can fall back to polling.
+    """
+
+    def __init__(self, path):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"Cannot watch {path}")
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """(name, mask) of the events waiting; name is None on overflow"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            events.append((None if mask & IN_Q_OVERFLOW else os.fsdecode(name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WatchFolder:
+    """Sanitize PDFs dropped into inbox into outbox as they arrive
+
+    A file is picked up once its writer has closed it and it has stayed
+    unchanged for settle seconds (inotify), or for a poll interval when
+    polling. It is sanitized on a pool of jobs processes, published to
+    outbox with a rename, and the original is then moved to done (or
+    failed). Every finished file is recorded in a journal first, so a
+    restart moves files it already handled instead of sanitizing them
+    again. Only the top level of inbox is watched.
+    """
+
+    def __init__(self, inbox, outbox, done=None, failed=None, journal=None, jobs=None,
+                 settle=DEFAULT_SETTLE, poll=None, recompress=DEFAULT_RECOMPRESS, output_mode='rewrite',
+                 limits=None, results=None, metrics_path=None):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.done = done or os.path.join(inbox, 'processed')
+        self.failed = failed or os.path.join(inbox, 'failed')
+        self.journal_path = journal or os.path.join(inbox, WATCH_JOURNAL)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.settle = settle
+        # Seconds between scans; None uses inotify where available
+        self.poll = poll
+        self.recompress = recompress
+        self.output_mode = output_mode
+        self.limits = limits or {}
+        # File object for one JSON line per finished file
+        self.results = results
+        self.metrics_path = metrics_path
+        # name -> {'size', 'mtime_ns', 'changed', 'closed', 'seen'}
+        self.pending = {}
+        # name -> (pending entry, future)
+        self.running = {}
+        # (name, size, mtime_ns) -> journal entry
+        self.journal = {}
+        self.finished = queue.SimpleQueue()
+        self.stopping = False
+        self.counts = {'ok': 0, 'failed': 0, 'resumed': 0}
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.totals = {'phases': {}, 'rules': {}}
+        self._wake = None
+
+    def stop(self):
+        """Finish the files being sanitized and return from run(); safe to
+        call from a signal handler or another thread"""
+        self.stopping = True
+        self._notify()
+
+    def _notify(self, *_):
+        if self._wake is not None:
+            try:
+                self._wake[1].send(b'\0')
+            except OSError:
+                # Already full, or closed as run() returns
+                pass
+
+    # === MAIN LOOP ===
+    def run(self, once=False):
+        """Watch until stop(), or with once=True until the inbox is empty"""
+        import socket
+        from concurrent.futures import ProcessPoolExecutor
+        for folder in (self.outbox, self.done, self.failed):
+            os.makedirs(folder, exist_ok=True)
+        self._load_journal()
+        watcher = None
+        if self.poll is None:
+            try:
+                watcher = _Inotify(self.inbox)
+            except (OSError, AttributeError, TypeError):
+                self.poll = DEFAULT_POLL_INTERVAL
+        # Polling can only tell a file is complete by seeing it unchanged
+        settle = self.settle if watcher is not None else max(self.settle, self.poll)
+        # A socket pair rather than a pipe: select() only takes sockets on Windows
+        self._wake = socket.socketpair()
+        for end in self._wake:
+            end.setblocking(False)
+        # Workers leave Ctrl-C to this process, which lets them finish
+        pool = ProcessPoolExecutor(self.jobs, initializer=signal.signal,
+                                   initargs=(signal.SIGINT, signal.SIG_IGN))
+        try:
+            self._scan()
+            next_scan = time.monotonic() + (self.poll or 0)
+            while not self.stopping or self.running:
+                now = time.monotonic()
+                deadlines = [entry['changed'] + settle for entry in self.pending.values()
+                             if entry['closed']]
+                if watcher is None:
+                    deadlines.append(next_scan)
+                timeout = max(min(deadlines) - now, 0) if deadlines else None
+                waiting = [self._wake[0]] + ([watcher] if watcher is not None else [])
+                readable, _, _ = select.select(waiting, [], [], timeout)
+
+                if self._wake[0] in readable:
+                    try:
+                        self._wake[0].recv(4096)
+                    except BlockingIOError:
+                        pass
+                if watcher is not None and watcher in readable:
+                    for name, mask in watcher.read():
+                        if name is None:
+                            self._scan()
+                        else:
+                            self._touch(name, closed=bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)))
+                if watcher is None and time.monotonic() >= next_scan:
+                    self._scan()
+                    next_scan = time.monotonic() + self.poll
+
+                while True:
+                    try:
+                        name, result = self.finished.get_nowait()
+                    except queue.Empty:
+                        break
+                    self._complete(name, result)
+                if not self.stopping:
+                    self._dispatch(pool, settle)
+                if once and not self.pending and not self.running:
+                    break
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            if watcher is not None:
+                watcher.close()
+            wake, self._wake = self._wake, None
+            for end in wake:
+                end.close()
+            self._write_metrics()
+
+    def _scan(self):
+        with os.scandir(self.inbox) as entries:
+            for entry in entries:
+                self._touch(entry.name, closed=True)
+
+    def _touch(self, name, closed):
+        """Note activity on an inbox file, restarting its settle time if it
+        changed"""
+        if name.startswith('.') or not name.lower().endswith('.pdf') or name in self.running:
+            return
+        try:
+            info = os.stat(os.path.join(self.inbox, name))
+        except OSError:
+            self.pending.pop(name, None)
+            return
+        if not stat.S_ISREG(info.st_mode):
+            return
+        now = time.monotonic()
+        entry = self.pending.setdefault(name, {'size': None, 'mtime_ns': None, 'changed': now,
+                                               'closed': closed, 'seen': time.time()})
+        if (info.st_size, info.st_mtime_ns) != (entry['size'], entry['mtime_ns']):
+            entry.update(size=info.st_size, mtime_ns=info.st_mtime_ns, changed=now)
+        # A write after the last close means the writer is back
+        entry['closed'] = closed
+
+    def _dispatch(self, pool, settle):
+        now = time.monotonic()
+        ready = sorted((entry['seen'], name) for name, entry in self.pending.items()
+                       if entry['closed'] and now - entry['changed'] >= settle)
+        for _, name in ready:
+            if len(self.running) >= self.jobs:
+                return
+            entry = self.pending[name]
+            source = os.path.join(self.inbox, name)
+            try:
+                info = os.stat(source)
+            except OSError:
+                del self.pending[name]
+                continue
+            if (info.st_size, info.st_mtime_ns) != (entry['size'], entry['mtime_ns']):
+                # Changed without an event we saw, or since the last poll
+                entry.update(size=info.st_size, mtime_ns=info.st_mtime_ns, changed=now)
+                continue
+            del self.pending[name]
+
+            known = self.journal.get((name, entry['size'], entry['mtime_ns']))
+            if known is not None:
+                # Finished before a restart; only the move was left to do
+                self.counts['resumed'] += 1
+                self._report({'input': source, 'output': known['output'], 'ok': known['ok'],
+                              'error': known['error'], 'resumed': True,
+                              'original': self._file_away(name, known['ok'])})
+                continue
+
+            job = (source, os.path.join(self.outbox, f".{name}.partial"), self.recompress,
+                   self.output_mode, None, 0, self.limits)
+            future = pool.submit(_batch_job, job)
+            self.running[name] = (entry, future)
+            future.add_done_callback(functools.partial(self._finished, name))
+
+    def _finished(self, name, future):
+        # Runs on the pool's thread: hand the result to the loop and wake it
+        self.finished.put((name, future))
+        self._notify()
+
+    # === FINISHING ===
+    def _complete(self, name, future):
+        entry, _ = self.running.pop(name)
+        try:
+            result = future.result()
+        except Exception as e:
+            # The worker itself died
+            result = {'input': os.path.join(self.inbox, name), 'ok': False,
+                      'error': f"{type(e).__name__}: {e}"}
+        partial = os.path.join(self.outbox, f".{name}.partial")
+        source = os.path.join(self.inbox, name)
+        try:
+            info = os.stat(source)
+        except OSError:
+            info = None
+        if info is None or (info.st_size, info.st_mtime_ns) != (entry['size'], entry['mtime_ns']):
+            # Rewritten while it was being sanitized: start over with the new copy
+            with contextlib.suppress(OSError):
+                os.remove(partial)
+            self._touch(name, closed=True)
+            return
+
+        if result['ok']:
+            output = os.path.join(self.outbox, name)
+            with open(partial, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(partial, output)
+            result['output'] = output
+            self.counts['ok'] += 1
+            _add_metrics(self.totals, result['stats']['metrics'])
+        else:
+            with contextlib.suppress(OSError):
+                os.remove(partial)
+            result.pop('output', None)
+            self.counts['failed'] += 1
+        latency = time.time() - entry['seen']
+        result['latency_s'] = round(latency, 4)
+        self.latency_sum += latency
+        self.latency[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+        # Journal before moving: a crash in between then only repeats the move
+        record = {'name': name, 'size': entry['size'], 'mtime_ns': entry['mtime_ns'], 'ok': result['ok'],
+                  'output': result.get('output'), 'error': result.get('error')}
+        self.journal[(name, entry['size'], entry['mtime_ns'])] = record
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        result['original'] = self._file_away(name, result['ok'])
+        self._report(result)
+        self._write_metrics()
+
+    def _file_away(self, name, ok):
+        """Move an inbox file to done or failed; returns its new path"""
+        target = os.path.join(self.done if ok else self.failed, name)
+        source = os.path.join(self.inbox, name)
+        try:
+            os.replace(source, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Another filesystem: copy beside the target, then rename over it
+            partial = os.path.join(os.path.dirname(target), f".{name}.partial")
+            shutil.copy2(source, partial)
+            os.replace(partial, target)
+            os.remove(source)
+        return target
+
+    def _report(self, result):
+        name = os.path.basename(result['input'])
+        if result['ok']:
+            done = " (finished before a restart)" if result.get('resumed') else f" in {result['latency_s']}s"
+            print(f"[OK] {name}{done}", file=sys.stderr)
+        else:
+            print(f"[ERROR] {name}: {result['error']}", file=sys.stderr)
+        if self.results is not None:
+            self.results.write(json.dumps(result) + '\n')
+            self.results.flush()
+
+    # === STATE ===
+    def _load_journal(self):
+        """Read the journal, keeping only files still in the inbox; the
+        rest are finished for good and the journal is rewritten without them"""
+        try:
+            with open(self.journal_path, encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+                info = os.stat(os.path.join(self.inbox, record['name']))
+            except (ValueError, KeyError, OSError):
+                # A line cut short by a crash, or a file long gone
+                continue
+            key = (record['name'], record['size'], record['mtime_ns'])
+            if key == (record['name'], info.st_size, info.st_mtime_ns):
+                self.journal[key] = record
+        partial = self.journal_path + '.partial'
+        with open(partial, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(record) + '\n' for record in self.journal.values())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, self.journal_path)
+
+    def prometheus(self):
+        lines = [
+            "# HELP pdf_sanitizer_watch_files_total Files finished by outcome",
+            "# TYPE pdf_sanitizer_watch_files_total counter",
+        ]
+        lines.extend(f'pdf_sanitizer_watch_files_total{{status="{status}"}} {count}'
+                     for status, count in self.counts.items())
+        lines += [
+            "# HELP pdf_sanitizer_watch_pending Files waiting to settle or being sanitized",
+            "# TYPE pdf_sanitizer_watch_pending gauge",
+            f"pdf_sanitizer_watch_pending {len(self.pending) + len(self.running)}",
+            "# HELP pdf_sanitizer_watch_latency_seconds Time from a file being seen to its output",
+            "# TYPE pdf_sanitizer_watch_latency_seconds histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), self.latency):
+            cumulative += count
+            lines.append(f'pdf_sanitizer_watch_latency_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"pdf_sanitizer_watch_latency_seconds_sum {round(self.latency_sum, 6)}")
+        lines.append(f"pdf_sanitizer_watch_latency_seconds_count {cumulative}")
+        return '\n'.join(lines) + '\n' + metrics_prometheus(self.totals)
+
+    def _write_metrics(self):
+        # Replaced whole, so a collector never reads half a file
+        if self.metrics_path is None:
+            return
+        partial = self.metrics_path + '.partial'
+        with open(partial, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        os.replace(partial, self.metrics_path)
+
+
+# === GUI ===
+# How often the Tk loop drains worker events, and the least time between
+# two progress events of one file
+GUI_POLL_MS = 100
+GUI_PROGRESS_INTERVAL = 0.1
+# stats key -> line in the results summary
+CHANGE_LABELS = [
+    ('author', "Author removed"), ('creator', "Creator removed"), ('producer', "Producer removed"),
+    ('title', "Title removed"), ('subject', "Subject removed"), ('timestamps', "Timestamps reset"),
+    ('timezone', "Timezone removed"), ('doc_id', "Document ID zeroed"), ('xmp', "XMP metadata cleared"),
+]
+
+
+def _load_gui():
+    global tk, filedialog, messagebox, ttk
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
 
 
 class ModernGUI:
-    def __init__(self):
+    """Window over a list of jobs run on a background thread pool
+
+    Workers never touch Tk: they post events to self.events, which the Tk
+    loop drains every GUI_POLL_MS, drawing only the newest progress of each
+    file. Each job has its own PDFSanitizer so it can be cancelled alone.
+    """
+
+    def __init__(self, paths=()):
+        _load_gui()
         self.root = tk.Tk()
         self.root.title("PDF Forensic Sanitizer")
-        self.root.geometry("650x750")
-        self.root.minsize(600, 700)
+        self.root.geometry("700x850")
+        self.root.minsize(640, 780)
         self.root.resizable(True, True)
         self.root.configure(bg='#0d1117')
 
-        self.sanitizer = PDFSanitizer()
-        self.selected_file = None
+        self.workers = os.cpu_count() or 1
+        self.pool = None
+        # Treeview row id -> job dict
+        self.jobs = {}
+        # Rows started by the last press of SANITIZE, and when
+        self.batch = []
+        self.batch_started = None
+        self.events = queue.Queue()
         self.options_vars = {}
 
         self.setup_ui()
+        self.add_paths(paths)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.root.after(GUI_POLL_MS, self.drain_events)
 
     def setup_ui(self):
         # Colors
@@ -215,6 +4242,9 @@ class ModernGUI:
         self.text_secondary = '#8b949e'
         self.border = '#30363d'
 
+        style = ttk.Style()
+        style.theme_use('clam')
+
         # Main container with scrollable canvas
         main = tk.Frame(self.root, bg=self.bg_dark, padx=25, pady=15)
         main.pack(fill=tk.BOTH, expand=True)
@@ -238,34 +4268,67 @@ class ModernGUI:
                           bg=self.bg_dark, fg='#58a6ff')
         credits.pack(pady=(5, 0))
 
-        # === FILE SELECTION CARD ===
+        # === FILES CARD ===
         file_card = tk.Frame(main, bg=self.bg_card, padx=15, pady=12)
-        file_card.pack(fill=tk.X, pady=(0, 12))
+        file_card.pack(fill=tk.BOTH, expand=True, pady=(0, 12))
+
+        file_top = tk.Frame(file_card, bg=self.bg_card)
+        file_top.pack(fill=tk.X)
 
-        file_header = tk.Label(file_card, text="SELECT FILE",
+        file_header = tk.Label(file_top, text="SELECT FILES",
                               font=('Segoe UI', 10, 'bold'),
                               bg=self.bg_card, fg=self.accent)
-        file_header.pack(anchor='w')
+        file_header.pack(side=tk.LEFT)
 
-        file_row = tk.Frame(file_card, bg=self.bg_card)
-        file_row.pack(fill=tk.X, pady=(10, 0))
+        for text, command in [("Add Folder", self.browse_folder), ("Add Files", self.browse_file)]:
+            tk.Button(file_top, text=text,
+                      font=('Segoe UI', 10, 'bold'),
+                      bg=self.accent, fg='white',
+                      activebackground='#2ea043',
+                      relief='flat', padx=15, pady=5,
+                      cursor='hand2',
+                      command=command).pack(side=tk.RIGHT, padx=(10, 0))
 
-        self.file_entry = tk.Entry(file_row, font=('Segoe UI', 11),
-                                   bg=self.bg_input, fg=self.text_primary,
-                                   insertbackground=self.text_primary,
-                                   relief='flat', bd=0)
-        self.file_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, ipady=10, ipadx=10)
-        self.file_entry.insert(0, "No file selected...")
-        self.file_entry.config(state='readonly')
+        style.configure("Jobs.Treeview",
+                        background=self.bg_input, fieldbackground=self.bg_input,
+                        foreground=self.text_primary, borderwidth=0, rowheight=22,
+                        font=('Segoe UI', 9))
+        style.configure("Jobs.Treeview.Heading",
+                        background=self.border, foreground=self.text_primary,
+                        borderwidth=0, font=('Segoe UI', 9, 'bold'))
+        style.map("Jobs.Treeview", background=[('selected', '#1f6feb')])
 
-        browse_btn = tk.Button(file_row, text="Browse",
-                              font=('Segoe UI', 10, 'bold'),
-                              bg=self.accent, fg='white',
-                              activebackground='#2ea043',
-                              relief='flat', padx=20, pady=8,
-                              cursor='hand2',
-                              command=self.browse_file)
-        browse_btn.pack(side=tk.RIGHT, padx=(15, 0))
+        tree_row = tk.Frame(file_card, bg=self.bg_card)
+        tree_row.pack(fill=tk.BOTH, expand=True, pady=(10, 0))
+
+        self.job_list = ttk.Treeview(tree_row, columns=('file', 'size', 'progress', 'status'),
+                                     show='headings', height=8, style="Jobs.Treeview")
+        for column, heading, width, stretch in [('file', "File", 250, True), ('size', "Size", 70, False),
+                                                ('progress', "Progress", 70, False),
+                                                ('status', "Status", 180, True)]:
+            self.job_list.heading(column, text=heading, anchor='w')
+            self.job_list.column(column, width=width, stretch=stretch, anchor='w')
+        self.job_list.tag_configure('done', foreground='#3fb950')
+        self.job_list.tag_configure('failed', foreground='#f85149')
+        self.job_list.tag_configure('cancelled', foreground=self.text_secondary)
+        self.job_list.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        scrollbar = ttk.Scrollbar(tree_row, orient=tk.VERTICAL, command=self.job_list.yview)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.job_list.configure(yscrollcommand=scrollbar.set)
+
+        list_buttons = tk.Frame(file_card, bg=self.bg_card)
+        list_buttons.pack(fill=tk.X, pady=(10, 0))
+
+        for text, command in [("Cancel Selected", self.cancel_selected), ("Cancel All", self.cancel_all),
+                              ("Clear Finished", self.clear_finished)]:
+            tk.Button(list_buttons, text=text,
+                      font=('Segoe UI', 9),
+                      bg=self.bg_input, fg=self.text_primary,
+                      activebackground=self.border,
+                      relief='flat', padx=15, pady=5,
+                      cursor='hand2',
+                      command=command).pack(side=tk.LEFT, padx=(0, 10))
 
         # === OPTIONS CARD ===
         options_card = tk.Frame(main, bg=self.bg_card, padx=15, pady=12)
@@ -344,8 +4407,6 @@ class ModernGUI:
         self.progress_var = tk.DoubleVar()
 
         # Custom progress bar style
-        style = ttk.Style()
-        style.theme_use('clam')
         style.configure("Custom.Horizontal.TProgressbar",
                        background=self.accent,
                        troughcolor=self.bg_input,
@@ -366,7 +4427,7 @@ class ModernGUI:
         self.status_label.pack(pady=(8, 0))
 
         # === SANITIZE BUTTON ===
-        self.sanitize_btn = tk.Button(main, text="SANITIZE PDF",
+        self.sanitize_btn = tk.Button(main, text="SANITIZE PDFs",
                                      font=('Segoe UI', 12, 'bold'),
                                      bg=self.accent, fg='white',
                                      activebackground='#2ea043',
@@ -390,7 +4451,7 @@ class ModernGUI:
                                    relief='flat', padx=8, pady=8,
                                    insertbackground=self.text_primary)
         self.results_text.pack(fill=tk.X, pady=(8, 0))
-        self.results_text.insert('1.0', 'Select a PDF file and click SANITIZE PDF...')
+        self.results_text.insert('1.0', 'Add PDF files or a folder and click SANITIZE PDFs...')
         self.results_text.config(state=tk.DISABLED)
 
         # Select all by default
@@ -426,27 +4487,69 @@ class ModernGUI:
         for var in self.options_vars.values():
             var.set(False)
 
+    # === JOB LIST ===
     def browse_file(self):
-        file_path = filedialog.askopenfilename(
-            title="Select PDF to Sanitize",
+        file_paths = filedialog.askopenfilenames(
+            title="Select PDFs to Sanitize",
             filetypes=[("PDF files", "*.pdf"), ("All files", "*.*")]
         )
-        if file_path:
-            self.selected_file = file_path
-            self.file_entry.config(state='normal')
-            self.file_entry.delete(0, tk.END)
-            self.file_entry.insert(0, file_path)
-            self.file_entry.config(state='readonly')
-            self.status_label.config(text=f"File loaded: {os.path.basename(file_path)}", fg=self.text_secondary)
-
-    def update_progress(self, value, status):
-        self.progress_var.set(value)
-        self.status_label.config(text=status)
-        self.root.update_idletasks()
+        self.add_paths(file_paths)
+
+    def browse_folder(self):
+        folder = filedialog.askdirectory(title="Select a Folder of PDFs")
+        if folder:
+            self.add_paths([folder])
 
+    def add_paths(self, paths):
+        """Queue files, folders (searched recursively) and globs, skipping
+        files already listed"""
+        listed = {job['input'] for job in self.jobs.values()}
+        added = 0
+        for input_path, output_path in _batch_inputs(paths, None, None):
+            if input_path in listed or not os.path.isfile(input_path):
+                continue
+            size = os.path.getsize(input_path)
+            row = self.job_list.insert('', tk.END, values=(
+                os.path.basename(input_path), f"{size / (1024 * 1024):.1f} MB", "", "Pending"))
+            self.jobs[row] = {'input': input_path, 'output': output_path, 'size': size,
+                              'state': 'pending', 'progress': 0.0, 'future': None, 'sanitizer': None}
+            listed.add(input_path)
+            added += 1
+        if added:
+            pending = sum(job['state'] == 'pending' for job in self.jobs.values())
+            self.status_label.config(text=f"{pending} files waiting", fg=self.text_secondary)
+
+    def cancel_selected(self):
+        for row in self.job_list.selection():
+            self._cancel(row)
+
+    def cancel_all(self):
+        for row in list(self.jobs):
+            self._cancel(row)
+
+    def _cancel(self, row):
+        job = self.jobs[row]
+        if job['state'] == 'pending':
+            # Never started: just take it off the list
+            self.job_list.delete(row)
+            del self.jobs[row]
+        elif job['state'] == 'queued' and job['future'].cancel():
+            self._finish(row, 'cancelled', "Cancelled")
+        elif job['state'] in ('queued', 'running'):
+            job['sanitizer'].cancel()
+            self.job_list.set(row, 'status', "Cancelling...")
+
+    def clear_finished(self):
+        for row, job in list(self.jobs.items()):
+            if job['state'] in ('done', 'failed', 'cancelled'):
+                self.job_list.delete(row)
+                del self.jobs[row]
+
+    # === RUNNING ===
     def start_sanitization(self):
-        if not self.selected_file:
-            messagebox.showwarning("No File", "Please select a PDF file first.")
+        rows = [row for row, job in self.jobs.items() if job['state'] == 'pending']
+        if not rows:
+            messagebox.showwarning("No Files", "Please add PDF files first.")
             return
 
         options = {key: var.get() for key, var in self.options_vars.items()}
@@ -455,54 +4558,165 @@ class ModernGUI:
             messagebox.showwarning("No Options", "Please select at least one option.")
             return
 
-        def run():
-            try:
-                self.sanitize_btn.config(state=tk.DISABLED, bg='#30363d')
-                output_path, stats = self.sanitizer.sanitize_pdf(
-                    self.selected_file,
-                    options=options,
-                    progress_callback=self.update_progress
-                )
-
-                # Show results
-                self.results_text.config(state=tk.NORMAL)
-                self.results_text.delete('1.0', tk.END)
-
-                self.results_text.insert(tk.END, "SANITIZATION COMPLETE!\n")
-                self.results_text.insert(tk.END, "=" * 45 + "\n\n")
-                self.results_text.insert(tk.END, f"Output: {os.path.basename(output_path)}\n\n")
-
-                changes = []
-                if stats['author']: changes.append("Author removed")
-                if stats['creator']: changes.append("Creator removed")
-                if stats['producer']: changes.append("Producer removed")
-                if stats['title']: changes.append("Title removed")
-                if stats['subject']: changes.append("Subject removed")
-                if stats['timestamps']: changes.append("Timestamps reset")
-                if stats['timezone']: changes.append("Timezone removed")
-                if stats['lang_tags']: changes.append(f"Language tags: {stats['lang_tags']} fixed")
-                if stats['doc_id']: changes.append("Document ID zeroed")
-                if stats['xmp']: changes.append("XMP metadata cleared")
-
-                if changes:
-                    self.results_text.insert(tk.END, "Changes:\n")
-                    for c in changes:
-                        self.results_text.insert(tk.END, f"  [OK] {c}\n")
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers)
+        if not self._running():
+            self.batch = []
+            self.batch_started = time.perf_counter()
+        self.batch.extend(rows)
+        self.sanitize_btn.config(bg='#30363d')
+        for row in rows:
+            job = self.jobs[row]
+            job['state'] = 'queued'
+            # Files run side by side, so each one stays on a single thread
+            job['sanitizer'] = PDFSanitizer()
+            job['future'] = self.pool.submit(self._run_job, row, job['input'], job['output'],
+                                             job['sanitizer'], options)
+            self.job_list.set(row, 'status', "Queued")
+
+    def _run_job(self, row, input_path, output_path, sanitizer, options):
+        """Sanitize one file on a pool thread, reporting through self.events"""
+        last = 0.0
+
+        def progress(value, status):
+            nonlocal last
+            now = time.monotonic()
+            if value < 100 and now - last < GUI_PROGRESS_INTERVAL:
+                return
+            last = now
+            self.events.put(('progress', row, value, status))
+
+        self.events.put(('started', row))
+        try:
+            _, stats = sanitizer.sanitize_pdf(input_path, output_path, options, progress_callback=progress)
+        except SanitizeAborted as e:
+            self.events.put(('cancelled' if e.guard == 'cancelled' else 'failed', row, str(e)))
+        except Exception as e:
+            self.events.put(('failed', row, str(e)))
+        else:
+            self.events.put(('done', row, stats))
+
+    def drain_events(self):
+        """Apply the events posted by workers since the last call; runs on
+        the Tk loop every GUI_POLL_MS"""
+        # Scheduled first so a message box opened below does not stall the list
+        self.root.after(GUI_POLL_MS, self.drain_events)
+        progress = {}
+        try:
+            while True:
+                event = self.events.get_nowait()
+                if event[0] == 'progress':
+                    # Only the newest of a file is worth drawing
+                    progress[event[1]] = event
                 else:
-                    self.results_text.insert(tk.END, "No changes needed.\n")
+                    self._apply(event)
+        except queue.Empty:
+            pass
+        for event in progress.values():
+            self._apply(event)
+        if self.batch:
+            self._show_totals()
 
-                self.results_text.config(state=tk.DISABLED)
-                self.status_label.config(text="Complete!", fg='#3fb950')
+    def _apply(self, event):
+        kind, row = event[0], event[1]
+        job = self.jobs.get(row)
+        if job is None or job['state'] in ('done', 'failed', 'cancelled'):
+            return
+        if kind == 'started':
+            job['state'] = 'running'
+            self.job_list.set(row, 'status', "Running")
+        elif kind == 'progress':
+            _, _, value, status = event
+            job['progress'] = value
+            self.job_list.set(row, 'progress', f"{int(value)}%")
+            self.job_list.set(row, 'status', status)
+        elif kind == 'done':
+            job['stats'] = event[2]
+            changes = sum(bool(job['stats'][key]) for key, _ in CHANGE_LABELS) + bool(job['stats']['lang_tags'])
+            self._finish(row, 'done', f"Done, {changes} kinds of traces removed" if changes else "Done, already clean")
+        elif kind == 'failed':
+            job['error'] = event[2]
+            self._finish(row, 'failed', f"Error: {event[2]}")
+        else:
+            self._finish(row, 'cancelled', "Cancelled")
 
-                messagebox.showinfo("Success", f"Sanitized PDF saved to:\n{output_path}")
+    def _finish(self, row, state, status):
+        job = self.jobs[row]
+        job['state'] = state
+        if state == 'done':
+            job['progress'] = 100.0
+            self.job_list.set(row, 'progress', "100%")
+        self.job_list.set(row, 'status', status)
+        self.job_list.item(row, tags=(state,))
 
-            except Exception as e:
-                self.status_label.config(text="Error!", fg='#f85149')
-                messagebox.showerror("Error", str(e))
-            finally:
-                self.sanitize_btn.config(state=tk.NORMAL, bg='#238636')
+    def _running(self):
+        return any(self.jobs[row]['state'] in ('queued', 'running') for row in self.batch if row in self.jobs)
+
+    def _show_totals(self):
+        jobs = [self.jobs[row] for row in self.batch if row in self.jobs]
+        if not jobs:
+            return
+        states = [job['state'] for job in jobs]
+        done_bytes = sum(job['size'] for job in jobs if job['state'] == 'done')
+        elapsed = time.perf_counter() - self.batch_started
+        rate = done_bytes / (1024 * 1024) / elapsed if elapsed else 0.0
+        # Finished files count as complete whatever their outcome
+        self.progress_var.set(sum(job['progress'] if job['state'] in ('queued', 'running') else 100.0
+                                  for job in jobs) / len(jobs))
+        text = (f"{states.count('done')}/{len(jobs)} files, {states.count('running')} running - "
+                f"{done_bytes / (1024 * 1024):.1f} MB at {rate:.1f} MB/s")
+        if self._running():
+            self.status_label.config(text=text, fg=self.text_secondary)
+            return
 
-        threading.Thread(target=run, daemon=True).start()
+        self.status_label.config(text="Complete! " + text, fg='#3fb950')
+        self.sanitize_btn.config(bg='#238636')
+        self._show_results(jobs, done_bytes, rate)
+        self.batch = []
+        messagebox.showinfo("Success", f"{states.count('done')} of {len(jobs)} files sanitized")
+
+    def _show_results(self, jobs, done_bytes, rate):
+        done = [job for job in jobs if job['state'] == 'done']
+        failed = [job for job in jobs if job['state'] == 'failed']
+
+        self.results_text.config(state=tk.NORMAL)
+        self.results_text.delete('1.0', tk.END)
+
+        self.results_text.insert(tk.END, "SANITIZATION COMPLETE!\n")
+        self.results_text.insert(tk.END, "=" * 45 + "\n\n")
+        if len(jobs) == 1 and done:
+            self.results_text.insert(tk.END, f"Output: {os.path.basename(done[0]['output'])}\n\n")
+        self.results_text.insert(tk.END, f"Files: {len(done)} sanitized, {len(failed)} failed, "
+                                         f"{len(jobs) - len(done) - len(failed)} cancelled\n")
+        self.results_text.insert(tk.END, f"Data: {done_bytes / (1024 * 1024):.1f} MB at {rate:.1f} MB/s\n\n")
+
+        changes = []
+        for key, label in CHANGE_LABELS:
+            count = sum(bool(job['stats'][key]) for job in done)
+            if count:
+                changes.append(label if len(jobs) == 1 else f"{label} ({count} files)")
+        tags = sum(job['stats']['lang_tags'] for job in done)
+        if tags:
+            changes.append(f"Language tags: {tags} fixed")
+
+        if changes:
+            self.results_text.insert(tk.END, "Changes:\n")
+            for c in changes:
+                self.results_text.insert(tk.END, f"  [OK] {c}\n")
+        elif done:
+            self.results_text.insert(tk.END, "No changes needed.\n")
+        for job in failed:
+            self.results_text.insert(tk.END, f"  [ERROR] {os.path.basename(job['input'])}: {job['error']}\n")
+
+        self.results_text.config(state=tk.DISABLED)
+
+    def close(self):
+        for job in self.jobs.values():
+            if job['sanitizer'] is not None:
+                job['sanitizer'].cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
 
     def run(self):
         self.root.mainloop()
@@ -516,30 +4730,423 @@ def cli_mode(input_file):
     print("=" * 50)
     print(f"\nProcessing: {input_file}")
 
-    sanitizer = PDFSanitizer()
+    sanitizer = PDFSanitizer(workers=None)
 
     def progress(val, msg):
         print(f"  [{int(val):3d}%] {msg}")
 
+    status = 0
     try:
         output_path, stats = sanitizer.sanitize_pdf(input_file, progress_callback=progress)
         print(f"\n[OK] Success! Output: {output_path}")
+        print(f"     Scan throughput: {stats['throughput_mb_s']} MB/s")
     except Exception as e:
         print(f"\n[ERROR] {e}")
+        status = 1
+
+    # Keep the console open after a drag-and-drop, but never block a pipeline
+    if sys.stdin is not None and sys.stdin.isatty():
+        print("\nPress Enter to exit...")
+        input()
+    return status
+
+
+def _recompress_arg(value):
+    try:
+        return _check_recompress(int(value) if value.isdigit() else value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _batch_inputs(paths, file_list, output_dir):
+    """Expand directories, globs and list files into (input, output) pairs"""
+    found = []
+
+    def add(path, root=None):
+        if output_dir is None:
+            output = '%s_sanitized%s' % os.path.splitext(path)
+        else:
+            name = os.path.relpath(path, root) if root else os.path.basename(path)
+            output = os.path.join(output_dir, name)
+        found.append((path, output))
+
+    if file_list is not None:
+        with (sys.stdin if file_list == '-' else open(file_list, encoding='utf-8')) as f:
+            paths = list(paths) + [line.strip() for line in f if line.strip()]
+
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, names in os.walk(path):
+                for name in sorted(names):
+                    # Outputs written next to their inputs by an earlier run
+                    if name.lower().endswith('.pdf') and not name.lower().endswith('_sanitized.pdf'):
+                        add(os.path.join(folder, name), path)
+        elif glob.has_magic(path):
+            for match in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(match):
+                    add(match)
+        else:
+            add(path)
+    return found
+
+
+def _batch_job(job):
+    """Sanitize one file in a worker process and describe the outcome"""
+    input_path, output_path, recompress, output_mode, cache_dir, cache_size, limits = job
+    result = {'input': input_path, 'output': output_path, 'ok': False}
+    started = time.perf_counter()
+    cache = None
+    try:
+        parent = os.path.dirname(output_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        if cache_dir is not None:
+            cache = SanitizeCache(cache_dir, cache_size)
+        _, stats = PDFSanitizer(recompress=recompress, cache=cache, **limits).sanitize_pdf(
+            input_path, output_path, output_mode=output_mode)
+        result['ok'] = True
+        result['stats'] = stats
+    except SanitizeAborted as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        result['stats'] = {'errors': [e.error]}
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        if cache is not None:
+            cache.close()
+    result['seconds'] = round(time.perf_counter() - started, 4)
+    return result
+
+
+def _add_metrics(total, metrics):
+    """Sum one file's stats['metrics'] into total"""
+    for kind in ('phases', 'rules'):
+        for name, record in metrics[kind].items():
+            if name not in total[kind]:
+                total[kind][name] = dict(record)
+                continue
+            into = total[kind][name]
+            for field, value in record.items():
+                if value is not None:
+                    into[field] = (into[field] or 0) + value
+
+
+def batch_mode(argv):
+    """Headless command line mode for many files, one JSON line per file
+
+    Exit status is 0 when every file was sanitized, 1 when any failed and
+    2 when there was nothing to do.
+    """
+    parser = argparse.ArgumentParser(
+        prog='pdf_sanitizer_full.py --batch',
+        description="Sanitize directories, globs or lists of PDFs on a process pool.")
+    parser.add_argument('paths', nargs='*', help='PDF files, directories (searched recursively) or globs')
+    parser.add_argument('--file-list', metavar='PATH',
+                        help="file with one input path per line, or '-' for stdin")
+    parser.add_argument('--output-dir', metavar='DIR',
+                        help='write outputs here, keeping the layout of input directories '
+                             '(default: <input>_sanitized.pdf next to each input)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, metavar='N',
+                        help='worker processes (default: %(default)s)')
+    parser.add_argument('--results', metavar='PATH',
+                        help='write the JSON lines here instead of stdout')
+    parser.add_argument('--recompress', type=_recompress_arg, default=DEFAULT_RECOMPRESS,
+                        metavar='POLICY', help="zlib level 0-9, 'fast', 'match' or 'smallest' "
+                                               "(default: %(default)s)")
+    parser.add_argument('--output-mode', choices=OUTPUT_MODES, default='rewrite',
+                        help="'incremental' appends a sanitized revision and keeps the old one, "
+                             "'collapse' keeps only the sanitized revision (default: %(default)s)")
+    parser.add_argument('--cache', metavar='DIR',
+                        help='reuse outputs of inputs already sanitized with the same settings')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        metavar='MB', help='evict cached outputs past this size (default: %(default)s)')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='write per-phase totals for the run here in Prometheus text format')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='give up on a file after this long (default: no limit)')
+    parser.add_argument('--cpu-limit', type=float, metavar='SECONDS',
+                        help='give up on a file after this much CPU time (default: no limit)')
+    parser.add_argument('--max-inflate', type=int, default=DEFAULT_MAX_INFLATE // (1024 * 1024), metavar='MB',
+                        help='leave streams that inflate past this alone (default: %(default)s)')
+    parser.add_argument('--max-document-inflate', type=int,
+                        default=DEFAULT_MAX_DOCUMENT_INFLATE // (1024 * 1024), metavar='MB',
+                        help='stop inflating streams of a file past this in total (default: %(default)s)')
+    parser.add_argument('--embedded-depth', type=int, default=DEFAULT_EMBEDDED_DEPTH, metavar='N',
+                        help='levels of attached PDFs to sanitize too, 0 for none (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if args.cache is not None:
+        # Settle the index (and any version purge) before workers share it
+        SanitizeCache(args.cache).close()
+    cache_size = args.cache_size * 1024 * 1024
+    limits = {'timeout': args.timeout, 'cpu_limit': args.cpu_limit,
+              'max_inflate': args.max_inflate * 1024 * 1024,
+              'max_document_inflate': args.max_document_inflate * 1024 * 1024,
+              'embedded_depth': args.embedded_depth}
+    try:
+        jobs = [(src, dst, args.recompress, args.output_mode, args.cache, cache_size, limits)
+                for src, dst in _batch_inputs(args.paths, args.file_list, args.output_dir)]
+    except OSError as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return 2
+    if not jobs:
+        print("[ERROR] No input files", file=sys.stderr)
+        return 2
+
+    from concurrent.futures import ProcessPoolExecutor
+    out = sys.stdout if args.results is None else open(args.results, 'w', encoding='utf-8')
+    failed = 0
+    totals = {'phases': {}, 'rules': {}}
+    started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max(args.jobs, 1)) as executor:
+            # Small chunks keep workers busy without holding one slow file's
+            # neighbours back for long
+            for result in executor.map(_batch_job, jobs, chunksize=4):
+                failed += not result['ok']
+                if result['ok']:
+                    _add_metrics(totals, result['stats']['metrics'])
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if args.metrics:
+        with open(args.metrics, 'w', encoding='utf-8') as f:
+            f.write(metrics_prometheus(totals))
+
+    print(f"[OK] {len(jobs) - failed}/{len(jobs)} files sanitized in "
+          f"{time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return 1 if failed else 0
 
-    print("\nPress Enter to exit...")
-    input()
+
+def _scan_job(job):
+    """Scan one file in a worker process"""
+    input_path, first_only = job
+    try:
+        return PDFSanitizer().scan_pdf(input_path, first_only=first_only)
+    except Exception as e:
+        return {'input': input_path, 'error': f"{type(e).__name__}: {e}"}
+
+
+def scan_mode(argv):
+    """Audit command line mode: report traces without writing any output
+
+    Exit status is 0 when every file is clean, 1 when traces were found and
+    2 when a file could not be scanned or there was nothing to do.
+    """
+    parser = argparse.ArgumentParser(
+        prog='pdf_sanitizer_full.py --scan',
+        description="Report forensic traces in PDFs as JSON lines, without rewriting them.")
+    parser.add_argument('paths', nargs='*', help='PDF files, directories (searched recursively) or globs')
+    parser.add_argument('--file-list', metavar='PATH',
+                        help="file with one input path per line, or '-' for stdin")
+    parser.add_argument('--first-only', action='store_true',
+                        help='stop at the first finding of each kind')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, metavar='N',
+                        help='worker processes (default: %(default)s)')
+    parser.add_argument('--results', metavar='PATH',
+                        help='write the JSON lines here instead of stdout')
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = [(src, args.first_only) for src, _ in _batch_inputs(args.paths, args.file_list, None)]
+    except OSError as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return 2
+    if not jobs:
+        print("[ERROR] No input files", file=sys.stderr)
+        return 2
+
+    from concurrent.futures import ProcessPoolExecutor
+    out = sys.stdout if args.results is None else open(args.results, 'w', encoding='utf-8')
+    dirty = errors = 0
+    try:
+        with ProcessPoolExecutor(max(args.jobs, 1)) as executor:
+            for report in executor.map(_scan_job, jobs, chunksize=8):
+                if 'error' in report:
+                    errors += 1
+                elif not report['clean']:
+                    dirty += 1
+                out.write(json.dumps(report) + '\n')
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"[OK] {len(jobs)} files scanned: {dirty} with traces, {errors} failed", file=sys.stderr)
+    return 2 if errors else 1 if dirty else 0
+
+
+def stream_mode(argv):
+    """Streaming command line mode, usable in pipelines"""
+    parser = argparse.ArgumentParser(
+        prog='pdf_sanitizer_full.py --stream',
+        description="Sanitize a PDF in bounded memory. Use '-' for stdin/stdout.")
+    parser.add_argument('input', help="input PDF path, or '-' for stdin")
+    parser.add_argument('output', nargs='?',
+                        help="output path, or '-' for stdout (default: <input>_sanitized.pdf, "
+                             "or stdout when reading stdin)")
+    parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+                        metavar='MB', help='approximate peak memory for buffers (default: %(default)s)')
+    parser.add_argument('--recompress', type=_recompress_arg, default=DEFAULT_RECOMPRESS,
+                        metavar='POLICY', help="zlib level 0-9, 'fast', 'match' or 'smallest' "
+                                               "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    output = args.output
+    if output is None:
+        output = '-' if args.input == '-' else '%s_sanitized%s' % os.path.splitext(args.input)
+
+    # stdout may carry the PDF itself, so all messages go to stderr
+    try:
+        with contextlib.ExitStack() as files:
+            if args.input == '-':
+                src, input_path, total_size = sys.stdin.buffer, None, None
+            else:
+                src = files.enter_context(open(args.input, 'rb'))
+                input_path, total_size = args.input, os.fstat(src.fileno()).st_size
+            # A file output is removed if sanitizing fails, and written
+            # beside the input when it is the input
+            dst = (sys.stdout.buffer if output == '-'
+                   else files.enter_context(_output_file(input_path, output, buffering=-1)))
+            stats = PDFSanitizer(recompress=args.recompress).sanitize_stream(
+                src, dst, memory_budget=args.memory_budget * 1024 * 1024, total_size=total_size)
+    except Exception as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return 1
+
+    print(f"[OK] Sanitized {args.input} -> {output} ({stats['throughput_mb_s']} MB/s)", file=sys.stderr)
+    return 0
+
+
+def serve_mode(argv):
+    """Run the sanitizer as a local HTTP service until interrupted"""
+    import asyncio
+    parser = argparse.ArgumentParser(
+        prog='pdf_sanitizer_full.py --serve',
+        description="Serve POST /sanitize, GET /health and GET /metrics on localhost or a Unix socket.")
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=DEFAULT_SERVICE_PORT,
+                        help='TCP port (default: %(default)s)')
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, metavar='N',
+                        help='sanitizer processes (default: %(default)s)')
+    parser.add_argument('--queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH, metavar='N',
+                        help='requests admitted at once before answering 503 (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_REQUEST_TIMEOUT, metavar='SECONDS',
+                        help='per-request time limit (default: %(default)s)')
+    parser.add_argument('--max-request', type=int, default=DEFAULT_MAX_REQUEST // (1024 * 1024),
+                        metavar='MB', help='largest accepted PDF (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    server = SanitizeServer(args.workers, args.queue_depth, args.timeout, args.max_request * 1024 * 1024)
+    where = args.unix or f"http://{args.host}:{args.port}"
+
+    def ready(_):
+        print(f"[OK] Serving on {where} with {server.workers} workers", file=sys.stderr)
+
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix, ready))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def watch_mode(argv):
+    """Drop-box mode: sanitize PDFs landing in an inbox until interrupted"""
+    parser = argparse.ArgumentParser(
+        prog='pdf_sanitizer_full.py --watch',
+        description="Sanitize PDFs dropped into INBOX into OUTBOX as they arrive, then move the "
+                    "originals out of INBOX.")
+    parser.add_argument('inbox', help='directory to watch (top level only)')
+    parser.add_argument('outbox', help='directory for the sanitized files, published by rename')
+    parser.add_argument('--done', metavar='DIR', help='originals that were sanitized (default: INBOX/processed)')
+    parser.add_argument('--failed', metavar='DIR', help='originals that failed (default: INBOX/failed)')
+    parser.add_argument('--journal', metavar='PATH',
+                        help=f'record of finished files, read on restart (default: INBOX/{WATCH_JOURNAL})')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, metavar='N',
+                        help='worker processes (default: %(default)s)')
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE, metavar='SECONDS',
+                        help='how long a closed file must stay unchanged (default: %(default)s)')
+    parser.add_argument('--poll', type=float, metavar='SECONDS',
+                        help='scan the inbox this often instead of using inotify '
+                             f'(the fallback where inotify is missing scans every {DEFAULT_POLL_INTERVAL:g}s)')
+    parser.add_argument('--once', action='store_true',
+                        help='exit once the files already in the inbox are done')
+    parser.add_argument('--results', metavar='PATH', help='append one JSON line per file here')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='keep counts, latency and per-phase totals here in Prometheus text format')
+    parser.add_argument('--recompress', type=_recompress_arg, default=DEFAULT_RECOMPRESS,
+                        metavar='POLICY', help="zlib level 0-9, 'fast', 'match' or 'smallest' "
+                                               "(default: %(default)s)")
+    parser.add_argument('--output-mode', choices=OUTPUT_MODES, default='rewrite',
+                        help="'incremental' appends a sanitized revision and keeps the old one, "
+                             "'collapse' keeps only the sanitized revision (default: %(default)s)")
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='give up on a file after this long (default: no limit)')
+    parser.add_argument('--cpu-limit', type=float, metavar='SECONDS',
+                        help='give up on a file after this much CPU time (default: no limit)')
+    parser.add_argument('--max-inflate', type=int, default=DEFAULT_MAX_INFLATE // (1024 * 1024), metavar='MB',
+                        help='leave streams that inflate past this alone (default: %(default)s)')
+    parser.add_argument('--max-document-inflate', type=int,
+                        default=DEFAULT_MAX_DOCUMENT_INFLATE // (1024 * 1024), metavar='MB',
+                        help='stop inflating streams of a file past this in total (default: %(default)s)')
+    parser.add_argument('--embedded-depth', type=int, default=DEFAULT_EMBEDDED_DEPTH, metavar='N',
+                        help='levels of attached PDFs to sanitize too, 0 for none (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.inbox):
+        print(f"[ERROR] Not a directory: {args.inbox}", file=sys.stderr)
+        return 2
+    limits = {'timeout': args.timeout, 'cpu_limit': args.cpu_limit,
+              'max_inflate': args.max_inflate * 1024 * 1024,
+              'max_document_inflate': args.max_document_inflate * 1024 * 1024,
+              'embedded_depth': args.embedded_depth}
+    results = None if args.results is None else open(args.results, 'a', encoding='utf-8')
+    folder = WatchFolder(args.inbox, args.outbox, args.done, args.failed, args.journal, args.jobs,
+                         args.settle, args.poll, args.recompress, args.output_mode, limits, results,
+                         args.metrics)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: folder.stop())
+
+    print(f"[OK] Watching {args.inbox} with {folder.jobs} workers", file=sys.stderr)
+    try:
+        folder.run(once=args.once)
+    except OSError as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return 1
+    finally:
+        if results is not None:
+            results.close()
+    return 1 if args.once and folder.counts['failed'] else 0
+
+
+CLI_MODES = {
+    '--stream': stream_mode,
+    '--batch': batch_mode,
+    '--scan': scan_mode,
+    '--serve': serve_mode,
+    '--watch': watch_mode,
+}
 
 
 def main():
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_MODES:
+        sys.exit(CLI_MODES[sys.argv[1]](sys.argv[2:]))
+
+    if len(sys.argv) == 2:
         input_file = sys.argv[1]
         if os.path.exists(input_file) and input_file.lower().endswith('.pdf'):
-            cli_mode(input_file)
-            sys.exit(0)
+            sys.exit(cli_mode(input_file))
 
     try:
-        app = ModernGUI()
+        # Folders or several files dropped onto the executable open as a job list
+        app = ModernGUI([path for path in sys.argv[1:] if os.path.exists(path)])
         app.run()
     except Exception as e:
         print(f"Error: {e}")
@@ -547,4 +5154,7 @@ def main():
 
 
 if __name__ == "__main__":
+    import multiprocessing
+    # Batch workers re-launch the frozen executable
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,183 @@
+"""Small PDFs built in memory for the regression tests
+
+Each builder returns the file's bytes. Secrets the sanitizer must remove
+are listed in SECRETS.
+"""
+
+import hashlib
+import zlib
+
+# Values planted in the Info dictionaries and XMP packets below
+SECRETS = (b'John Secret Smith', b'SecretProducer', b'Secret plan', b"+02'00'")
+
+INFO = (b"<</Author(John Secret Smith)/Creator<5365637265745772697465>/Producer(SecretProducer)"
+        b"/Title(Secret plan)/Subject(Secret subject)/CreationDate(D:20240101120000+02'00')"
+        b"/ModDate(D:20240102120000+02'00')>>")
+CONTENT = b'BT /F1 12 Tf 72 712 Td (Hello) Tj ET /Span<</Lang(he)>>BDC EMC\n'
+FILE_ID = b'[<0123456789ABCDEF0123456789ABCDEF><0123456789ABCDEF0123456789ABCDEF>]'
+
+
+def xmp_packet(trailer=True):
+    """An XMP packet, with or without its '<?xpacket end' trailer"""
+    packet = (b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF><rdf:Description>'
+              b'<xmp:CreatorTool>SecretProducer</xmp:CreatorTool>'
+              b'<pdf:Producer>SecretProducer</pdf:Producer>'
+              b'<dc:creator><rdf:Seq><rdf:li>John Secret Smith</rdf:li></rdf:Seq></dc:creator>'
+              b'<dc:title><rdf:Alt><rdf:li xml:lang="x-default">Secret plan</rdf:li></rdf:Alt></dc:title>'
+              b'<xmp:CreateDate>2024-01-01T12:00:00+02:00</xmp:CreateDate>'
+              b'<xmpMM:DocumentID>uuid:1b4e28ba-2fa1-11d2-883f-0016d3cca427</xmpMM:DocumentID>'
+              b'</rdf:Description></rdf:RDF></x:xmpmeta>')
+    if trailer:
+        return b'<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>\n' + packet + b'\n<?xpacket end="w"?>'
+    return packet
+
+
+def stream(dictionary, data, flate=False):
+    """A stream object body with a direct /Length"""
+    if flate:
+        data = zlib.compress(data)
+        dictionary += b'/Filter/FlateDecode'
+    return b'<<' + dictionary + b'/Length %d>>\nstream\n' % len(data) + data + b'\nendstream'
+
+
+def _objects(objects, out):
+    offsets = {}
+    for num in sorted(objects):
+        offsets[num] = len(out)
+        out += b'%d 0 obj\n' % num + objects[num] + b'\nendobj\n'
+    return offsets
+
+
+def classic(objects, info=None):
+    """A file with a classic xref table; objects is {num: body}, 1 the catalog"""
+    out = bytearray(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+    offsets = _objects(objects, out)
+    xref = len(out)
+    size = max(objects) + 1
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % size
+    for num in range(1, size):
+        out += b'%010d 00000 n \n' % offsets[num] if num in offsets else b'0000000000 65535 f \n'
+    out += b'trailer\n<</Size %d/Root 1 0 R' % size
+    if info is not None:
+        out += b'/Info %d 0 R' % info
+    out += b'/ID%s>>\nstartxref\n%d\n%%%%EOF\n' % (FILE_ID, xref)
+    return bytes(out)
+
+
+def simple_document(xmp_trailer=True, extra=None):
+    """One page, an Info dictionary, XMP metadata and a Flate content stream
+    with a language tag; extra(objects) may add or replace objects"""
+    objects = {
+        1: b'<</Type/Catalog/Pages 2 0 R/Metadata 6 0 R/Lang(he)>>',
+        2: b'<</Type/Pages/Kids[3 0 R]/Count 1>>',
+        3: b'<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]/Contents 4 0 R>>',
+        4: stream(b'', CONTENT * 20, flate=True),
+        5: INFO,
+        6: stream(b'/Type/Metadata/Subtype/XML', xmp_packet(xmp_trailer)),
+    }
+    if extra is not None:
+        extra(objects)
+    return classic(objects, info=5)
+
+
+def incremental_update(data, objects, info=None):
+    """data with an update appending objects, as an editor saving in place would"""
+    out = bytearray(data)
+    previous = int(data[data.rindex(b'startxref') + 9:].split()[0])
+    size = int(data[data.rindex(b'/Size') + 5:].split(b'/')[0])
+    offsets = _objects(objects, out)
+    xref = len(out)
+    out += b'xref\n'
+    for num in sorted(offsets):
+        out += b'%d 1\n%010d 00000 n \n' % (num, offsets[num])
+    out += b'trailer\n<</Size %d/Root 1 0 R/Prev %d' % (max(size, max(objects) + 1), previous)
+    if info is not None:
+        out += b'/Info %d 0 R' % info
+    out += b'/ID%s>>\nstartxref\n%d\n%%%%EOF\n' % (FILE_ID, xref)
+    return bytes(out)
+
+
+def _png_up(rows, columns):
+    """Rows encoded with the PNG Up predictor (type 2)"""
+    out = bytearray()
+    previous = bytes(columns)
+    for row in rows:
+        out += b'\x02' + bytes((a - b) & 0xFF for a, b in zip(row, previous))
+        previous = row
+    return bytes(out)
+
+
+def xref_stream_document(padding=0, xmp_trailer=False):
+    """A PDF 1.5 file: the catalog, page tree and Info dictionary sit in an
+    object stream, and the xref stream uses a PNG predictor. padding adds
+    that many spaces to the object stream, for a decompression bomb."""
+    inner = [(1, b'<</Type/Catalog/Pages 2 0 R/Metadata 8 0 R/Lang(he)>>'),
+             (2, b'<</Type/Pages/Kids[3 0 R]/Count 1>>'),
+             (6, INFO)]
+    positions = []
+    body = b''
+    for _, text in inner:
+        positions.append(len(body))
+        body += text + b'\n'
+    header = b' '.join(b'%d %d' % (num, position) for (num, _), position in zip(inner, positions)) + b'\n'
+    packed = zlib.compress(header + body + b' ' * padding, 9)
+
+    out = bytearray(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+    offsets = _objects({
+        3: b'<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]/Contents 4 0 R>>',
+        4: stream(b'', CONTENT * 20, flate=True),
+        5: b'<</Type/ObjStm/N %d/First %d/Filter/FlateDecode/Length %d>>\nstream\n'
+           % (len(inner), len(header), len(packed)) + packed + b'\nendstream',
+        8: stream(b'/Type/Metadata/Subtype/XML', xmp_packet(xmp_trailer)),
+    }, out)
+    xref = len(out)
+
+    def row(kind, field, index):
+        return bytes([kind]) + field.to_bytes(4, 'big') + bytes([index])
+    entries = {0: row(0, 0, 255), 1: row(2, 5, 0), 2: row(2, 5, 1), 6: row(2, 5, 2), 7: row(1, xref, 0)}
+    entries.update((num, row(1, offset, 0)) for num, offset in offsets.items())
+    rows = zlib.compress(_png_up([entries[num] for num in range(9)], 6))
+    out += (b'7 0 obj\n<</Type/XRef/Size 9/W[1 4 1]/Root 1 0 R/Info 6 0 R/ID%s/Filter/FlateDecode'
+            b'/DecodeParms<</Predictor 12/Columns 6>>/Length %d>>\nstream\n' % (FILE_ID, len(rows))
+            + rows + b'\nendstream\nendobj\nstartxref\n%d\n%%%%EOF\n' % xref)
+    return bytes(out)
+
+
+def _attach(objects, first, data, name, flate):
+    """Add an embedded file stream at first and its file specification at
+    first + 1; returns the specification's number"""
+    params = b'/Params<</Size %d/CheckSum<%s>>>' % (len(data), hashlib.md5(data).hexdigest().encode())
+    objects[first] = stream(b'/Type/EmbeddedFile/Subtype/application#2Fpdf' + params, data, flate)
+    objects[first + 1] = b'<</Type/Filespec/F(%s)/UF(%s)/EF<</F %d 0 R>>>>' % (name, name, first)
+    return first + 1
+
+
+def attachment_document():
+    """A document with a compressed PDF in its /EmbeddedFiles name tree, an
+    uncompressed PDF attached to its page that has an attachment of its
+    own, and a text file"""
+    def inner_attachment(objects):
+        spec = _attach(objects, 20, simple_document(), b'deep.pdf', True)
+        objects[22] = b'<</Names[(deep.pdf) %d 0 R]>>' % spec
+        objects[1] = b'<</Type/Catalog/Pages 2 0 R/Metadata 6 0 R/Names<</EmbeddedFiles 22 0 R>>>>'
+    nested = simple_document(extra=inner_attachment)
+
+    def attachments(objects):
+        first = _attach(objects, 10, simple_document(), b'inner.pdf', True)
+        page = _attach(objects, 12, nested, b'nested.pdf', False)
+        text = _attach(objects, 14, b'plain text, not a PDF', b'notes.txt', True)
+        objects[16] = b'<</Names[(inner.pdf) %d 0 R(notes.txt) %d 0 R]>>' % (first, text)
+        objects[17] = b'<</Type/Annot/Subtype/FileAttachment/Rect[0 0 10 10]/FS %d 0 R>>' % page
+        objects[1] = b'<</Type/Catalog/Pages 2 0 R/Metadata 6 0 R/Names<</EmbeddedFiles 16 0 R>>>>'
+        objects[3] = b'<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]/Contents 4 0 R/Annots[17 0 R]>>'
+    return simple_document(extra=attachments)
+
+
+def bomb_document(size):
+    """simple_document with a content stream of size zero bytes, compressed"""
+    def bomb(objects):
+        deflater = zlib.compressobj(9)
+        chunk = bytes(1 << 20)
+        packed = b''.join(deflater.compress(chunk) for _ in range(size >> 20)) + deflater.flush()
+        objects[4] = b'<</Filter/FlateDecode/Length %d>>\nstream\n' % len(packed) + packed + b'\nendstream'
+    return simple_document(extra=bomb)
@@ -0,0 +1,9 @@
+"""Shared setup for the tests: makes the sanitizer importable from the
+repository root"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdf_sanitizer_full as sanitizer  # noqa: E402,F401
@@ -0,0 +1,80 @@
+"""Tests for the on-disk cache of sanitized outputs"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import fixtures
+from support import sanitizer
+
+
+def numbered_document(number):
+    """simple_document with an extra object, so each number hashes apart
+    while every output has the same size"""
+    return fixtures.simple_document(extra=lambda objects: objects.update({7: b'(%d)' % number}))
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.cache_dir = os.path.join(self.directory, 'cache')
+
+    def open_cache(self, **settings):
+        cache = sanitizer.SanitizeCache(self.cache_dir, **settings)
+        self.addCleanup(cache.close)
+        return cache
+
+    def sanitize(self, cache, number, **settings):
+        """Output bytes and stats of document number, sanitized through cache"""
+        path = os.path.join(self.directory, f'{number}.pdf')
+        with open(path, 'wb') as f:
+            f.write(numbered_document(number))
+        output_path, stats = sanitizer.PDFSanitizer(cache=cache, **settings).sanitize_pdf(path)
+        with open(output_path, 'rb') as f:
+            output = f.read()
+        os.remove(output_path)
+        return output, stats
+
+    def test_hit(self):
+        cache = self.open_cache()
+        output, stats = self.sanitize(cache, 1)
+        self.assertEqual(stats['cache'], 'miss')
+        cached, cached_stats = self.sanitize(cache, 1)
+        self.assertEqual(cached_stats['cache'], 'hit')
+        self.assertEqual(cached, output)
+        self.assertEqual(cached_stats['lang_tags'], stats['lang_tags'])
+
+        # Other settings and other input bytes are different entries
+        self.assertEqual(self.sanitize(cache, 1, recompress='fast')[1]['cache'], 'miss')
+        self.assertEqual(self.sanitize(cache, 2)[1]['cache'], 'miss')
+
+    def test_least_recently_used_entry_is_evicted(self):
+        size = len(self.sanitize(None, 1)[0])
+        cache = self.open_cache(max_size=2 * size + size // 2)
+        self.sanitize(cache, 1)
+        self.sanitize(cache, 2)
+        # Using the first entry again leaves the second as the oldest
+        self.assertEqual(self.sanitize(cache, 1)[1]['cache'], 'hit')
+        self.sanitize(cache, 3)
+        self.assertEqual(len(os.listdir(cache.objects)), 2)
+        self.assertEqual(self.sanitize(cache, 1)[1]['cache'], 'hit')
+        self.assertEqual(self.sanitize(cache, 3)[1]['cache'], 'hit')
+        self.assertEqual(self.sanitize(cache, 2)[1]['cache'], 'miss')
+
+    def test_other_version_is_purged(self):
+        cache = self.open_cache()
+        self.sanitize(cache, 1)
+        cache.close()
+        self.assertEqual(len(os.listdir(cache.objects)), 1)
+
+        with mock.patch.object(sanitizer, '__version__', '0.0.0'):
+            cache = self.open_cache()
+            self.assertEqual(os.listdir(cache.objects), [])
+            self.assertEqual(self.sanitize(cache, 1)[1]['cache'], 'miss')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""Tests for the single-scan rewrite engine"""
+
+import collections
+import random
+import re
+import unittest
+import zlib
+
+import fixtures
+from support import sanitizer
+
+# Quirks the rules have to agree on, outside any real object structure
+EDGE_CASES = (b"%PDF-1.4\n1 0 obj\n<</Author()/Creator<>/Title<4142>/Subject(a)/Producer<4a6f>"
+              b"/ModDate(D:20240101120000-05'00')/CreationDate()>>\nendobj\n"
+              b"2 0 obj\n<</Length 40>>\nstream\n/Span<</Lang(he)>>BDC (D:20240101120000+01'00')\nendstream\n"
+              b"endobj\ntrailer\n<</ID [ <ABCD> ]>>\n"
+              b"<xmp:ModifyDate>2024</xmp:ModifyDate><dc:description>x</dc:description>"
+              b"<xmpMM:InstanceID>uuid:1</xmpMM:InstanceID>")
+
+
+def sequential_passes(data, options):
+    """The sanitizer before the engine: one re.sub pass over the whole file
+    per rule, in this order. Returns (output, stats)."""
+    stats = {'author': False, 'creator': False, 'producer': False, 'title': False, 'subject': False,
+             'timestamps': False, 'timezone': False, 'lang_tags': 0, 'doc_id': False, 'xmp': False}
+
+    if options.get('remove_lang_tags'):
+        def replace_in_stream(match):
+            try:
+                decompressed = zlib.decompress(match.group(1))
+            except zlib.error:
+                return match.group(0)
+            if b'/Lang(he)' not in decompressed:
+                return match.group(0)
+            stats['lang_tags'] += decompressed.count(b'/Lang(he)')
+            decompressed = decompressed.replace(b'/Lang(he)', b'/Lang(en)')
+            return b'stream\r\n' + zlib.compress(decompressed, 9) + b'\r\nendstream'
+        data = re.sub(rb'stream\r?\n(.+?)\r?\nendstream', replace_in_stream, data, flags=re.DOTALL)
+
+    if options.get('remove_timezone'):
+        date_pattern = rb"(D:\d{14})([+-]\d{2}'\d{2}')"
+        if re.search(date_pattern, data):
+            stats['timezone'] = True
+        data = re.sub(date_pattern, rb"\1Z", data)
+
+    for option, key, name in sanitizer.INFO_FIELDS:
+        if options.get(option):
+            if re.search(rb'/' + name + rb'\([^)]+\)', data) or re.search(rb'/' + name + rb'<[^>]+>', data):
+                stats[key] = True
+            data = re.sub(rb'/' + name + rb'\([^)]*\)', b'/' + name + b'()', data)
+            data = re.sub(rb'/' + name + rb'<[^>]*>', b'/' + name + b'<>', data)
+
+    if options.get('remove_lang_tags'):
+        data = re.sub(rb'/Lang\(he\)', b'/Lang(en)', data)
+
+    if options.get('remove_doc_id'):
+        if re.search(rb'/ID\s*\[\s*<[A-Fa-f0-9]+>', data):
+            stats['doc_id'] = True
+        data = re.sub(rb'/ID\s*\[\s*<[A-Fa-f0-9]+>\s*<[A-Fa-f0-9]+>\s*\]', sanitizer.ZERO_ID, data)
+
+    if options.get('remove_timestamps'):
+        if re.search(rb'/CreationDate\([^)]+\)', data):
+            stats['timestamps'] = True
+        data = re.sub(rb'/CreationDate\([^)]*\)', b'/CreationDate' + sanitizer.EPOCH_DATE, data)
+        data = re.sub(rb'/ModDate\([^)]*\)', b'/ModDate' + sanitizer.EPOCH_DATE, data)
+
+    if options.get('remove_xmp'):
+        stats['xmp'] = True
+        for tag, content, replacement in sanitizer.XMP_RULES:
+            data = re.sub(b'<' + tag + b'>' + content + b'</' + tag + b'>',
+                          b'<' + tag + b'>' + replacement + b'</' + tag + b'>', data, flags=re.DOTALL)
+    return data, stats
+
+
+def option_sets():
+    """Every option on, each one alone, and none"""
+    yield dict(sanitizer.DEFAULT_OPTIONS)
+    for option in sanitizer.DEFAULT_OPTIONS:
+        yield {key: key == option for key in sanitizer.DEFAULT_OPTIONS}
+    yield {key: False for key in sanitizer.DEFAULT_OPTIONS}
+
+
+class EngineTest(unittest.TestCase):
+    def rewrite(self, data, options):
+        stats = collections.defaultdict(int, {key: False for key in sanitizer.DEFAULT_OPTIONS})
+        stats['lang_tags'] = 0
+        return sanitizer.RewriteEngine(options).rewrite(data, stats), stats
+
+    def test_matches_sequential_passes(self):
+        corpus = {
+            'simple': fixtures.simple_document(),
+            'no packet trailer': fixtures.simple_document(xmp_trailer=False),
+            'edge cases': EDGE_CASES,
+        }
+        for label, data in corpus.items():
+            for options in option_sets():
+                enabled = sorted(key for key, value in options.items() if value)
+                with self.subTest(label, options=enabled):
+                    expected, expected_stats = sequential_passes(data, options)
+                    output, stats = self.rewrite(data, options)
+                    self.assertEqual(output, expected)
+                    # sanitize_pdf reports XMP as handled whenever the rules ran
+                    del expected_stats['xmp']
+                    self.assertEqual({key: stats[key] for key in expected_stats}, expected_stats)
+
+    def test_nothing_to_rewrite(self):
+        data = fixtures.simple_document()
+        output, stats = self.rewrite(data, {})
+        self.assertEqual(output, data)
+
+        def untagged(objects):
+            objects[1] = objects[1].replace(b'/Lang(he)', b'')
+            objects[4] = fixtures.stream(b'', fixtures.CONTENT.replace(b'(he)', b'(en)') * 20, flate=True)
+        clean = fixtures.simple_document(extra=untagged)
+        output, stats = self.rewrite(clean, {'remove_lang_tags': True})
+        self.assertEqual(output, clean)
+        self.assertEqual(stats['lang_tags'], 0)
+
+    def test_flate_stream_language_tags(self):
+        output, stats = self.rewrite(fixtures.simple_document(), {'remove_lang_tags': True})
+        # Only the tags inside streams are counted
+        self.assertEqual(stats['lang_tags'], 20)
+        self.assertNotIn(b'/Lang(he)', output)
+        body = re.search(rb'stream\r\n(.*?)\r\nendstream', output, re.DOTALL).group(1)
+        self.assertEqual(zlib.decompress(body), fixtures.CONTENT.replace(b'(he)', b'(en)') * 20)
+
+    def test_stream_selection(self):
+        tagged = fixtures.CONTENT * 20
+        image = fixtures.stream(b'/Type/XObject/Subtype/Image/Width 1/Height 1', tagged, flate=True)
+        encoded = fixtures.stream(b'/Filter/DCTDecode', tagged)
+        corrupt = b'<</Filter/FlateDecode/Length 12>>\nstream\nnot deflated\nendstream'
+
+        def streams(objects):
+            objects.update({7: image, 8: encoded, 9: fixtures.stream(b'', tagged), 10: corrupt})
+        output, stats = self.rewrite(fixtures.simple_document(extra=streams), {'remove_lang_tags': True})
+        # The content stream and the corrupt one are inflated; the XMP and
+        # unfiltered bodies are scanned as they are, the rest left alone
+        self.assertEqual(stats['streams_decoded'], 2)
+        self.assertEqual(stats['streams_skipped'], 4)
+        self.assertEqual(stats['lang_tags'], 20)
+        for kept in (image, encoded, corrupt):
+            self.assertIn(kept, output)
+        self.assertIn(fixtures.stream(b'', tagged.replace(b'(he)', b'(en)')), output)
+
+
+class RecompressTest(unittest.TestCase):
+    def setUp(self):
+        self.content = fixtures.CONTENT * 200
+        self.untagged = fixtures.stream(b'', random.Random(6).randbytes(4096), flate=True)
+        self.data = fixtures.simple_document(extra=lambda objects: objects.update(
+            {4: fixtures.stream(b'', self.content, flate=True), 7: self.untagged}))
+        self.original = len(zlib.compress(self.content))
+
+    def rewrite(self, policy):
+        stats = collections.defaultdict(int)
+        engine = sanitizer.RewriteEngine({'remove_lang_tags': True}, recompress=policy)
+        output = engine.rewrite(self.data, stats)
+        body = re.search(rb'stream\r\n(.*?)\r\nendstream', output, re.DOTALL).group(1)
+        self.assertEqual(zlib.decompress(body), self.content.replace(b'(he)', b'(en)'))
+        # The stream without a tag is never re-encoded
+        self.assertIn(self.untagged, output)
+        self.assertEqual(stats['recompress_bytes_in'], self.original)
+        self.assertEqual(stats['recompress_bytes_out'], len(body))
+        return len(body)
+
+    def test_policies(self):
+        sizes = {}
+        for policy in sanitizer.RECOMPRESS_POLICIES + (0, 1, 6, 9):
+            with self.subTest(policy=policy):
+                sizes[policy] = self.rewrite(policy)
+        self.assertEqual(sizes['fast'], sizes[1])
+        self.assertLessEqual(sizes['match'], self.original)
+        self.assertLessEqual(sizes['smallest'], sizes[9])
+        self.assertGreater(sizes[0], sizes[9])
+
+    def test_unknown_policy(self):
+        for policy in ('best', 10, -1, True):
+            with self.subTest(policy=policy), self.assertRaises(ValueError):
+                sanitizer.RewriteEngine({}, recompress=policy)
+
+
+if __name__ == '__main__':
+    unittest.main()
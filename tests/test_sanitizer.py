@@ -0,0 +1,400 @@
+"""Regression tests for the object-level rewrite: xref tables and streams,
+object streams, relocation, incremental updates, output modes, worker
+pools, attachments and decompression bombs
+
+Every output is checked for xref entries that point at their objects and
+for streams whose /Length ends on endstream.
+"""
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+
+import fixtures
+from support import sanitizer
+
+STREAM_START = re.compile(rb'>>\s*stream(?:\r\n|\n)')
+LENGTH = re.compile(rb'/Length\s+(\d+)(?:\s+(\d+)\s+R)?')
+
+
+class StructureChecks(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def sanitize(self, data, output_mode='rewrite', **settings):
+        """Output bytes and stats of sanitize_pdf run on data"""
+        path = os.path.join(self.directory, 'input.pdf')
+        with open(path, 'wb') as f:
+            f.write(data)
+        output_path, stats = sanitizer.PDFSanitizer(**settings).sanitize_pdf(path, output_mode=output_mode)
+        with open(output_path, 'rb') as f:
+            return f.read(), stats
+
+    def index(self, data):
+        """XrefIndex of data, kept open until the test ends"""
+        path = os.path.join(self.directory, 'indexed.pdf')
+        with open(path, 'wb') as f:
+            f.write(data)
+        f = open(path, 'rb')
+        self.addCleanup(f.close)
+        return sanitizer.XrefIndex(f)
+
+    def assertStructure(self, data):
+        """Every xref entry of every revision points at its object, every
+        compressed object can be read and every stream's /Length ends on
+        endstream"""
+        index = self.index(data)
+        for i, section in enumerate(index.sections):
+            for num, offset in section['entries'].items():
+                self.assertStreamLength(data, index.sections[i:], num, offset)
+            for num in section['compressed']:
+                self.assertTrue(index.read_text(num, index.locations(num)[0]))
+        return index
+
+    def assertStreamLength(self, data, sections, num, offset):
+        header = re.match(rb'(\d+)\s+\d+\s+obj', data[offset:offset + 64])
+        self.assertIsNotNone(header, f"no object at offset {offset}")
+        self.assertEqual(int(header.group(1)), num)
+        keyword = STREAM_START.search(data, offset)
+        if keyword is None or keyword.start() > data.find(b'endobj', offset):
+            return
+        entry = LENGTH.search(data, offset, keyword.start())
+        self.assertIsNotNone(entry, f"object {num} has no /Length")
+        length = int(entry.group(1))
+        if entry.group(2) is not None:
+            # The length object as of the revision holding this stream
+            position = next(section['entries'][length] for section in sections
+                            if length in section['entries'])
+            length = int(re.match(rb'\d+\s+\d+\s+obj\s*(\d+)', data[position:position + 64]).group(1))
+        end = keyword.end() + length
+        self.assertRegex(data[end:end + 16], rb'^(?:\r\n|\r|\n)?endstream',
+                         f"/Length of object {num} does not end on endstream")
+
+    def assertClean(self, data):
+        """The newest Info dictionary and XMP packet hold none of the secrets"""
+        index = self.index(data)
+        trailer = index.sections[0]['trailer']
+
+        def newest(num):
+            return index.read_text(num, index.locations(num)[0])
+        info = newest(sanitizer._ref(trailer, b'Info'))
+        root = newest(sanitizer._ref(trailer, b'Root'))
+        metadata = newest(sanitizer._ref(root, b'Metadata'))
+        for secret in fixtures.SECRETS:
+            self.assertNotIn(secret, info)
+            self.assertNotIn(secret, metadata)
+        self.assertNotIn(b'/Lang(he)', root)
+
+
+class ClassicXrefTest(StructureChecks):
+    def test_output_modes(self):
+        data = fixtures.simple_document()
+        for mode in sanitizer.OUTPUT_MODES:
+            with self.subTest(mode=mode):
+                output, stats = self.sanitize(data, mode)
+                self.assertEqual(stats['mode'], 'xref' if mode == 'rewrite' else mode)
+                self.assertStructure(output)
+                self.assertClean(output)
+
+    def test_incremental_onto_itself(self):
+        # Only the new revision is written; the original bytes stay ahead of it
+        data = fixtures.simple_document()
+        path = os.path.join(self.directory, 'input.pdf')
+        with open(path, 'wb') as f:
+            f.write(data)
+        sanitizer.PDFSanitizer().sanitize_pdf(path, path, output_mode='incremental')
+        with open(path, 'rb') as f:
+            output = f.read()
+        self.assertTrue(output.startswith(data))
+        self.assertEqual(len(self.assertStructure(output).sections), 2)
+        self.assertClean(output)
+
+    def test_rewrite_keeps_offsets(self):
+        # Without the stream pass nothing changes size
+        data = fixtures.simple_document()
+        options = dict(sanitizer.DEFAULT_OPTIONS, remove_lang_tags=False)
+        path = os.path.join(self.directory, 'input.pdf')
+        with open(path, 'wb') as f:
+            f.write(data)
+        output_path, stats = sanitizer.PDFSanitizer().sanitize_pdf(path, options=options)
+        self.assertEqual(stats['mode'], 'xref')
+        with open(output_path, 'rb') as f:
+            output = f.read()
+        self.assertEqual(len(output), len(data))
+        self.assertStructure(output)
+        for secret in fixtures.SECRETS:
+            self.assertNotIn(secret, output)
+
+    def test_recompressed_streams_move_later_objects(self):
+        # The recompressed content stream comes ahead of the Info and XMP
+        # objects, and is written back with CRLF around its body
+        data = fixtures.simple_document()
+        output, stats = self.sanitize(data)
+        self.assertEqual(stats['mode'], 'xref')
+        self.assertEqual(stats['lang_tags'], 20)
+        self.assertNotEqual(len(output), len(data))
+        self.assertGreater(stats['xref_verified'], 0)
+        self.assertStructure(output)
+        self.assertClean(output)
+
+    def test_flat_scan_fixes_length_of_edited_text_streams(self):
+        # The XMP rules shrink the uncompressed packet in place
+        data = fixtures.simple_document()
+        output, stats = self.sanitize(data, use_xref=False)
+        self.assertEqual(stats['mode'], 'flat')
+        self.assertLess(len(output), len(data))
+        self.assertStructure(output)
+        self.assertClean(output)
+
+    def test_xmp_without_packet_trailer(self):
+        data = fixtures.simple_document(xmp_trailer=False)
+        for use_xref in (True, False):
+            with self.subTest(use_xref=use_xref):
+                output, _ = self.sanitize(data, use_xref=use_xref)
+                self.assertStructure(output)
+                self.assertClean(output)
+        for mode in sanitizer.OUTPUT_MODES[1:]:
+            with self.subTest(mode=mode):
+                output, _ = self.sanitize(data, mode)
+                self.assertStructure(output)
+                self.assertClean(output)
+
+
+    def test_benchmark_corpus(self):
+        import benchmark
+        data = benchmark.generate_pdf(size=0.05, streams=4, xmp_size=2048)
+        for settings in ({}, {'use_xref': False}, {'workers': 2}):
+            with self.subTest(**settings):
+                output, _ = self.sanitize(data, **settings)
+                self.assertStructure(output)
+
+    def test_verify_catches_stale_length(self):
+        def shrink(objects):
+            # The packet lost 16 bytes but /Length still counts them
+            packet = fixtures.xmp_packet().replace(b'John Secret Smith', b'J')
+            objects[6] = fixtures.stream(b'/Type/Metadata/Subtype/XML', packet).replace(
+                b'/Length %d' % len(packet), b'/Length %d' % (len(packet) + 16))
+        index = self.index(fixtures.simple_document(extra=shrink))
+        index.verify()
+        with self.assertRaises(sanitizer.PDFStructureError):
+            index.verify([index.offsets(6)[0] + 20])
+
+
+class XrefStreamTest(StructureChecks):
+    def test_output_modes(self):
+        data = fixtures.xref_stream_document()
+        for mode in sanitizer.OUTPUT_MODES:
+            for workers in (1, 2):
+                with self.subTest(mode=mode, workers=workers):
+                    output, stats = self.sanitize(data, mode, workers=workers)
+                    self.assertNotIn('xref_fallback', stats)
+                    self.assertEqual(stats['mode'], 'xref' if mode == 'rewrite' else mode)
+                    index = self.assertStructure(output)
+                    self.assertClean(output)
+                    if mode == 'rewrite':
+                        # The recompressed content stream moved the xref stream
+                        self.assertNotEqual(len(output), len(data))
+                        self.assertEqual(index.sections[0]['kind'], 'stream')
+
+    def test_png_predictor_rows(self):
+        index = self.index(fixtures.xref_stream_document())
+        self.assertEqual(index.sections[0]['kind'], 'stream')
+        self.assertEqual(index.locations(6), [('compressed', 5, index.offsets(5)[0], 2)])
+        self.assertIn(b'/Author', index.read_text(6, index.locations(6)[0]))
+
+    def test_update_rewriting_the_object_stream(self):
+        # The update lists the new object stream but not the objects in it,
+        # which are read from it all the same
+        output, _ = self.sanitize(fixtures.xref_stream_document(), 'incremental')
+        index = self.index(output)
+        self.assertNotIn(6, index.sections[0]['compressed'])
+        self.assertEqual(index.locations(6)[0][:3], ('compressed', 5, index.offsets(5)[0]))
+        self.assertNotIn(b'John Secret Smith', index.read_text(6, index.locations(6)[0]))
+
+
+class IncrementalUpdateTest(StructureChecks):
+    def setUp(self):
+        super().setUp()
+        content = fixtures.stream(b'', fixtures.CONTENT * 40, flate=True)
+        self.data = fixtures.incremental_update(fixtures.simple_document(),
+                                                {4: content, 5: fixtures.INFO.replace(b'Secret plan', b'Secret plan v2')},
+                                                info=5)
+
+    def test_output_modes(self):
+        for mode in sanitizer.OUTPUT_MODES:
+            with self.subTest(mode=mode):
+                output, stats = self.sanitize(self.data, mode)
+                index = self.assertStructure(output)
+                self.assertClean(output)
+                if mode != 'incremental':
+                    # Superseded revisions are sanitized or dropped too
+                    for secret in fixtures.SECRETS:
+                        self.assertNotIn(secret, output)
+                if mode == 'collapse':
+                    self.assertEqual(len(index.sections), 1)
+                else:
+                    self.assertEqual(len(index.sections), 3 if mode == 'incremental' else 2)
+
+    def test_rewrite_sanitizes_every_revision(self):
+        output, stats = self.sanitize(self.data)
+        self.assertEqual(stats['mode'], 'xref')
+        self.assertEqual(len(self.assertStructure(output).sections), 2)
+        self.assertClean(output)
+        self.assertTrue(stats['author'])
+        for secret in fixtures.SECRETS:
+            self.assertNotIn(secret, output)
+
+    def test_flat_scan(self):
+        output, stats = self.sanitize(self.data, use_xref=False)
+        self.assertEqual(stats['mode'], 'flat')
+        self.assertStructure(output)
+        self.assertClean(output)
+
+
+class WorkerPoolTest(StructureChecks):
+    def test_output_does_not_depend_on_workers(self):
+        def streams(objects):
+            for num in range(20, 40):
+                objects[num] = fixtures.stream(b'', fixtures.CONTENT * num, flate=True)
+        data = fixtures.simple_document(extra=streams)
+        for use_xref in (True, False):
+            with self.subTest(use_xref=use_xref):
+                serial, stats = self.sanitize(data, use_xref=use_xref, workers=1)
+                self.assertEqual(stats['lang_tags'], 20 + sum(range(20, 40)))
+                self.assertStructure(serial)
+                for workers in (2, 4):
+                    output, pooled = self.sanitize(data, use_xref=use_xref, workers=workers)
+                    self.assertEqual(output, serial)
+                    for key in ('lang_tags', 'streams_decoded', 'streams_skipped'):
+                        self.assertEqual(pooled[key], stats[key], key)
+
+
+class AttachmentTest(StructureChecks):
+    def embedded(self, data):
+        """{num: decoded bytes} of the embedded file streams of the newest revision"""
+        index = self.index(data)
+        found = {}
+        for num in index.embedded_files():
+            dictionary, content = sanitizer._decode_stream(index.read_object(num, index.offsets(num)[0]))
+            self.assertEqual(sanitizer._int_value(dictionary, b'Size'), len(content))
+            checksum = re.search(rb'/CheckSum\s*<([0-9a-fA-F]+)>', dictionary).group(1)
+            self.assertEqual(checksum.decode().lower(), hashlib.md5(content).hexdigest())
+            found[num] = content
+        return found
+
+    def assertCleanTree(self, data, depth):
+        self.assertStructure(data)
+        self.assertClean(data)
+        for content in self.embedded(data).values():
+            if content.startswith(b'%PDF') and depth > 1:
+                self.assertCleanTree(content, depth - 1)
+
+    def test_output_modes(self):
+        data = fixtures.attachment_document()
+        for mode in sanitizer.OUTPUT_MODES:
+            for workers in (1, 3):
+                with self.subTest(mode=mode, workers=workers):
+                    output, stats = self.sanitize(data, mode, workers=workers)
+                    self.assertCleanTree(output, 3)
+                    entries = {entry['name']: entry for entry in stats['attachments']}
+                    self.assertEqual(set(entries), {'inner.pdf', 'nested.pdf', 'notes.txt'})
+                    self.assertFalse(entries['notes.txt']['pdf'])
+                    self.assertEqual(len(entries['nested.pdf']['stats']['attachments']), 1)
+
+    def test_flat_scan(self):
+        output, stats = self.sanitize(fixtures.attachment_document(), use_xref=False)
+        self.assertEqual(stats['mode'], 'flat')
+        self.assertCleanTree(output, 3)
+
+    def test_depth_limit(self):
+        data = fixtures.attachment_document()
+        output, stats = self.sanitize(data, embedded_depth=1)
+        nested = next(entry for entry in stats['attachments'] if entry['name'] == 'nested.pdf')
+        self.assertEqual(nested['stats']['attachments'], [])
+        # The attachment of the attachment keeps its metadata
+        deep, = self.embedded(self.embedded(output)[12]).values()
+        self.assertIn(b'John Secret Smith', deep)
+
+        output, stats = self.sanitize(data, embedded_depth=0)
+        self.assertEqual(stats['attachments'], [])
+        self.assertEqual(self.embedded(output), self.embedded(data))
+
+
+class DecompressionBombTest(StructureChecks):
+    def test_content_stream_left_alone(self):
+        data = fixtures.bomb_document(64 << 20)
+        output, stats = self.sanitize(data, max_inflate=8 << 20)
+        self.assertEqual([error['guard'] for error in stats['errors']], ['stream_inflate'])
+        self.assertStructure(output)
+        self.assertClean(output)
+
+    def test_object_stream_within_limits(self):
+        data = fixtures.xref_stream_document(padding=32 << 20)
+        output, stats = self.sanitize(data, max_inflate=8 << 20)
+        self.assertEqual(stats['mode'], 'flat')
+        self.assertIn('stream_inflate', stats['xref_fallback'])
+        self.assertStructure(output)
+
+        output, stats = self.sanitize(data, max_document_inflate=8 << 20)
+        self.assertIn('document_inflate', stats['xref_fallback'])
+
+        with self.assertRaises(sanitizer.PDFStructureError):
+            self.sanitize(data, 'collapse', max_inflate=8 << 20)
+
+    def test_timeout(self):
+        with self.assertRaises(sanitizer.SanitizeAborted) as caught:
+            self.sanitize(fixtures.simple_document(), timeout=0)
+        self.assertEqual(caught.exception.guard, 'timeout')
+
+    def test_cpu_limit_counts_only_the_jobs_threads(self):
+        def spin(seconds):
+            until = time.thread_time() + seconds
+            while time.thread_time() < until:
+                pass
+        guard = sanitizer._JobGuard(cpu_limit=0.1)
+        # Another job's thread in the same process is not charged
+        other = threading.Thread(target=spin, args=(0.3,))
+        other.start()
+        other.join()
+        guard.check()
+        spin(0.15)
+        with self.assertRaises(sanitizer.SanitizeAborted) as caught:
+            guard.check()
+        self.assertEqual(caught.exception.guard, 'cpu_limit')
+
+    def test_batch_limits(self):
+        path = os.path.join(self.directory, 'input.pdf')
+        with open(path, 'wb') as f:
+            f.write(fixtures.simple_document())
+        results = os.path.join(self.directory, 'results.jsonl')
+        output_dir = os.path.join(self.directory, 'out')
+        for flag in ('--timeout', '--cpu-limit'):
+            with self.subTest(flag), contextlib.redirect_stderr(io.StringIO()):
+                self.assertEqual(sanitizer.batch_mode([path, '--jobs', '1', '--results', results,
+                                                       '--output-dir', output_dir, flag, '0']), 1)
+                with open(results, encoding='utf-8') as f:
+                    result = json.loads(f.read())
+                self.assertEqual(result['stats']['errors'][0]['guard'], flag[2:].replace('-', '_'))
+
+    def test_cancel(self):
+        path = os.path.join(self.directory, 'input.pdf')
+        with open(path, 'wb') as f:
+            f.write(fixtures.simple_document())
+        pdf = sanitizer.PDFSanitizer()
+        pdf.cancel()
+        with self.assertRaises(sanitizer.SanitizeAborted) as caught:
+            pdf.sanitize_pdf(path)
+        self.assertEqual(caught.exception.guard, 'cancelled')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Tests for the scan-only audit mode"""
+
+import os
+import tempfile
+import unittest
+
+import fixtures
+from support import sanitizer
+
+CATEGORIES = {'author', 'creator', 'producer', 'title', 'subject', 'timestamps', 'timezone',
+              'lang_tags', 'doc_id', 'xmp'}
+
+
+class ScanTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'input.pdf')
+        self.data = fixtures.simple_document()
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def test_findings_point_at_their_traces(self):
+        for use_xref in (True, False):
+            with self.subTest(use_xref=use_xref):
+                report = sanitizer.PDFSanitizer(use_xref=use_xref).scan_pdf(self.path)
+                self.assertFalse(report['clean'])
+                self.assertEqual(set(report['findings']), CATEGORIES)
+                for category, found in report['findings'].items():
+                    for finding in found:
+                        text = finding['text'].encode('latin-1')
+                        if text.startswith(b'stream '):
+                            # A tag inside a Flate stream is reported at its keyword
+                            text = b'stream'
+                        self.assertEqual(self.data[finding['offset']:finding['offset'] + len(text)], text,
+                                         category)
+
+    def test_first_only(self):
+        report = sanitizer.PDFSanitizer().scan_pdf(self.path, first_only=True)
+        self.assertEqual(set(report['findings']), CATEGORIES)
+        for category, found in report['findings'].items():
+            self.assertEqual(len(found), 1, category)
+
+    def test_first_only_stops_inflating_at_the_tag(self):
+        # The only tag opens a stream that inflates past the limit
+        def tagged_bomb(objects):
+            objects[1] = objects[1].replace(b'/Lang(he)', b'')
+            objects[4] = fixtures.stream(b'', fixtures.CONTENT + bytes(8 << 20), flate=True)
+        with open(self.path, 'wb') as f:
+            f.write(fixtures.simple_document(extra=tagged_bomb))
+        for use_xref in (True, False):
+            with self.subTest(use_xref=use_xref):
+                pdf = sanitizer.PDFSanitizer(use_xref=use_xref, max_inflate=1 << 20)
+                report = pdf.scan_pdf(self.path, first_only=True)
+                self.assertEqual(len(report['findings']['lang_tags']), 1)
+                self.assertEqual(report['errors'], [])
+                report = pdf.scan_pdf(self.path)
+                self.assertNotIn('lang_tags', report['findings'])
+                self.assertEqual([error['guard'] for error in report['errors']], ['stream_inflate'])
+
+    def test_sanitized_file_scans_clean(self):
+        for use_xref in (True, False):
+            with self.subTest(use_xref=use_xref):
+                pdf = sanitizer.PDFSanitizer(use_xref=use_xref)
+                output_path, _ = pdf.sanitize_pdf(self.path)
+                report = pdf.scan_pdf(output_path)
+                self.assertEqual(report['findings'], {})
+                self.assertTrue(report['clean'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""Tests for the local HTTP service"""
+
+import asyncio
+import http.client
+import json
+import socket
+import threading
+import time
+import unittest
+
+import fixtures
+from support import sanitizer
+
+
+class ServiceTest(unittest.TestCase):
+    def start(self, **settings):
+        """Serve on self.port with one worker until the test ends"""
+        server = sanitizer.SanitizeServer(workers=1, **settings)
+        loop = asyncio.new_event_loop()
+        listening = threading.Event()
+        task = loop.create_task(server.serve(port=0, ready=lambda listener: (
+            setattr(self, 'port', listener.sockets[0].getsockname()[1]), listening.set())))
+
+        def run():
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                loop.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(loop.call_soon_threadsafe, task.cancel)
+        self.assertTrue(listening.wait(60), "server did not start")
+
+    def request(self, method, path, body=None):
+        """(status, headers, body) of one request on a new connection"""
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            connection.close()
+
+    def test_sanitize(self):
+        self.start()
+        status, headers, body = self.request('POST', '/sanitize?recompress=fast', fixtures.simple_document())
+        self.assertEqual(status, 200)
+        self.assertTrue(body.startswith(b'%PDF'))
+        for secret in fixtures.SECRETS:
+            self.assertNotIn(secret, body)
+        stats = json.loads(headers['X-Sanitize-Stats'])
+        self.assertEqual(stats['lang_tags'], 20)
+        self.assertTrue(stats['author'])
+
+        self.assertEqual(self.request('POST', '/sanitize?remove_author=maybe', b'%PDF')[0], 400)
+        self.assertEqual(self.request('GET', '/sanitize')[0], 405)
+        health = json.loads(self.request('GET', '/health')[2])
+        self.assertEqual(health['status'], 'ok')
+        metrics = self.request('GET', '/metrics')[2].decode()
+        self.assertIn('pdf_sanitizer_requests_total{status="200"} 1', metrics)
+
+    def test_full_queue_is_refused(self):
+        self.start(queue_depth=1)
+        data = fixtures.simple_document()
+        # A request whose body is still arriving holds the only place
+        held = socket.create_connection(('127.0.0.1', self.port), timeout=60)
+        self.addCleanup(held.close)
+        held.sendall(b'POST /sanitize HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+                     b'Content-Length: %d\r\n\r\n' % len(data) + data[:100])
+        deadline = time.monotonic() + 60
+        while json.loads(self.request('GET', '/health')[2])['queued'] != 1:
+            self.assertLess(time.monotonic(), deadline, "request was not admitted")
+            time.sleep(0.01)
+
+        status, headers, _ = self.request('POST', '/sanitize', data)
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['Retry-After'], '1')
+
+        # The held request still completes once its body is in
+        held.sendall(data[100:])
+        response = http.client.HTTPResponse(held)
+        response.begin()
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.read().startswith(b'%PDF'))
+
+    def test_timeout(self):
+        self.start(timeout=0)
+        status, _, body = self.request('POST', '/sanitize', fixtures.simple_document())
+        self.assertEqual(status, 504)
+        self.assertEqual(body, b'Timed out\n')
+        # The place is given back although the worker still runs the job
+        health = json.loads(self.request('GET', '/health')[2])
+        self.assertEqual(health['running'] + health['queued'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""Tests for the bounded-memory streaming mode"""
+
+import collections
+import contextlib
+import io
+import os
+import random
+import tempfile
+import unittest
+
+import fixtures
+from support import sanitizer
+
+# A 64 KiB window, of which the last 32 KiB are carried into the next one
+BUDGET = 256 * 1024
+WINDOW = 64 * 1024
+LIMIT = WINDOW // 2
+
+
+def padded_document(filler, body_size=20 * 1024):
+    """A document whose untagged Flate stream (object 4) starts about
+    filler bytes into the file, directly followed by a tagged one"""
+    noise = random.Random(body_size).randbytes(body_size)
+    return fixtures.classic({
+        1: b'<</Type/Catalog/Pages 2 0 R/Metadata 6 0 R/Lang(he)>>',
+        2: b'<</Type/Pages/Kids[3 0 R]/Count 1>>',
+        3: b'<</Type/Page/Parent 2 0 R/Contents[4 0 R 5 0 R]/Filler(' + b'x' * filler + b')>>',
+        4: fixtures.stream(b'', noise, flate=True),
+        5: fixtures.stream(b'', fixtures.CONTENT * 20, flate=True),
+        6: fixtures.stream(b'/Type/Metadata/Subtype/XML', fixtures.xmp_packet()),
+        7: fixtures.INFO,
+        # Keeps the file longer than a window
+        8: b'(' + b'y' * 2 * WINDOW + b')',
+    }, info=7)
+
+
+class StreamingTest(unittest.TestCase):
+    def assertSameAsInMemory(self, data, budget=BUDGET):
+        stats = collections.defaultdict(int, {key: False for key in sanitizer.DEFAULT_OPTIONS})
+        stats['lang_tags'] = 0
+        expected = sanitizer.RewriteEngine(sanitizer.DEFAULT_OPTIONS).rewrite(data, stats)
+        out = io.BytesIO()
+        streamed = sanitizer.PDFSanitizer().sanitize_stream(io.BytesIO(data), out, memory_budget=budget)
+        self.assertEqual(out.getvalue(), expected)
+        for key in ('author', 'creator', 'producer', 'title', 'subject', 'timestamps', 'timezone',
+                    'lang_tags', 'doc_id'):
+            self.assertEqual(streamed[key], stats[key], key)
+
+    def test_match_across_window_boundary(self):
+        data = fixtures.simple_document()
+        author = data.index(b'/Author')
+        for shift in range(-12, 12):
+            with self.subTest(shift=shift):
+                # Moves /Author(...) so that it straddles the end of the window
+                filler = LIMIT - author + shift
+                self.assertSameAsInMemory(fixtures.simple_document(extra=lambda objects: objects.update(
+                    {3: objects[3][:-2] + b'/Filler(' + b'x' * filler + b')>>'})))
+
+    def test_stream_across_window_limit(self):
+        # Untagged stream ending before, inside and past the carried-over
+        # part of the window, and one longer than the window itself
+        for filler in range(LIMIT - 24 * 1024, WINDOW, 2 * 1024):
+            with self.subTest(filler=filler):
+                self.assertSameAsInMemory(padded_document(filler))
+        self.assertSameAsInMemory(padded_document(1000, body_size=3 * WINDOW))
+
+    def test_tagged_stream_longer_than_window(self):
+        body = random.Random(1).randbytes(3 * WINDOW) + fixtures.CONTENT
+        data = fixtures.simple_document(extra=lambda objects: objects.update(
+            {4: fixtures.stream(b'', body, flate=True)}))
+        self.assertSameAsInMemory(data)
+
+    def test_small_budget_is_raised_to_minimum_window(self):
+        self.assertSameAsInMemory(fixtures.simple_document(), budget=1)
+
+
+class StreamingFileTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(self.directory, 'input.pdf')
+        self.data = fixtures.simple_document()
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        out = io.BytesIO()
+        sanitizer.PDFSanitizer().sanitize_stream(io.BytesIO(self.data), out, memory_budget=BUDGET)
+        self.expected = out.getvalue()
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_file_onto_itself(self):
+        sanitizer.PDFSanitizer().sanitize_pdf(self.path, self.path, memory_budget=BUDGET)
+        self.assertEqual(self.read(self.path), self.expected)
+        self.assertEqual(os.listdir(self.directory), ['input.pdf'])
+
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(sanitizer.stream_mode([self.path, self.path]), 0)
+        self.assertEqual(self.read(self.path), self.expected)
+        self.assertEqual(os.listdir(self.directory), ['input.pdf'])
+
+    def test_failure_leaves_no_output(self):
+        output = os.path.join(self.directory, 'output.pdf')
+        for target in (output, self.path):
+            with self.subTest(onto_itself=target == self.path):
+                with self.assertRaises(sanitizer.SanitizeAborted):
+                    sanitizer.PDFSanitizer(timeout=0).sanitize_pdf(self.path, target, memory_budget=BUDGET)
+                self.assertEqual(os.listdir(self.directory), ['input.pdf'])
+                self.assertEqual(self.read(self.path), self.data)
+
+        with contextlib.redirect_stderr(io.StringIO()) as messages:
+            self.assertEqual(sanitizer.stream_mode([os.path.join(self.directory, 'missing.pdf'), output]), 1)
+        self.assertIn('[ERROR]', messages.getvalue())
+        self.assertEqual(os.listdir(self.directory), ['input.pdf'])
+
+
+if __name__ == '__main__':
+    unittest.main()
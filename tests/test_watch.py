@@ -0,0 +1,137 @@
+"""Tests for the watch-folder mode"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+import fixtures
+from support import sanitizer
+
+
+class RecordingPool:
+    """Stands in for the process pool: keeps the submitted jobs, never runs them"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, job):
+        self.jobs.append(job)
+        return Future()
+
+
+class WatchFolderTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.inbox = os.path.join(directory.name, 'inbox')
+        self.outbox = os.path.join(directory.name, 'outbox')
+        os.makedirs(self.inbox)
+
+    def drop(self, name, data=None):
+        path = os.path.join(self.inbox, name)
+        with open(path, 'wb') as f:
+            f.write(fixtures.simple_document() if data is None else data)
+        return path
+
+    def test_file_waits_until_closed_and_settled(self):
+        watch = sanitizer.WatchFolder(self.inbox, self.outbox, jobs=1)
+        pool = RecordingPool()
+        path = self.drop('report.pdf')
+        # Still being written
+        watch._touch('report.pdf', closed=False)
+        watch._dispatch(pool, 0)
+        self.assertEqual(pool.jobs, [])
+
+        watch._touch('report.pdf', closed=True)
+        watch._dispatch(pool, 60)
+        self.assertEqual(pool.jobs, [])
+
+        # Written again without an event seen: the settle time starts over
+        with open(path, 'ab') as f:
+            f.write(b'\n')
+        watch._dispatch(pool, 0)
+        self.assertEqual(pool.jobs, [])
+        watch._dispatch(pool, 0)
+        self.assertEqual([job[0] for job in pool.jobs], [path])
+
+        # Hidden files, other types and files in progress are not picked up
+        self.drop('.hidden.pdf')
+        self.drop('notes.txt', b'text')
+        watch._scan()
+        self.assertEqual(watch.pending, {})
+
+    def test_run_once(self):
+        # Collapsing needs an xref, so the file that is not a PDF fails
+        watch = sanitizer.WatchFolder(self.inbox, self.outbox, jobs=2, poll=0.05, settle=0,
+                                      output_mode='collapse')
+        for i in range(3):
+            self.drop(f'{i}.pdf')
+        self.drop('broken.pdf', b'not a pdf')
+        watch.run(once=True)
+        self.assertEqual(watch.counts, {'ok': 3, 'failed': 1, 'resumed': 0})
+        self.assertEqual(sorted(os.listdir(self.outbox)), ['0.pdf', '1.pdf', '2.pdf'])
+        self.assertEqual(sorted(os.listdir(watch.done)), ['0.pdf', '1.pdf', '2.pdf'])
+        self.assertEqual(os.listdir(watch.failed), ['broken.pdf'])
+        with open(os.path.join(self.outbox, '0.pdf'), 'rb') as f:
+            output = f.read()
+        for secret in fixtures.SECRETS:
+            self.assertNotIn(secret, output)
+        with open(watch.journal_path, encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), 4)
+
+    def test_polls_where_libc_cannot_be_loaded(self):
+        # ctypes.CDLL(None) raises TypeError on Windows
+        watch = sanitizer.WatchFolder(self.inbox, self.outbox, jobs=1, settle=0)
+        self.drop('report.pdf')
+        with mock.patch('ctypes.CDLL', side_effect=TypeError("expected str, bytes or os.PathLike object")):
+            watch.run(once=True)
+        self.assertEqual(watch.poll, sanitizer.DEFAULT_POLL_INTERVAL)
+        self.assertEqual(watch.counts['ok'], 1)
+
+    def test_stop_wakes_the_loop(self):
+        watch = sanitizer.WatchFolder(self.inbox, self.outbox, jobs=1)
+        thread = threading.Thread(target=watch.run)
+        thread.start()
+        self.addCleanup(thread.join)
+        # Nothing to wait for: run() sleeps until it is woken
+        while watch._wake is None and thread.is_alive():
+            time.sleep(0.01)
+        watch.stop()
+        thread.join(60)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(watch._wake)
+
+    def test_journal_resumes_without_sanitizing_again(self):
+        # A crash after the journal entry, before the original was moved
+        path = self.drop('report.pdf')
+        os.makedirs(self.outbox)
+        output = os.path.join(self.outbox, 'report.pdf')
+        with open(output, 'wb') as f:
+            f.write(b'published before the crash')
+        info = os.stat(path)
+        record = {'name': 'report.pdf', 'size': info.st_size, 'mtime_ns': info.st_mtime_ns, 'ok': True,
+                  'output': output, 'error': None}
+        stale = dict(record, name='gone.pdf')
+        journal = os.path.join(self.inbox, sanitizer.WATCH_JOURNAL)
+        with open(journal, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(stale) + '\n' + json.dumps(record) + '\n' + '{"name": "cut')
+
+        watch = sanitizer.WatchFolder(self.inbox, self.outbox, jobs=1, poll=0.05, settle=0)
+        watch.run(once=True)
+        self.assertEqual(watch.counts, {'ok': 0, 'failed': 0, 'resumed': 1})
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), b'published before the crash')
+        self.assertEqual(os.listdir(watch.done), ['report.pdf'])
+        self.assertFalse(os.path.exists(path))
+        # Only entries for files still in the inbox are kept
+        with open(journal, encoding='utf-8') as f:
+            self.assertEqual([json.loads(line) for line in f], [record])
+
+
+if __name__ == '__main__':
+    unittest.main()